@@ -1,9 +1,49 @@
+import time
+
 import torch
 import torch.fx as fx
 from functorch import make_fx
 from torch.profiler import profile, ProfilerActivity
+from torch.utils._pytree import tree_flatten
+
+from functorch._src.compile_utils import fx_graph_cse, get_aten_target, rand_ops
+
+
+# The CSE pass before it keyed nodes by tuple keys, kept for comparison
+def legacy_fx_graph_cse(fx_g: torch.fx.graph.Graph):
+    new_graph = fx.Graph()
+    env = {}  # map from node in the old graph to node in the new graph
+    hash_env = {}  # map from hash to a node in the new graph
+    token_map = {}  # map from hash to token
+    for n in fx_g.nodes:
+        if n.op == 'placeholder' or n.op == 'output' or n.op == 'get_attr' or get_aten_target(n) in rand_ops:
+            new_node = new_graph.node_copy(n, lambda x: env[x])
+            env[n] = new_node
+        else:
+            def substitute(arg_list):
+                arg_list, spec = tree_flatten(arg_list)
+                for i in range(len(arg_list)):
+                    v = arg_list[i]
+                    if isinstance(v, torch.fx.node.Node) and v in env:
+                        arg_list[i] = env[v]
+                return tuple(arg_list), spec
+            args, args_spec = substitute(n.args)
+            kwargs, kwargs_spec = substitute(n.kwargs)
+            token = {"target": n.target, "args": args, "args_spec": args_spec,
+                     "kwargs": kwargs, "kwargs_spec": kwargs_spec}
+            hash_arg = hash((args, kwargs))
+            hash_val = (n.target, hash_arg)
+            hash_val_in_hash_env = hash_val in hash_env
+            if hash_val_in_hash_env and token_map[hash_val] == token:
+                env[n] = hash_env[hash_val]
+                continue
+            new_node = new_graph.node_copy(n, lambda x: env[x])
+            env[n] = new_node
+            if not hash_val_in_hash_env:
+                hash_env[hash_val] = new_node
+                token_map[hash_val] = token
+    return new_graph
 
-from functorch._src.compile_utils import fx_graph_cse
 
 def profile_it(f, inp):
     for _ in range(5):
@@ -20,6 +60,7 @@ def profile_it(f, inp):
         cuda_time_total = cuda_time_total + e.cuda_time_total
     return cuda_time_total / itr
 
+
 def profile_function(name, f, inp):
     fx_g = make_fx(f)(inp)
 
@@ -36,14 +77,10 @@ def profile_function(name, f, inp):
 
     print(f"{name}, {avg_cuda_time_f}, {avg_cuda_time_g}, {num_node_decrease}, {len(fx_g.graph.nodes)}")
 
-g_gpu = torch.Generator(device='cuda')
-g_gpu.manual_seed(2147483647)
-inp = torch.randn(2**20, device='cuda', generator=g_gpu)
 
 def f1(x):
     return x.cos().cos()
 
-profile_function("f1", f1, inp)
 
 def fsum(x):
     a = x.sum()
@@ -52,13 +89,12 @@ def fsum(x):
     d = x.sum()
     return a + b + c + d
 
-profile_function("fsum", fsum, inp)
 
 def fconcat(x):
     a = torch.cat((x, x))
     b = torch.cat((x, x))
     return a + b
-profile_function("fconcat", fconcat, inp)
+
 
 def fsum2(x):
     a = x.sum()
@@ -66,7 +102,6 @@ def fsum2(x):
         a = a + x.sum()
     return a
 
-profile_function("fsum2", fsum2, inp)
 
 def fsummulti(x):
     a = 0
@@ -75,7 +110,6 @@ def fsummulti(x):
         a = a * x.sum()
     return a
 
-profile_function("fsummulti", fsummulti, inp)
 
 def fsummulti2(x):
     a = 0
@@ -84,7 +118,6 @@ def fsummulti2(x):
         a = a * x.sum()
     return a
 
-profile_function("fsummulti2", fsummulti2, inp)
 
 def fcos(x):
     a = 0
@@ -92,7 +125,6 @@ def fcos(x):
         a = a + x.cos()
     return a
 
-profile_function("fcos", fcos, inp)
 
 def fcos2(x):
     a = 0
@@ -100,4 +132,55 @@ def fcos2(x):
         a = a + x.cos()
     return a
 
-profile_function("fcos2", fcos2, inp)
+
+def joint_graph(num_layers):
+    """
+    The joint forward and backward graph of a stack of gated layers, whose
+    gates are computed both ways round and from constants.
+    """
+    def layer(x, w):
+        h = torch.mm(x, w)
+        gate = torch.sigmoid(h) * torch.tanh(h)
+        gate = gate + torch.tanh(h) * torch.sigmoid(h)
+        scale = torch.ones(w.shape[1]).cumsum(0) * 0.5
+        return torch.nn.functional.gelu(gate * scale) + x
+
+    def joint(x, *weights):
+        out = x
+        for w in weights:
+            out = layer(out, w)
+        return torch.autograd.grad(out.sum(), weights)
+
+    x = torch.randn(8, 16)
+    weights = [torch.randn(16, 16, requires_grad=True) for _ in range(num_layers)]
+    return make_fx(joint)(x, *weights)
+
+
+def time_pass(name, cse, fx_g, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        new_graph = cse(fx_g.graph)
+        best = min(best, time.perf_counter() - start)
+    num_kernels = sum(1 for n in fx_g.graph.nodes if n.op == 'call_function')
+    num_kernels_after = sum(1 for n in new_graph.nodes if n.op == 'call_function')
+    print(f"{name}, {len(fx_g.graph.nodes)} nodes, {best * 1000:.1f} ms, "
+          f"{num_kernels - num_kernels_after} of {num_kernels} kernels removed")
+
+
+if __name__ == "__main__":
+    # Time of the pass on large joint graphs, and the ops it removes
+    fx_g = joint_graph(1250)
+    print("pass, graph size, pass time, kernel savings")
+    time_pass("legacy", legacy_fx_graph_cse, fx_g)
+    time_pass("fx_graph_cse", fx_graph_cse, fx_g)
+
+    if torch.cuda.is_available():
+        g_gpu = torch.Generator(device='cuda')
+        g_gpu.manual_seed(2147483647)
+        inp = torch.randn(2**20, device='cuda', generator=g_gpu)
+
+        print("name, cuda time before, cuda time after, nodes removed, nodes")
+        for name, f in [("f1", f1), ("fsum", fsum), ("fconcat", fconcat), ("fsum2", fsum2),
+                        ("fsummulti", fsummulti), ("fsummulti2", fsummulti2), ("fcos", fcos), ("fcos2", fcos2)]:
+            profile_function(name, f, inp)
@@ -0,0 +1,158 @@
+"""
+Compares the built-in min-cut solver of the rematerialization partitioner with
+networkx, on synthetic flow networks shaped like joint graphs and on the joint
+graphs of real models. Checks that both produce identical partitions. For the
+models, the solver times are reported next to the time of the whole
+partitioner with the built-in solver.
+
+Usage: python benchmarks/min_cut.py [--sizes 1000 10000 50000] [--no-networkx]
+"""
+import argparse
+import math
+import random
+import time
+from functools import partial
+
+import torch
+import torch.nn as nn
+from functorch.compile import (
+    aot_module, clear_partition_cache, min_cut_rematerialization_partition, nop, CompileProfiler
+)
+from functorch._src import partitioners
+from functorch._src.min_cut import FlowGraph
+
+try:
+    import networkx as nx
+except ImportError:
+    nx = None
+
+
+class NetworkxFlowGraph(FlowGraph):
+    """Solves the same network with networkx.minimum_cut."""
+    def minimum_cut(self, source, sink):
+        g = nx.DiGraph()
+        g.add_nodes_from(range(self.num_nodes))
+        for e in range(0, len(self.edge_to), 2):
+            u, v = self.edge_to[e + 1], self.edge_to[e]
+            g.add_edge(u, v, capacity=self.edge_cap[e])
+        return nx.minimum_cut(g, source, sink)
+
+
+def synthetic_joint_graph(num_nodes, seed=0):
+    """
+    A flow network like the ones the partitioner builds: every node is split
+    into an in and out node connected by its size, users are connected with
+    infinite edges, primals hang off the source and backward nodes off the sink.
+    """
+    rng = random.Random(seed)
+    g = FlowGraph(2 * num_nodes + 2)
+    source, sink = 0, 1
+    num_fw = num_nodes // 2
+    for i in range(num_nodes):
+        node_in, node_out = 2 * i + 2, 2 * i + 3
+        if i >= num_fw:
+            g.add_edge(node_in, sink, math.inf)
+            continue
+        if i < 8 or rng.random() < 0.05:
+            g.add_edge(source, node_in, math.inf)
+        g.add_edge(node_in, node_out, rng.choice([4, 8, 16, 32]) * 1024 + rng.randrange(1000))
+        for _ in range(rng.randint(1, 3)):
+            user = rng.randrange(i + 1, min(i + 64, num_nodes - 1) + 1)
+            g.add_edge(node_out, 2 * user + 2, math.inf)
+    return g
+
+
+def time_solve(g, repeat=1):
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = g.minimum_cut(0, 1)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_synthetic(sizes, use_networkx):
+    print(f"{'synthetic nodes':<20}{'edges':>10}{'native (s)':>14}{'networkx (s)':>14}{'identical':>11}")
+    for size in sizes:
+        g = synthetic_joint_graph(size)
+        native_time, (native_value, native_partition) = time_solve(g)
+        nx_time, identical = float("nan"), "-"
+        if use_networkx:
+            nx_g = NetworkxFlowGraph()
+            nx_g.__dict__.update(g.__dict__)
+            nx_time, (nx_value, nx_partition) = time_solve(nx_g)
+            identical = native_value == nx_value and native_partition[1] == set(nx_partition[1])
+        print(f"{size:<20}{g.num_edges:>10}{native_time:>14.3f}{nx_time:>14.3f}{str(identical):>11}")
+
+
+class MLP(nn.Module):
+    def __init__(self, width, depth):
+        super().__init__()
+        self.layers = nn.ModuleList([nn.Linear(width, width) for _ in range(depth)])
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = torch.nn.functional.gelu(layer(x)) + x
+        return x
+
+
+class Transformer(nn.Module):
+    def __init__(self, width, depth):
+        super().__init__()
+        self.layers = nn.ModuleList([
+            nn.TransformerEncoderLayer(width, nhead=4, dim_feedforward=2 * width, dropout=0.0, batch_first=True)
+            for _ in range(depth)
+        ])
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+
+def partition_with(flow_graph_cls, results, joint_module, joint_inputs):
+    partitioners.FlowGraph = flow_graph_cls
+    # Solve every graph, instead of reusing the cut of the other solver
+    clear_partition_cache()
+    try:
+        start = time.perf_counter()
+        with CompileProfiler() as prof:
+            fw_module, bw_module = min_cut_rematerialization_partition(joint_module, joint_inputs)
+        results["time"] = time.perf_counter() - start
+        results["solve_time"] = prof.summary()["min_cut"]["total_time"]
+    finally:
+        partitioners.FlowGraph = FlowGraph
+    results["fw_code"] = fw_module.code
+    results["joint_nodes"] = len(joint_module.graph.nodes)
+    return fw_module, bw_module
+
+
+def bench_models(use_networkx):
+    models = [
+        ("mlp x64", MLP(64, 64), torch.randn(32, 64)),
+        ("mlp x256", MLP(32, 256), torch.randn(16, 32)),
+        ("transformer x8", Transformer(64, 8), torch.randn(4, 16, 64)),
+    ]
+    print(f"\n{'model':<20}{'joint nodes':>12}{'native (s)':>14}{'networkx (s)':>14}{'partition (s)':>15}"
+          f"{'identical':>11}")
+    for name, model, x in models:
+        native = {}
+        aot_module(model, nop, partition_fn=partial(partition_with, FlowGraph, native))(x).sum().backward()
+        nx_time, identical = float("nan"), "-"
+        if use_networkx:
+            reference = {}
+            aot_module(model, nop, partition_fn=partial(partition_with, NetworkxFlowGraph, reference))(x)
+            nx_time = reference["solve_time"]
+            identical = native["fw_code"] == reference["fw_code"]
+        print(f"{name:<20}{native['joint_nodes']:>12}{native['solve_time']:>14.3f}{nx_time:>14.3f}"
+              f"{native['time']:>15.3f}{str(identical):>11}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--no-networkx", action="store_true")
+    args = parser.parse_args()
+    use_networkx = nx is not None and not args.no_networkx
+    bench_synthetic(args.sizes, use_networkx)
+    bench_models(use_networkx)
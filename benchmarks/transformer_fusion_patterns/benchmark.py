@@ -1,6 +1,8 @@
 import torch
 import time
-from functorch.compile import memory_efficient_fusion, clear_compile_cache
+from functorch.compile import (
+    aot_function, boxed_nop, clear_compile_cache, memory_efficient_fusion, min_cut_rematerialization_partition, nop
+)
 import benchmark_helper
 
 
@@ -190,3 +192,13 @@ for cl in [DropoutResBias, BiasReluDropout, DropoutResBiasScalar, BiasDropoutRes
     benchmark_helper.time_with_manual_timer(fn, args, "Eager")
     with torch.jit.fuser("fuser2"):
         benchmark_helper.time_with_manual_timer(opt_fn, args, "AOTAutograd")
+
+    # Peak memory of the graphs run by Python, which keep the saved tensors
+    # alive for the whole backward unless they are boxed
+    benchmark_helper.measure_peak_memory(fn, args, "Eager")
+    for name, compiler in [("nop", nop), ("boxed_nop", boxed_nop)]:
+        clear_compile_cache()
+        aot_fn = aot_function(
+            fn, compiler, partition_fn=min_cut_rematerialization_partition, static_argnums=static_argnums
+        )
+        benchmark_helper.measure_peak_memory(aot_fn, args, f"AOTAutograd ({name})")
@@ -144,3 +144,35 @@ def time_with_manual_timer(fn, args, string_id):
     print("################################################")
     print(f"#### Manual Timer for {string_id} ends #########")
     print("################################################\n\n\n")
+    return avg_fwd, avg_bwd
+
+
+def measure_peak_memory(fn, args, string_id):
+    """
+    Prints the peak memory allocated by the forward and by the backward of
+    :attr:`fn`, on top of the memory in use before it runs.
+    """
+    ref = fn(*args)
+    gO = torch.rand_like(ref)
+    ref.backward(gO)
+    del ref
+    for arg in args:
+        if isinstance(arg, torch.Tensor):
+            arg.grad = None
+
+    torch.cuda.synchronize()
+    base = torch.cuda.memory_allocated()
+    torch.cuda.reset_peak_memory_stats()
+    ref = fn(*args)
+    torch.cuda.synchronize()
+    fwd_peak = torch.cuda.max_memory_allocated() - base
+
+    torch.cuda.reset_peak_memory_stats()
+    bwd_base = torch.cuda.memory_allocated()
+    ref.backward(gO)
+    torch.cuda.synchronize()
+    bwd_peak = torch.cuda.max_memory_allocated() - base
+    bwd_delta = torch.cuda.max_memory_allocated() - bwd_base
+    print(f"Peak memory for {string_id}: forward = {fwd_peak / 2 ** 20:.1f} MiB, "
+          f"backward = {bwd_peak / 2 ** 20:.1f} MiB ({bwd_delta / 2 ** 20:+.1f} MiB over the saved tensors)")
+    return fwd_peak, bwd_peak
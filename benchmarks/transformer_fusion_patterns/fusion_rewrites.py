@@ -0,0 +1,70 @@
+import torch
+import torch.nn.functional as F
+from functorch.compile import clear_compile_cache, config, memory_efficient_fusion
+import benchmark_helper
+
+# Speedup of the built-in fusion patterns of functorch.compile: each pattern
+# is compiled with memory_efficient_fusion with and without rewriting it.
+
+device = "cuda"
+dtype = torch.float16
+
+
+class BiasGeluDropout:
+    @staticmethod
+    def fn(input, bias):
+        return F.dropout(F.gelu(input + bias), p=0.1, training=True)
+
+    @staticmethod
+    def args():
+        batch_size, seq_len, intermediate_size = 32, 196, 4096
+        input = torch.randn(batch_size, seq_len, intermediate_size, requires_grad=True, device=device, dtype=dtype)
+        bias = torch.randn(intermediate_size, requires_grad=True, device=device, dtype=dtype)
+        return (input, bias)
+
+
+class LayerNormResidual:
+    @staticmethod
+    def fn(input, residual, weight, bias):
+        return F.layer_norm(input + residual, (1024,), weight, bias, 1e-12)
+
+    @staticmethod
+    def args():
+        batch_size, seq_len, hidden_size = 32, 196, 1024
+        input = torch.randn(batch_size, seq_len, hidden_size, requires_grad=True, device=device, dtype=dtype)
+        residual = torch.randn(batch_size, seq_len, hidden_size, requires_grad=True, device=device, dtype=dtype)
+        weight = torch.randn(hidden_size, requires_grad=True, device=device, dtype=dtype)
+        bias = torch.randn(hidden_size, requires_grad=True, device=device, dtype=dtype)
+        return (input, residual, weight, bias)
+
+
+class SoftmaxMaskDropout:
+    @staticmethod
+    def fn(scores, mask):
+        return F.dropout(torch.softmax(scores + mask, -1), p=0.1, training=True)
+
+    @staticmethod
+    def args():
+        batch_size, num_heads, seq_len = 32, 16, 196
+        scores = torch.randn(batch_size, num_heads, seq_len, seq_len, requires_grad=True, device=device, dtype=dtype)
+        mask = torch.randn(batch_size, 1, 1, seq_len, device=device, dtype=dtype)
+        return (scores, mask)
+
+
+for cl in [BiasGeluDropout, LayerNormResidual, SoftmaxMaskDropout]:
+    fn = cl.fn
+    args = cl.args()
+
+    times = {}
+    for rewrite in [False, True]:
+        clear_compile_cache()
+        config.rewrite_fusion_patterns = rewrite
+        opt_fn = memory_efficient_fusion(fn)
+        name = f"{cl.__name__} ({'rewritten' if rewrite else 'not rewritten'})"
+        with torch.jit.fuser("fuser2"):
+            times[rewrite] = benchmark_helper.time_with_manual_timer(opt_fn, args, name)
+    config.rewrite_fusion_patterns = False
+
+    (fwd, bwd), (rewritten_fwd, rewritten_bwd) = times[False], times[True]
+    print(f"{cl.__name__}: forward speedup {fwd / rewritten_fwd:.2f}x, backward speedup {bwd / rewritten_bwd:.2f}x, "
+          f"total speedup {(fwd + bwd) / (rewritten_fwd + rewritten_bwd):.2f}x")
@@ -1,4 +1,13 @@
 from contextlib import contextmanager
+import collections
+import concurrent.futures
+import copy
+import inspect
+import pickle
+import threading
+import time
+import warnings
+import weakref
 import torch
 import torch.nn as nn
 from torch import Tensor
@@ -12,9 +21,19 @@ from functorch.experimental import functionalize
 from . import config
 from .decompositions import register_decomposition
 from .partitioners import default_partition
+from .fusion_patterns import apply_fusion_patterns
+from .partition_report import PartitionReport
+from .memory_planner import plan_memory
+from .compile_profiler import compile_phase, is_profiling_compiles
+from .persistent_cache import (
+    compute_cache_key,
+    deserialize_compiled,
+    get_persistent_cache,
+    serialize_compiled,
+)
 from .named_members_polyfill import _named_parameters, _named_buffers
-from typing import Callable, List, Dict, Any, Tuple, Optional
-from functools import wraps
+from typing import Callable, List, Dict, Any, Tuple, Optional, Union
+from functools import partial, wraps
 
 try:
     from torchdynamo import disable as disable_torchdynamo
@@ -134,8 +153,108 @@ def new_full(inp, size, value, dtype=None, layout=None, device=None, pin_memory=
     return torch.full(size, value, dtype=inp.dtype, device=inp.device)
 
 
+def _outputs_from_meta(flat_fn, flat_tensor_args):
+    """
+    Runs :attr:`flat_fn` on meta copies of the tensor args to get the shapes
+    and dtypes of its outputs without computing them. Returns None if
+    :attr:`flat_fn` can't run on meta tensors, e.g. because it creates
+    tensors on another device, or if its outputs are not meta tensors.
+    """
+    meta_args = [
+        x.detach().to("meta").requires_grad_(x.requires_grad) if isinstance(x, Tensor) else x
+        for x in flat_tensor_args
+    ]
+    try:
+        out = flat_fn(*meta_args)
+    except Exception:
+        return None
+    if any(isinstance(x, Tensor) and not x.is_meta for x in pytree.tree_flatten(out)[0]):
+        return None
+    return out
+
+
+def _zeros_like_meta(x, device):
+    """Replaces the meta tensors in :attr:`x` by zero-filled tensors on :attr:`device`."""
+    return pytree.tree_map(
+        lambda t: torch.zeros(t.shape, dtype=t.dtype, device=device)
+        if isinstance(t, Tensor) and t.is_meta else t, x
+    )
+
+
+def _maybe_plan_memory(fx_module, example_inputs, partition_report, graph):
+    """
+    Runs the memory planner on :attr:`fx_module` if ``config.memory_planning``
+    is set, and records the plan in the :attr:`partition_report`.
+    """
+    if not config.memory_planning:
+        return fx_module
+    fx_module = plan_memory(fx_module, example_inputs)
+    if partition_report is not None:
+        setattr(partition_report, f"{graph}_memory_plan", fx_module.memory_plan)
+    return fx_module
+
+
+def _example_inputs_from_meta(fx_module, device) -> Optional[List[Tensor]]:
+    """
+    Returns uninitialized tensors with the shapes, strides and dtypes of the
+    inputs of :attr:`fx_module` on :attr:`device`, or None if the metadata of
+    an input is unknown.
+    """
+    example_inputs = []
+    for node in fx_module.graph.nodes:
+        if node.op != "placeholder":
+            continue
+        tensor_meta = node.meta.get("tensor_meta")
+        if device is None or tensor_meta is None or not hasattr(tensor_meta, "shape"):
+            return None
+        example_inputs.append(torch.empty_strided(
+            tuple(tensor_meta.shape), tuple(tensor_meta.stride), dtype=tensor_meta.dtype, device=device
+        ))
+    return example_inputs
+
+
+def _common_device(args) -> Optional[torch.device]:
+    """
+    Returns the device of the tensors in :attr:`args` if they are all on the
+    same one, and None otherwise.
+    """
+    devices = {x.device for x in args if isinstance(x, Tensor)}
+    return next(iter(devices)) if len(devices) == 1 else None
+
+
+def _views_tangents(bw_module: torch.fx.GraphModule) -> bool:
+    """
+    Returns whether :attr:`bw_module` calls ``aten.view`` on a value computed
+    from its tangents. Unlike other ops, ``view`` fails for inputs with
+    strides other than those the graph was traced with, and the outputs of
+    most ops take over the strides of their inputs.
+    """
+    from_tangents = set()
+    for node in bw_module.graph.nodes:
+        if node.op == "placeholder":
+            if "tangents" in node.target:
+                from_tangents.add(node)
+        elif any(arg in from_tangents for arg in node.all_input_nodes):
+            if node.target in (torch.ops.aten.view.default, torch.ops.aten._unsafe_view.default):
+                return True
+            from_tangents.add(node)
+    return False
+
+
+def _call_compiled(compiled, args: List[Any]):
+    """
+    Calls a compiled forward or backward with the list :attr:`args`. Boxed
+    graphs (see ``make_boxed_module``) take the list itself and clear it, so
+    that nothing but the graph holds on to the inputs.
+    """
+    if getattr(compiled, "_boxed_call", False):
+        return compiled(args)
+    return compiled(*args)
+
+
 def create_aot_autograd_function(
-    flat_fn, fw_compiler, bw_compiler, partition_fn, decompositions, grad_state
+    flat_fn, fw_compiler, bw_compiler, partition_fn, decompositions, grad_state,
+    cache_key=None, out_spec=None,
 ):
     """
     Traces the forward and backward graphs of the attr:`flat_fn` to generate a
@@ -148,64 +267,299 @@ def create_aot_autograd_function(
 
     The resulting compiled forward and backward graphs are then wrapped up in a
     ``torch.autograd.Function`` object.
+
+    If :attr:`cache_key` is given and ``config.persistent_cache_dir`` is set,
+    the partitioned graphs are loaded from the on-disk cache instead of being
+    traced, and saved to it after a miss. :attr:`out_spec` is the output spec
+    thunk of :attr:`flat_fn`, which is restored from the cache on a hit.
+
+    With ``config.rewrite_fusion_patterns``, the joint graph is rewritten by
+    the registered fusion patterns (see :func:`apply_fusion_patterns`) before
+    it is partitioned.
+
+    With ``config.partition_reports``, or while profiling compilations, the
+    ``partition_report`` attribute of the returned function is the
+    :class:`PartitionReport` of its graphs once they are compiled.
     """
     if decompositions is None:
         decompositions = {}
     joint_forward_backward = create_joint_forward_backward(flat_fn)
+    persistent_cache = get_persistent_cache() if cache_key is not None else None
 
     compiled_fw = None
     compiled_bw = None
+    # An uncompiled copy of the backward graph, and its compiled versions for
+    # the stride layouts of the cotangents it was specialized for.
+    bw_module_for_layouts = None
+    compiled_bw_for_layout = {}
     num_outs = None
 
+    def compile_graphs(flat_tensor_args):
+        """
+        Traces, partitions and compiles :attr:`flat_fn` for the given inputs
+        (or loads it from the persistent cache), and returns the outputs of the
+        compiled forward on them.
+        """
+        with compile_phase("aot_compile"):
+            compile_fn, _ = trace_graphs(flat_tensor_args)
+            return compile_fn(run_forward=True)
+
+    def trace_graphs(flat_tensor_args):
+        """
+        Traces and partitions :attr:`flat_fn` for the given inputs, or loads
+        the partitioned graphs from the persistent cache. Tracing replaces
+        global state (e.g. the decompositions of make_fx) and consumes random
+        numbers, so it has to run on the calling thread, which gets its RNG
+        state back afterwards.
+
+        Returns a function ``compile(run_forward)`` that compiles the graphs,
+        and whether it can run on another thread. With ``run_forward``, it
+        returns the outputs of the compiled forward on the inputs. Otherwise
+        the forward only runs if the example inputs of the backward can't be
+        derived from the graph, in which case it consumes random numbers and
+        can't run on another thread.
+        """
+        nonlocal num_outs
+        cache_entry = None
+        if persistent_cache is not None:
+            with compile_phase("persistent_cache_load"):
+                cache_entry = persistent_cache.load(cache_key)
+        if cache_entry is not None:
+            try:
+                fw_module, bw_module = pickle.loads(cache_entry["graphs"])
+            except Exception:
+                # Entries that can't be loaded, e.g. written by another version, are misses
+                cache_entry = None
+        if cache_entry is not None:
+            num_outs = cache_entry["num_outs"]
+            if out_spec is not None:
+                out_spec.set(cache_entry["out_spec"])
+            bw_example_args = _example_inputs_from_meta(bw_module, _common_device(flat_tensor_args))
+            compile_fn = partial(
+                compile_partitioned, flat_tensor_args, fw_module, bw_module, cache_entry.get("partition_report"),
+                bw_example_args, compiled_graphs=(cache_entry["compiled_fw"], cache_entry["compiled_bw"]),
+            )
+            return compile_fn, bw_example_args is not None
+
+        # make_fx installs the decompositions globally, so only one thread
+        # can trace at a time.
+        with _tracing_lock, preserve_rng_state():
+            # Set input tensors that require grad to leaves
+            flat_tensor_args = pytree.tree_map(
+                lambda x: x.detach().requires_grad_(x.requires_grad)
+                if isinstance(x, Tensor) else x, flat_tensor_args
+            )
+            # The joint graph only needs the shapes and dtypes of the outputs
+            # to create the tangents, so avoid computing them if possible.
+            devices = {x.device for x in flat_tensor_args if isinstance(x, Tensor)}
+            with compile_phase("output_metadata") as phase, torch.set_grad_enabled(grad_state):
+                out = _outputs_from_meta(flat_fn, flat_tensor_args) if len(devices) == 1 else None
+                phase.metrics["meta"] = out is not None
+                if out is None:
+                    out = flat_fn(*flat_tensor_args)
+            out = pytree.tree_map(
+                lambda x: x.detach().contiguous() if isinstance(x, Tensor) else x, out
+            )
+
+            if isinstance(out, (list, tuple)):
+                num_outs = len(out)
+            else:
+                num_outs = 1
+
+            tracing_mode = config.tracing_mode
+            if tracing_mode == "meta":
+                joint_inputs = (flat_tensor_args, out)
+            else:
+                joint_inputs = (flat_tensor_args, _zeros_like_meta(out, next(iter(devices), None)))
+            aot_decompositions = {**aot_autograd_decompositions, **decompositions}
+            with torch.set_grad_enabled(grad_state):
+                with compile_phase("make_fx") as phase:
+                    try:
+                        fx_g = make_fx(joint_forward_backward, aot_decompositions, tracing_mode=tracing_mode)(
+                            *joint_inputs
+                        )
+                    except Exception as e:
+                        if tracing_mode == "real":
+                            raise
+                        warnings.warn(
+                            f"Tracing with tracing_mode='{tracing_mode}' failed ({e}), "
+                            "tracing with real tensors instead"
+                        )
+                        tracing_mode = "real"
+                        joint_inputs = (flat_tensor_args, _zeros_like_meta(out, next(iter(devices), None)))
+                        fx_g = make_fx(joint_forward_backward, aot_decompositions)(*joint_inputs)
+                    phase.metrics["tracing_mode"] = tracing_mode
+                    phase.graph = fx_g
+
+                if config.use_functionalize:
+                    # Functionalize the foward backward graph. First create a
+                    # fake fn to make functionalize happy
+                    def fake_fn(primals, tangents):
+                        return fx_g(primals, tangents)
+                    with compile_phase("functionalize", fx_g) as phase:
+                        fx_g = make_fx(functionalize(fake_fn), tracing_mode=tracing_mode)(*joint_inputs)
+                        phase.graph = fx_g
+
+                if config.rewrite_fusion_patterns:
+                    with compile_phase("fusion_patterns", fx_g) as phase:
+                        num_rewrites = apply_fusion_patterns(
+                            fx_g, device=next(iter(devices), None), tracing_mode=tracing_mode,
+                            decompositions=aot_decompositions,
+                        )
+                        phase.metrics["rewrites"] = num_rewrites
+                        if num_rewrites:
+                            # Trace the rewritten graph again for the tensor_meta of its new nodes
+                            rewritten_g = fx_g
+                            fx_g = make_fx(lambda primals, tangents: rewritten_g(primals, tangents),
+                                           tracing_mode=tracing_mode)(*joint_inputs)
+                        phase.graph = fx_g
+        with compile_phase("partition", fx_g) as phase:
+            fw_module, bw_module = partition_fn(fx_g, joint_inputs)
+            partition_report = None
+            if config.partition_reports or is_profiling_compiles():
+                partition_report = PartitionReport.from_modules(fw_module, bw_module, num_outs)
+            if is_profiling_compiles():
+                phase.graph = None
+                phase.metrics["fw_nodes"] = len(fw_module.graph.nodes)
+                phase.metrics["bw_nodes"] = len(bw_module.graph.nodes)
+                phase.metrics.update(partition_report.summary())
+        # print(fw_module.code, bw_module.code)
+
+        # Serialize the graphs before the compilers get to modify them.
+        serialized_graphs = None
+        if persistent_cache is not None:
+            try:
+                serialized_graphs = pickle.dumps((fw_module, bw_module))
+            except Exception:
+                pass
+
+        bw_example_args = _example_inputs_from_meta(bw_module, _common_device(flat_tensor_args))
+        compile_fn = partial(
+            compile_partitioned, flat_tensor_args, fw_module, bw_module, partition_report, bw_example_args,
+            serialized_graphs=serialized_graphs,
+        )
+        return compile_fn, bw_example_args is not None
+
+    def compile_partitioned(flat_tensor_args, fw_module, bw_module, partition_report, bw_example_args,
+                            run_forward=True, compiled_graphs=(None, None), serialized_graphs=None):
+        """
+        Compiles the partitioned graphs, unless :attr:`compiled_graphs` has
+        serialized versions of them, and saves them in the persistent cache
+        if :attr:`serialized_graphs` is given. :attr:`bw_example_args` are the
+        example inputs of the backward, or None to run the forward for them.
+        """
+        nonlocal compiled_fw, compiled_bw, bw_module_for_layouts
+
+        def compile_bw(bw_module, bw_args):
+            bw_module = _maybe_plan_memory(bw_module, bw_args, partition_report, "bw")
+            with compile_phase("bw_compiler", bw_module):
+                return bw_compiler(bw_module, bw_args)
+
+        if config.specialize_backward_strides and not _views_tangents(bw_module):
+            bw_module_for_layouts = copy.deepcopy(bw_module)
+        new_compiled_fw = deserialize_compiled(compiled_graphs[0])
+        new_compiled_bw = deserialize_compiled(compiled_graphs[1])
+        bw_future = None
+        if config.parallel_compile and new_compiled_bw is None and bw_example_args is not None:
+            bw_future = _get_parallel_compile_pool().submit(compile_bw, bw_module, bw_example_args)
+
+        fw_outs = None
+        try:
+            if new_compiled_fw is None:
+                fw_module = _maybe_plan_memory(fw_module, flat_tensor_args, partition_report, "fw")
+                with compile_phase("fw_compiler", fw_module):
+                    new_compiled_fw = fw_compiler(fw_module, flat_tensor_args)
+            if run_forward or (new_compiled_bw is None and bw_example_args is None):
+                fw_outs = normalize_as_list(_call_compiled(new_compiled_fw, list(flat_tensor_args)))
+        finally:
+            if bw_future is not None:
+                # Don't leave the backward compiling if the forward failed
+                concurrent.futures.wait([bw_future])
+
+        if bw_future is not None:
+            new_compiled_bw = bw_future.result()
+        elif new_compiled_bw is None:
+            if fw_outs is not None:
+                bw_example_args = fw_outs[num_outs:] + fw_outs[0:num_outs]
+            new_compiled_bw = compile_bw(bw_module, bw_example_args)
+        # Publish the forward last, it is what marks the function as compiled.
+        CompiledFunction.partition_report = partition_report
+        compiled_bw = new_compiled_bw
+        compiled_fw = new_compiled_fw
+
+        if serialized_graphs is not None:
+            with compile_phase("persistent_cache_save"):
+                persistent_cache.save(cache_key, {
+                    "graphs": serialized_graphs,
+                    "num_outs": num_outs,
+                    "out_spec": out_spec.spec if out_spec is not None else None,
+                    "compiled_fw": serialize_compiled(compiled_fw),
+                    "compiled_bw": serialize_compiled(compiled_bw),
+                    "partition_report": partition_report,
+                })
+        return fw_outs if run_forward else None
+
+    def call_bw_with_layout(saved_tensors, flat_args):
+        """
+        Calls the backward with non-contiguous cotangents. With
+        ``config.specialize_backward_strides``, the backward graph is
+        compiled for their stride layout. Otherwise, or if the graph views
+        the cotangents (which only works for the layout it was traced with),
+        the non-contiguous cotangents are copied.
+        """
+        if bw_module_for_layouts is not None:
+            layout = tuple(t.stride() for t in flat_args)
+            if layout not in compiled_bw_for_layout:
+                compiled_bw_for_layout[layout] = bw_compiler(
+                    copy.deepcopy(bw_module_for_layouts), [*saved_tensors, *flat_args]
+                )
+            return normalize_as_list(_call_compiled(compiled_bw_for_layout[layout], [*saved_tensors, *flat_args]))
+
+        contiguous_args = []
+        for t in flat_args:
+            if not t.is_contiguous():
+                _call_counts["cotangent_copies"] += 1
+                _call_counts["cotangent_copy_bytes"] += t.numel() * t.element_size()
+                t = t.contiguous()
+            contiguous_args.append(t)
+        return normalize_as_list(_call_compiled(compiled_bw, [*saved_tensors, *contiguous_args]))
+
     class CompiledFunction(torch.autograd.Function):
+        partition_report = None
+
+        @staticmethod
+        def trace(*flat_tensor_args) -> Callable[[], None]:
+            """
+            Traces and partitions the function for the given example inputs
+            on the calling thread, and returns a function that compiles it
+            without running it through autograd, e.g. on another thread. If
+            compiling has to run the forward, it is compiled right away
+            instead, with the RNG state restored afterwards.
+            """
+            if compiled_fw is not None:
+                return lambda: None
+            with compile_phase("aot_trace"):
+                compile_fn, thread_safe = trace_graphs(flat_tensor_args)
+
+            def compile():
+                with compile_phase("aot_compile"):
+                    compile_fn(run_forward=False)
+            if thread_safe:
+                return compile
+            with preserve_rng_state():
+                compile()
+            return lambda: None
+
         @staticmethod
         @disable_torchdynamo
         def forward(ctx, *flat_tensor_args):
-            nonlocal compiled_fw, compiled_bw, num_outs
             # Disable the JIT Autocast flag to prevent re-autocasting of jitted graph.
             # TODO - Remove when https://github.com/pytorch/functorch/pull/794 is fixed.
             old_jit_autocast_flag = torch._C._jit_set_autocast_mode(False)
             if compiled_fw is None:
-                with preserve_rng_state():
-                    # Set input tensors that require grad to leaves
-                    flat_tensor_args = pytree.tree_map(
-                        lambda x: x.detach().requires_grad_(x.requires_grad)
-                        if isinstance(x, Tensor) else x, flat_tensor_args
-                    )
-                    with torch.set_grad_enabled(grad_state):
-                        out = flat_fn(*flat_tensor_args)
-                    out = pytree.tree_map(
-                        lambda x: x.detach().contiguous() if isinstance(x, Tensor) else x, out
-                    )
-
-                    if isinstance(out, (list, tuple)):
-                        num_outs = len(out)
-                    else:
-                        num_outs = 1
-
-                    joint_inputs = (flat_tensor_args, out)
-                    aot_decompositions = {**aot_autograd_decompositions, **decompositions}
-                    with torch.set_grad_enabled(grad_state):
-                        fx_g = make_fx(joint_forward_backward, aot_decompositions)(
-                            *joint_inputs
-                        )
-
-                        if config.use_functionalize:
-                            # Functionalize the foward backward graph. First create a
-                            # fake fn to make functionalize happy
-                            def fake_fn(primals, tangents):
-                                return fx_g(primals, tangents)
-                            fx_g = make_fx(functionalize(fake_fn))(*joint_inputs)
-                fw_module, bw_module = partition_fn(fx_g, joint_inputs)
-                # print(fw_module.code, bw_module.code)
-
-                compiled_fw = fw_compiler(fw_module, flat_tensor_args)
-                fw_outs = normalize_as_list(compiled_fw(*flat_tensor_args))
-
-                bw_args = fw_outs[num_outs:] + fw_outs[0:num_outs]
-                compiled_bw = bw_compiler(bw_module, bw_args)
+                fw_outs = compile_graphs(flat_tensor_args)
             else:
-                fw_outs = normalize_as_list(compiled_fw(*flat_tensor_args))
+                fw_outs = normalize_as_list(_call_compiled(compiled_fw, list(flat_tensor_args)))
             torch._C._jit_set_autocast_mode(old_jit_autocast_flag)
             ctx.save_for_backward(*fw_outs[num_outs:])
             return tuple(fw_outs[0:num_outs])
@@ -216,9 +570,16 @@ def create_aot_autograd_function(
             # Disable the JIT Autocast flag to prevent re-autocasting of jitted graph.
             # TODO - Remove when https://github.com/pytorch/functorch/pull/794 is fixed.
             old_jit_autocast_flag = torch._C._jit_set_autocast_mode(False)
-            contiguous_args = [t.contiguous() for t in flat_args]
-            # contiguous_args = [t for t in flat_args]
-            out = normalize_as_list(compiled_bw(*ctx.saved_tensors, *contiguous_args))
+            # The backward is compiled for contiguous cotangents
+            if all(t.is_contiguous() for t in flat_args):
+                bw_args = [*ctx.saved_tensors, *flat_args]
+                if getattr(compiled_bw, "_boxed_call", False):
+                    # Let the boxed backward free each saved tensor after its
+                    # last use. This is a no-op when the graph is retained.
+                    ctx.maybe_clear_saved_tensors()
+                out = normalize_as_list(_call_compiled(compiled_bw, bw_args))
+            else:
+                out = call_bw_with_layout(ctx.saved_tensors, flat_args)
             torch._C._jit_set_autocast_mode(old_jit_autocast_flag)
             return tuple(out)
 
@@ -239,6 +600,144 @@ except ImportError:
 compile_cache = None
 
 
+_tracing_lock = threading.Lock()
+_async_compile_pool = None
+_parallel_compile_pool = None
+_pending_compiles = set()
+_call_counts = {
+    "eager_calls": 0,
+    "compiled_calls": 0,
+    "cotangent_copies": 0,
+    "cotangent_copy_bytes": 0,
+}
+
+
+def _get_async_compile_pool():
+    global _async_compile_pool
+    if _async_compile_pool is None:
+        _async_compile_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.async_compile_workers, thread_name_prefix="aot_compile"
+        )
+    return _async_compile_pool
+
+
+def _get_parallel_compile_pool():
+    global _parallel_compile_pool
+    if _parallel_compile_pool is None:
+        _parallel_compile_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.parallel_compile_workers, thread_name_prefix="aot_bw_compile"
+        )
+    return _parallel_compile_pool
+
+
+class AsyncCompiledFunction(object):
+    """
+    Stands in for a ``CompiledFunction`` while it is being compiled in the
+    background. The function is traced on the calling thread, and only
+    compiled on a worker. Calls are served by :attr:`eager_fn` until the
+    compilation finishes, and by the compiled function afterwards. If tracing
+    or compiling fails, a warning is issued and :attr:`eager_fn` keeps
+    serving the calls.
+    """
+    def __init__(self, compiled_function, eager_fn, flat_tensor_args):
+        self.compiled_function = compiled_function
+        self.eager_fn = eager_fn
+        self.compiled_fn = None
+        self.failed = False
+        # Compile with copies of the inputs, the caller is free to update the
+        # originals in place (e.g. in an optimizer step) in the meantime.
+        example_args = [
+            x.detach().clone().requires_grad_(x.requires_grad) if isinstance(x, Tensor) else x
+            for x in flat_tensor_args
+        ]
+        self.future = concurrent.futures.Future()
+        try:
+            compile_fn = compiled_function.trace(*example_args)
+        except Exception as e:
+            self.future.set_exception(e)
+        else:
+            self.future = _get_async_compile_pool().submit(compile_fn)
+            _pending_compiles.add(self.future)
+            self.future.add_done_callback(_pending_compiles.discard)
+
+    def __call__(self, *flat_tensor_args):
+        if self.compiled_fn is None:
+            if not self.future.done() or self.failed:
+                _call_counts["eager_calls"] += 1
+                return tuple(self.eager_fn(*flat_tensor_args))
+            error = self.future.exception()
+            if error is not None:
+                warnings.warn(f"Background compilation failed ({error!r}), running eagerly instead")
+                self.failed = True
+                return self(*flat_tensor_args)
+            self.compiled_fn = self.compiled_function.apply
+        _call_counts["compiled_calls"] += 1
+        return self.compiled_fn(*flat_tensor_args)
+
+
+class TensorSpec(object):
+    """
+    Describes a tensor argument of a signature passed to the ``warmup`` method
+    of :func:`aot_function`. :attr:`stride` defaults to contiguous strides.
+    """
+    def __init__(
+        self,
+        shape: Tuple[int, ...],
+        dtype: torch.dtype = torch.float32,
+        stride: Optional[Tuple[int, ...]] = None,
+        requires_grad: bool = False,
+        device: Union[str, torch.device] = "cpu",
+    ):
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.stride = tuple(stride) if stride is not None else None
+        self.requires_grad = requires_grad
+        self.device = torch.device(device)
+
+    def __repr__(self):
+        return (
+            f"TensorSpec(shape={self.shape}, dtype={self.dtype}, stride={self.stride}, "
+            f"requires_grad={self.requires_grad}, device='{self.device}')"
+        )
+
+
+class CallSpec(object):
+    """
+    Describes the positional and keyword args of a signature passed to the
+    ``warmup`` method of :func:`aot_function`, for signatures that need
+    keyword args. Tensors can be described by :class:`TensorSpec` objects.
+    """
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+    def __eq__(self, other):
+        return isinstance(other, CallSpec) and (self.args, self.kwargs) == (other.args, other.kwargs)
+
+    def __repr__(self):
+        args = [repr(a) for a in self.args] + [f"{k}={v!r}" for k, v in self.kwargs.items()]
+        return f"CallSpec({', '.join(args)})"
+
+
+def _materialize_tensor_spec(x, generator):
+    """
+    Replaces a :class:`TensorSpec` with a tensor of random values drawn from
+    :attr:`generator`. Zeros would hide data-dependent behavior from the
+    trace, e.g. masks that are all False or divisions by zero.
+    """
+    if not isinstance(x, TensorSpec):
+        return x
+    if x.dtype == torch.bool:
+        values = torch.randint(0, 2, x.shape, generator=generator).bool()
+    elif x.dtype.is_floating_point or x.dtype.is_complex:
+        values = torch.randn(x.shape, generator=generator).to(x.dtype)
+    else:
+        values = torch.randint(1, 8, x.shape, generator=generator).to(x.dtype)
+    stride = x.stride if x.stride is not None else values.stride()
+    t = torch.empty_strided(x.shape, stride, dtype=x.dtype, device=x.device).copy_(values)
+    return t.requires_grad_(x.requires_grad)
+
+
 # Inspired by autodidax (thanks!)
 class PytreeThunk:
     spec = None
@@ -279,7 +778,7 @@ def filter_tensor_and_static_args(args, static_argnums):
             tensor_args.append(arg)
         else:
             static_args.append(arg)
-            static_args_hashed.append(arg.__hash__())
+            static_args_hashed.append(hash(arg))
     return tensor_args, static_args, static_args_hashed
 
 
@@ -312,6 +811,171 @@ def rearrange(tensor_args, static_args, static_argnums):
     return args
 
 
+def _bucket_size(size: int, buckets: Optional[List[int]]) -> int:
+    """
+    Returns the bucket that a dimension of size :attr:`size` is padded to: the
+    smallest bucket that fits it, or the next power of two if no buckets are
+    given. Sizes larger than every bucket are not padded.
+    """
+    if buckets is None:
+        return 1 << (size - 1).bit_length() if size > 0 else size
+    for bucket in buckets:
+        if bucket >= size:
+            return bucket
+    return size
+
+
+def _bucket_arg_names(fn) -> Dict[int, str]:
+    """Maps the positions of the arguments of :attr:`fn` that can be passed by keyword to their names."""
+    try:
+        parameters = inspect.signature(fn).parameters.values()
+    except (TypeError, ValueError):
+        return {}
+    names = {}
+    for idx, param in enumerate(parameters):
+        if param.kind == inspect.Parameter.VAR_POSITIONAL:
+            break
+        if param.kind == inspect.Parameter.POSITIONAL_OR_KEYWORD:
+            names[idx] = param.name
+    return names
+
+
+def _map_bucketed(args, kwargs, bucket_dims: Dict[int, int], arg_names: Dict[int, str], f):
+    """
+    Returns :attr:`args` and :attr:`kwargs` with every tensor ``x`` in the
+    arguments of :attr:`bucket_dims`, passed by position or by keyword,
+    replaced by ``f(x, dim)``.
+    """
+    args = list(args)
+    kwargs = dict(kwargs)
+    for idx, dim in bucket_dims.items():
+        def apply(x, dim=dim):
+            return f(x, dim) if isinstance(x, Tensor) else x
+
+        if idx < len(args):
+            args[idx] = pytree.tree_map(apply, args[idx])
+        elif arg_names.get(idx) in kwargs:
+            kwargs[arg_names[idx]] = pytree.tree_map(apply, kwargs[arg_names[idx]])
+    return tuple(args), kwargs
+
+
+def _pad(x, dim: int, size: int, padded_size: int, zeros: bool = True):
+    """
+    Pads the first :attr:`size` entries of :attr:`x` along :attr:`dim` to
+    :attr:`padded_size`, with zeros or, if not :attr:`zeros`, with values that
+    are neither zero nor constant.
+    """
+    x = x.narrow(dim, 0, size)
+    pad_shape = list(x.shape)
+    pad_shape[dim] = padded_size - size
+    if zeros:
+        padding = x.new_zeros(pad_shape)
+    else:
+        numel = 1
+        for s in pad_shape:
+            numel *= s
+        padding = (torch.arange(numel, device=x.device) % 7 + 1).reshape(pad_shape).to(x.dtype)
+    return torch.cat([x, padding], dim=dim)
+
+
+def pad_to_buckets(args, kwargs, bucket_dims: Dict[int, int], buckets: Optional[List[int]],
+                   arg_names: Optional[Dict[int, str]] = None):
+    """
+    Zero-pads the dimensions :attr:`bucket_dims` (positional arg index to
+    dimension) of every tensor in the corresponding args up to the bucket size.
+    Args passed by keyword are found through :attr:`arg_names`. All of these
+    dimensions must have the same size.
+
+    Returns the padded args and kwargs, the original size and the padded size.
+    """
+    arg_names = arg_names or {}
+    sizes = set()
+
+    def record(x, dim):
+        sizes.add(x.shape[dim])
+        return x
+
+    _map_bucketed(args, kwargs, bucket_dims, arg_names, record)
+    if len(sizes) == 0:
+        return args, kwargs, None, None
+    if len(sizes) > 1:
+        raise RuntimeError(
+            "BucketedShapeHasher expects the bucketed dimensions to have the same "
+            f"size, but found sizes {sorted(sizes)}"
+        )
+    size = sizes.pop()
+    padded_size = _bucket_size(size, buckets)
+    if padded_size == size:
+        return args, kwargs, size, padded_size
+    args, kwargs = _map_bucketed(
+        args, kwargs, bucket_dims, arg_names, lambda x, dim: _pad(x, dim, size, padded_size)
+    )
+    return args, kwargs, size, padded_size
+
+
+def bucketed_output_dims(fn, args, kwargs, bucket_dims: Dict[int, int], arg_names: Dict[int, str],
+                         size: int, padded_size: int) -> List[Tuple[int, ...]]:
+    """
+    Finds the dimensions of the outputs of :attr:`fn` that follow the
+    bucketed dimension, by running :attr:`fn` eagerly on :attr:`args` and
+    :attr:`kwargs`, which are zero-padded from :attr:`size` to
+    :attr:`padded_size`, and on the same args padded to one more entry with
+    other values. Returns the dimensions for each leaf of the outputs.
+
+    Raises a RuntimeError if the entries of the outputs that correspond to
+    the original entries depend on the padding, e.g. because :attr:`fn`
+    reduces over the bucketed dimension.
+    """
+    other_args, other_kwargs = _map_bucketed(
+        args, kwargs, bucket_dims, arg_names, lambda x, dim: _pad(x, dim, size, padded_size + 1, zeros=False)
+    )
+    with torch.no_grad():
+        with preserve_rng_state():
+            outs = pytree.tree_flatten(fn(*args, **kwargs))[0]
+        with preserve_rng_state():
+            other_outs = pytree.tree_flatten(fn(*other_args, **other_kwargs))[0]
+
+    def error(reason):
+        return RuntimeError(
+            f"BucketedShapeHasher can't be used with this function: {reason}. The entries along the bucketed "
+            "dimensions must be independent of each other, e.g. the function can't reduce over them."
+        )
+
+    out_dims = []
+    for out, other_out in zip(outs, other_outs):
+        if not isinstance(out, Tensor):
+            out_dims.append(())
+            continue
+        if out.dim() != other_out.dim():
+            raise error("the rank of an output depends on the bucketed size")
+        dims = tuple(d for d in range(out.dim()) if out.shape[d] != other_out.shape[d])
+        if any(out.shape[d] != padded_size or other_out.shape[d] != padded_size + 1 for d in dims):
+            raise error("an output dimension depends on the bucketed size but isn't bucketed")
+        for d in dims:
+            out = out.narrow(d, 0, size)
+            other_out = other_out.narrow(d, 0, size)
+        if out.is_floating_point() or out.is_complex():
+            same = torch.allclose(out, other_out, rtol=1e-4, atol=1e-5, equal_nan=True)
+        else:
+            same = torch.equal(out, other_out)
+        if not same:
+            raise error("an output depends on the padded entries")
+        out_dims.append(dims)
+    return out_dims
+
+
+def slice_from_buckets(out, out_dims: List[Tuple[int, ...]], size: int):
+    """
+    Narrows the dimensions :attr:`out_dims` (see :func:`bucketed_output_dims`)
+    of the leaves of :attr:`out` back to the original size.
+    """
+    flat_out, spec = pytree.tree_flatten(out)
+    for idx, dims in enumerate(out_dims):
+        for dim in dims:
+            flat_out[idx] = flat_out[idx].narrow(dim, 0, size)
+    return pytree.tree_unflatten(flat_out, spec)
+
+
 KNOWN_TYPES = [torch.Tensor, int, str, float, bool]
 
 
@@ -323,6 +987,8 @@ def aot_function(
     decompositions: Optional[Dict] = None,
     hasher_type: str = "StaticShapeHasher",
     static_argnums: Optional[Tuple[int]] = None,
+    bucket_dims: Optional[Dict[int, int]] = None,
+    buckets: Optional[List[int]] = None,
 ) -> Callable:
     """
     Traces the forward and backward graph of :attr:`fn` using torch dispatch
@@ -339,13 +1005,57 @@ def aot_function(
     :func:`aot_function` uses a compilation cache, based on input tensor
     properties, to detect when there is a need of recompilation. By default, its
     behavior is static, i.e., it recompiles if shape of any input tensor
-    changes.
+    changes. ``hasher_type="DynamicShapeHasher"`` only specializes on
+    contiguity and broadcasting, which requires a compiler that handles
+    arbitrary sizes.
+
+    ``hasher_type="BucketedShapeHasher"`` recompiles only when the dimensions
+    in :attr:`bucket_dims` grow past a bucket. These dimensions are
+    zero-padded up to the bucket size before calling the compiled function.
+    The first time a padded signature is seen, :attr:`fn` also runs eagerly
+    on the inputs padded with other values, to find the output dimensions
+    that follow the bucketed ones; these are sliced back to the original
+    size. :attr:`fn` must treat the entries along the bucketed dimensions
+    independently, e.g. the batch dimension of most layers. A RuntimeError is
+    raised if its outputs depend on the padding, e.g. if it reduces over a
+    bucketed dimension.
 
     :attr:`static_argnums` allows user to mark the arguments of the original
     :attr:`fn` as static. This is useful when an argument is a non-tensor, e.g.,
     ``int`` or ``bool``. A change in the actual value of static arg causes
     recompilation.
 
+    Setting ``functorch.compile.config.persistent_cache_dir`` (or the
+    ``FUNCTORCH_PERSISTENT_CACHE_DIR`` environment variable) additionally
+    enables an on-disk cache of the partitioned graphs, keyed on a fingerprint
+    of :attr:`fn`, the compilers, the partitioner, the decompositions and the
+    input properties. The fingerprint of :attr:`fn` includes the values it
+    reads from its closure and globals, such as captured tensors and module
+    weights; if one of them can't be fingerprinted, nothing is persisted. A
+    hit in a new process skips tracing and partitioning, and for TorchScript
+    compilers it skips compilation as well. Entries are unpickled, so the
+    directory must be trusted.
+
+    Setting ``functorch.compile.config.async_compile`` moves compilation off
+    the calling thread: on a cache miss, :attr:`fn` is traced on the calling
+    thread and runs eagerly while it is compiled in a background thread, and
+    the compiled version is used once it is ready. If compiling fails, a
+    warning is issued and :attr:`fn` keeps running eagerly. See
+    :func:`wait_for_async_compiles` and :func:`compile_cache_stats`.
+
+    With ``functorch.compile.config.parallel_compile``, the backward graph is
+    compiled in a worker thread while the forward graph is compiled and run,
+    so that the first call takes about as long as the longer of the two
+    compilations rather than their sum. The compilers must be thread-safe.
+
+    The returned function has a ``warmup(signatures, num_workers=1)`` method
+    that compiles it ahead of time for argument signatures built from
+    :class:`TensorSpec` descriptors, and reports the compile time of each.
+    With ``functorch.compile.config.partition_reports``, its
+    ``partition_reports()`` method returns a :class:`PartitionReport` per
+    compiled input signature, with the tensors saved for the backward and the
+    estimated peak memory of the forward and backward graphs.
+
     .. warning::
         This API is experimental and likely to change.
 
@@ -364,8 +1074,17 @@ def aot_function(
             backward graphs.
         decompositions (Dict): A dictionary to define the decomposition of
             larger Aten ops into simpler or core Aten ops.
+        hasher_type (str): ``"StaticShapeHasher"``, ``"DynamicShapeHasher"``
+            or ``"BucketedShapeHasher"``. Default: ``"StaticShapeHasher"``
         static_argnums (Optional[Tuple[Int]]): An option tuple of ints to mark
             the arguments of the function as static.
+        bucket_dims (Optional[Dict[int, int]]): For the
+            ``"BucketedShapeHasher"``, maps the index of a positional argument
+            to the dimension that is bucketed in every tensor of that
+            argument. The argument may also be passed by keyword.
+        buckets (Optional[List[int]]): For the ``"BucketedShapeHasher"``, the
+            sorted sizes that bucketed dimensions are padded to. Default: None
+            (pad to the next power of two)
 
     Returns:
         Returns a ``Callable`` that retains the eager behavior of the original
@@ -398,14 +1117,29 @@ def aot_function(
     global compile_cache
     if compile_cache is None:
         compile_cache = CompileCache()
+        compile_cache.set_capacity(
+            config.compile_cache_capacity or 0,
+            config.compile_cache_per_function_capacity or 0,
+        )
     if bw_compiler is None:
         bw_compiler = fw_compiler
-    cached_res = None
 
     fn_id = id(fn)
     fw_compiler_id = id(fw_compiler)
     bw_compiler_id = id(bw_compiler)
 
+    bucketed = hasher_type == "BucketedShapeHasher"
+    if bucketed:
+        if not bucket_dims:
+            raise ValueError("BucketedShapeHasher requires bucket_dims")
+        if buckets is not None:
+            buckets = sorted(buckets)
+        bucket_arg_names = _bucket_arg_names(fn)
+        # The output dimensions that follow the bucketed dimensions, by padded input shapes
+        bucket_out_dims = {}
+        # The padded inputs are specialized statically
+        hasher_type = "StaticShapeHasher"
+
     if isinstance(static_argnums, int):
         static_argnums = [static_argnums]
     elif static_argnums is not None and len(static_argnums) == 0:
@@ -413,16 +1147,30 @@ def aot_function(
     elif static_argnums is not None:
         static_argnums = list(static_argnums)
         static_argnums.sort()
+    static_argnums_for_cache = static_argnums if static_argnums is not None else []
+    # The CompiledFunction of every cache entry created, to get their reports
+    compiled_functions = []
 
-    @wraps(fn)
-    def returned_function(*args, **kwargs):
-        global compile_cache
-        nonlocal cached_res
+    def insert_cache_entry(cached_res, flat_tensor_args, flat_args_for_cache):
+        compile_cache.insert(
+            fn_id,
+            fw_compiler_id,
+            bw_compiler_id,
+            len(flat_tensor_args),
+            hasher_type,
+            cached_res,
+            *flat_args_for_cache,
+        )
 
+    def create_cache_entry(args, kwargs, flat_tensor_args, background=False):
+        """
+        Handles a miss of the C++ fast path. Returns the cache entry for the
+        args, the flattened tensor args, and, if the entry has to be created,
+        its ``CompiledFunction`` and the args to insert it into the cache with.
+        """
         # Separate out static args if static_argnums is present
         tensor_args = args
         static_args = []
-        # TODO - move the hashing part of static_args to C++.
         static_args_hashed = []
         if static_argnums is not None:
             (
@@ -431,100 +1179,292 @@ def aot_function(
                 static_args_hashed,
             ) = filter_tensor_and_static_args(args, static_argnums)
 
-        # Now flatten the tensor args
-        if HAS_TREE:
-            flat_tensor_args = tree.flatten((tensor_args, kwargs))
-        else:
-            flat_tensor_args, _ = pytree.tree_flatten((tensor_args, kwargs))
+        if flat_tensor_args is None:
+            # The args contain pytree nodes that the fast path can't flatten, so
+            # flatten the tensor args and check the cache here.
+            if HAS_TREE:
+                flat_tensor_args = tree.flatten((tensor_args, kwargs))
+            else:
+                flat_tensor_args, _ = pytree.tree_flatten((tensor_args, kwargs))
+
+            cached_res = compile_cache.at(
+                fn_id,
+                fw_compiler_id,
+                bw_compiler_id,
+                len(flat_tensor_args),
+                hasher_type,
+                *flat_tensor_args,
+                *static_args_hashed,
+            )
+            if cached_res is not None:
+                return cached_res, flat_tensor_args, None, None
 
-        # Check if the fn is already compiled
-        num_tensor_args = len(flat_tensor_args)
         flat_args_for_cache = flat_tensor_args + static_args_hashed
-        cached_res = compile_cache.at(
-            fn_id,
-            fw_compiler_id,
-            bw_compiler_id,
-            num_tensor_args,
-            hasher_type,
-            *flat_args_for_cache,
-        )
 
-        # Compile the function and save it in the cache
-        if cached_res is None:
-            # Save the args_spec for flat_tensor_args to unflatten while tracing
-            _, tensor_args_spec = pytree.tree_flatten((tensor_args, kwargs))
-            out_spec = PytreeThunk()
-
-            def flat_fn(*flat_tensor_args):
-                # The input are flattened tensor args. Prepare the args in the
-                # order that original function expects. Add static args as well.
-                # They will appear as tensor constants in the traced graph.
-                nonlocal out_spec, static_args
-
-                tensor_args, kwargs = pytree.tree_unflatten(
-                    flat_tensor_args, tensor_args_spec
-                )
-                if static_argnums is None:
-                    args = tensor_args
-                else:
-                    args = rearrange(tensor_args, static_args, static_argnums)
-                tree_out = fn(*args, **kwargs)
-                flat_out, spec = pytree.tree_flatten(tree_out)
-                for i in flat_out:
-                    is_known_type = False
-                    for j in KNOWN_TYPES:
-                        if isinstance(i, j):
-                            is_known_type = True
-                            break
-                    if not is_known_type:
-                        raise RuntimeError(
-                            f"Found {type(i)} in output, which is not a known type. "
-                            "If this type holds tensors, you need to register a pytree for it. "
-                            "See https://github.com/pytorch/functorch/issues/475 for a brief "
-                            "explanation why. If you don't need to register a pytree, please "
-                            "leave a comment explaining your use case and we'll make this more "
-                            "ergonomic to deal with"
-                        )
-                out_spec.set(spec)
-                return flat_out
+        # Save the args_spec for flat_tensor_args to unflatten while tracing
+        _, tensor_args_spec = pytree.tree_flatten((tensor_args, kwargs))
+        out_spec = PytreeThunk()
 
-            compiled_fn = create_aot_autograd_function(
-                flat_fn,
+        def flat_fn(*flat_tensor_args):
+            # The input are flattened tensor args. Prepare the args in the
+            # order that original function expects. Add static args as well.
+            # They will appear as tensor constants in the traced graph.
+            tensor_args, kwargs = pytree.tree_unflatten(
+                flat_tensor_args, tensor_args_spec
+            )
+            if static_argnums is None:
+                args = tensor_args
+            else:
+                args = rearrange(tensor_args, static_args, static_argnums)
+            tree_out = fn(*args, **kwargs)
+            flat_out, spec = pytree.tree_flatten(tree_out)
+            for i in flat_out:
+                is_known_type = False
+                for j in KNOWN_TYPES:
+                    if isinstance(i, j):
+                        is_known_type = True
+                        break
+                if not is_known_type:
+                    raise RuntimeError(
+                        f"Found {type(i)} in output, which is not a known type. "
+                        "If this type holds tensors, you need to register a pytree for it. "
+                        "See https://github.com/pytorch/functorch/issues/475 for a brief "
+                        "explanation why. If you don't need to register a pytree, please "
+                        "leave a comment explaining your use case and we'll make this more "
+                        "ergonomic to deal with"
+                    )
+            out_spec.set(spec)
+            return flat_out
+
+        grad_state = torch.is_grad_enabled()
+        cache_key = None
+        if config.persistent_cache_dir:
+            cache_key = compute_cache_key(
+                fn,
                 fw_compiler,
                 bw_compiler,
                 partition_fn,
                 decompositions,
-                grad_state=torch.is_grad_enabled(),
-            ).apply
-            cached_res = (compiled_fn, out_spec)
+                flat_tensor_args,
+                static_args,
+                grad_state,
+            )
 
-            # Save the compiled_fn in the cache
-            compile_cache.insert(
-                fn_id,
-                fw_compiler_id,
-                bw_compiler_id,
-                num_tensor_args,
-                hasher_type,
-                cached_res,
-                *flat_args_for_cache,
+        compiled_function = create_aot_autograd_function(
+            flat_fn,
+            fw_compiler,
+            bw_compiler,
+            partition_fn,
+            decompositions,
+            grad_state=grad_state,
+            cache_key=cache_key,
+            out_spec=out_spec,
+        )
+        compiled_functions[:] = [ref for ref in compiled_functions if ref() is not None]
+        compiled_functions.append(weakref.ref(compiled_function))
+        if background:
+            compiled_fn = AsyncCompiledFunction(compiled_function, flat_fn, flat_tensor_args)
+        else:
+            compiled_fn = compiled_function.apply
+        cached_res = (compiled_fn, out_spec)
+        return cached_res, flat_tensor_args, compiled_function, flat_args_for_cache
+
+    @wraps(fn)
+    def returned_function(*args, **kwargs):
+
+        if bucketed:
+            args, kwargs, size, padded_size = pad_to_buckets(args, kwargs, bucket_dims, buckets, bucket_arg_names)
+
+        # Fast path: separate out and hash the static args, flatten the tensor
+        # args and check if the fn is already compiled, all in one C++ call.
+        cached_res, flat_tensor_args = compile_cache.at_args(
+            fn_id,
+            fw_compiler_id,
+            bw_compiler_id,
+            hasher_type,
+            static_argnums_for_cache,
+            args,
+            kwargs,
+        )
+        if cached_res is None:
+            # Compile the function and save it in the cache
+            cached_res, flat_tensor_args, _, flat_args_for_cache = create_cache_entry(
+                args, kwargs, flat_tensor_args, background=config.async_compile
             )
+            if flat_args_for_cache is not None:
+                insert_cache_entry(cached_res, flat_tensor_args, flat_args_for_cache)
 
         cached_fn, out_spec = cached_res
-        out = cached_fn(*flat_tensor_args)
-        return out_spec.unflatten(out)
+        out = out_spec.unflatten(cached_fn(*flat_tensor_args))
+        if bucketed and size != padded_size:
+            shapes = tuple(
+                tuple(x.shape) for x in pytree.tree_flatten((args, kwargs))[0] if isinstance(x, Tensor)
+            )
+            if shapes not in bucket_out_dims:
+                bucket_out_dims[shapes] = bucketed_output_dims(
+                    fn, args, kwargs, bucket_dims, bucket_arg_names, size, padded_size
+                )
+            out = slice_from_buckets(out, bucket_out_dims[shapes], size)
+        return out
 
+    def warmup(signatures: List[Union[Tuple[Any, ...], CallSpec]], num_workers: int = 1) -> List[Dict[str, Any]]:
+        """
+        Compiles :attr:`fn` ahead of time for each of the :attr:`signatures`,
+        so that later calls with matching arguments hit the compilation
+        cache. A signature is a tuple of positional args, or a
+        :class:`CallSpec` with positional and keyword args, in which tensors
+        can be described by :class:`TensorSpec` objects. They are replaced
+        by tensors of random values, and the args are traced and compiled
+        with the current grad mode, as if :attr:`fn` were called with them.
+
+        The signatures are traced on the calling thread, but with
+        :attr:`num_workers` larger than one the forward and backward compilers
+        of different signatures run concurrently.
+
+        Returns a list with a dict per signature, with the ``signature``, the
+        ``compile_time`` in seconds, and whether it was already ``cached``.
+        """
+        entries = []
+        generator = torch.Generator().manual_seed(0)
+        # Tracing consumes random numbers, so restore the RNG state once it's done.
+        with preserve_rng_state():
+            for signature in signatures:
+                entries.append(trace_signature(signature, generator))
+
+        def compile_one(compile_fn, trace_time):
+            start = time.perf_counter()
+            compile_fn()
+            return trace_time + time.perf_counter() - start
+
+        report = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as pool:
+            futures = [
+                pool.submit(compile_one, compile_fn, trace_time) if compile_fn is not None else None
+                for _, _, _, compile_fn, trace_time, _ in entries
+            ]
+            for (signature, flat_tensor_args, cached_res, _, _, flat_args_for_cache), future in zip(entries, futures):
+                if future is None:
+                    report.append({"signature": signature, "compile_time": 0.0, "cached": True})
+                    continue
+                compile_time = future.result()
+                # Entries are only inserted once compiled, so that concurrent
+                # calls don't start compiling them as well.
+                insert_cache_entry(cached_res, flat_tensor_args, flat_args_for_cache)
+                report.append({"signature": signature, "compile_time": compile_time, "cached": False})
+        return report
+
+    def trace_signature(signature, generator):
+        """
+        Traces :attr:`fn` for a signature of ``warmup``, and returns its cache
+        entry with a function that compiles it, which is None if the entry
+        is cached already.
+        """
+        call_spec = signature if isinstance(signature, CallSpec) else CallSpec(*signature)
+        args, kwargs = pytree.tree_map(
+            lambda x: _materialize_tensor_spec(x, generator), (list(call_spec.args), call_spec.kwargs)
+        )
+        args = tuple(args)
+        if bucketed:
+            args, kwargs, _, _ = pad_to_buckets(args, kwargs, bucket_dims, buckets, bucket_arg_names)
+        cached_res, flat_tensor_args = compile_cache.at_args(
+            fn_id,
+            fw_compiler_id,
+            bw_compiler_id,
+            hasher_type,
+            static_argnums_for_cache,
+            args,
+            kwargs,
+        )
+        compiled_function = flat_args_for_cache = None
+        if cached_res is None:
+            cached_res, flat_tensor_args, compiled_function, flat_args_for_cache = create_cache_entry(
+                args, kwargs, flat_tensor_args
+            )
+        compile_fn = None
+        start = time.perf_counter()
+        if compiled_function is not None:
+            compile_fn = compiled_function.trace(*flat_tensor_args)
+        return signature, flat_tensor_args, cached_res, compile_fn, time.perf_counter() - start, flat_args_for_cache
+
+    def partition_reports() -> List[PartitionReport]:
+        """
+        Returns the :class:`PartitionReport` of each compiled version of
+        :attr:`fn` that is still alive, in the order they were compiled.
+        Reports are only built with ``config.partition_reports``, or while
+        profiling compilations.
+        """
+        compiled_functions[:] = [ref for ref in compiled_functions if ref() is not None]
+        reports = [getattr(ref(), "partition_report", None) for ref in compiled_functions]
+        return [report for report in reports if report is not None]
+
+    returned_function.warmup = warmup
+    returned_function.partition_reports = partition_reports
     return returned_function
 
 
 def num_of_recompilations():
     """
     Returns the numbers of recompilations since the last time cache was cleared.
-    This is equivalent to the number of entries in the compilation cache.
+    This is equivalent to the number of cache misses, which can be larger than
+    the number of entries in the compilation cache once entries get evicted.
     """
-    global compile_cache
     if compile_cache is None:
         return 0
-    return compile_cache.size()
+    return compile_cache.misses()
+
+
+def compile_cache_stats() -> Dict[str, int]:
+    """
+    Returns the counters of the compilation cache since the last time it was
+    cleared: the number of ``hits``, ``misses`` (i.e. compilations) and
+    ``evictions``, and the current number of entries as ``size``. With
+    ``config.async_compile``, ``eager_calls`` and ``compiled_calls`` count the
+    calls that were served eagerly while compiling and by compiled functions.
+    ``cotangent_copies`` and ``cotangent_copy_bytes`` count the
+    non-contiguous cotangents that were copied before calling a backward.
+    """
+    stats = {"hits": 0, "misses": 0, "evictions": 0, "size": 0}
+    if compile_cache is not None:
+        stats = {
+            "hits": compile_cache.hits(),
+            "misses": compile_cache.misses(),
+            "evictions": compile_cache.evictions(),
+            "size": compile_cache.size(),
+        }
+    stats.update(_call_counts)
+    return stats
+
+
+def wait_for_async_compiles(timeout: Optional[float] = None) -> bool:
+    """
+    Blocks until the background compilations started with
+    ``config.async_compile`` have finished, or :attr:`timeout` seconds have
+    passed. Returns True if no compilation is pending anymore.
+    """
+    _, not_done = concurrent.futures.wait(list(_pending_compiles), timeout=timeout)
+    return len(not_done) == 0
+
+
+def set_compile_cache_capacity(
+    capacity: Optional[int] = None, per_function_capacity: Optional[int] = None
+):
+    """
+    Bounds the number of compiled functions kept in the compilation cache.
+    Once a bound is reached, inserting a new entry evicts the least recently
+    used one, and an evicted entry is recompiled if it is needed again.
+
+    Args:
+        capacity (Optional[int]): Maximum number of entries across all
+            functions. Default: None (unbounded)
+        per_function_capacity (Optional[int]): Maximum number of entries, i.e.
+            input specializations, per compiled function. The least recently
+            used entry of the same function is evicted. Default: None
+            (unbounded)
+    """
+    config.compile_cache_capacity = capacity
+    config.compile_cache_per_function_capacity = per_function_capacity
+    if compile_cache is not None:
+        compile_cache.set_capacity(capacity or 0, per_function_capacity or 0)
 
 
 def clear_compile_cache():
@@ -535,9 +1475,137 @@ def clear_compile_cache():
     if compile_cache is not None:
         compile_cache.clear()
         compile_cache = None
+    for name in _call_counts:
+        _call_counts[name] = 0
+
+
+def _attribute_key(value):
+    """A hashable key of an attribute of a module, equal for equivalent values."""
+    if value is None or isinstance(value, (bool, int, float, complex, str, torch.dtype, torch.device)):
+        return (type(value), repr(value))
+    if isinstance(value, (list, tuple)):
+        return (type(value),) + tuple(_attribute_key(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return (type(value),) + tuple(sorted(repr(_attribute_key(v)) for v in value))
+    if isinstance(value, dict):
+        return (type(value),) + tuple((repr(k), _attribute_key(v)) for k, v in value.items())
+    # Anything else, e.g. a hook or a tensor attribute, is only equal to itself
+    return ("id", id(value))
+
+
+def _module_structure(mod: nn.Module):
+    """
+    Returns a hashable key of everything that the forward of :attr:`mod` may
+    depend on, except for the values of its parameters and buffers: the types
+    and attributes of its submodules, and the names, shapes, strides, dtypes,
+    devices and ``requires_grad`` of its parameters and buffers.
+    """
+    key = []
+    for name, m in mod.named_modules(remove_duplicate=False):
+        attributes = tuple(
+            (k, _attribute_key(v)) for k, v in sorted(vars(m).items())
+            if k not in ("_parameters", "_buffers", "_modules")
+        )
+        tensors = tuple(
+            (k, None) if t is None else (k, tuple(t.shape), t.stride(), t.dtype, t.device, t.requires_grad)
+            for k, t in list(m._parameters.items()) + list(m._buffers.items())
+        )
+        key.append((name, type(m), attributes, tensors))
+    return tuple(key)
+
+
+def _functional_call_signature(mod: nn.Module) -> Optional[inspect.Signature]:
+    """
+    Returns the signature of a functional call of :attr:`mod`, which takes
+    its parameters and buffers before the arguments of its forward, so that
+    ``bucket_dims`` can find the arguments passed by keyword.
+    """
+    try:
+        forward_params = list(inspect.signature(mod.forward).parameters.values())
+        lifted = [inspect.Parameter(name, inspect.Parameter.POSITIONAL_ONLY) for name in ("params", "buffers")]
+        return inspect.Signature(lifted + forward_params)
+    except (TypeError, ValueError):
+        return None
+
+
+def _has_hooks(mod: nn.Module) -> bool:
+    return bool(mod._forward_hooks or mod._forward_pre_hooks or mod._backward_hooks)
+
+
+def _repeated_submodules(mod: nn.Module) -> List[List[nn.Module]]:
+    """
+    Returns the groups of structurally identical submodules of :attr:`mod`,
+    e.g. the layers of a transformer. No module of a group is inside a module
+    of another group, and each group has at least two modules. Modules with
+    forward or backward hooks are never grouped.
+    """
+    structure = {m: _module_structure(m) for m in mod.modules() if m is not mod}
+    num_instances = collections.Counter(structure.values())
+    # Structures whose instances outside of other groups turned out to be unique
+    ungrouped = set()
+    while True:
+        groups = {}
+        seen = set()
+
+        def visit(m):
+            for child in m._modules.values():
+                if child is None or child in seen:
+                    continue
+                seen.add(child)
+                key = structure[child]
+                if num_instances[key] > 1 and key not in ungrouped and not _has_hooks(child):
+                    groups.setdefault(key, []).append(child)
+                else:
+                    visit(child)
+
+        visit(mod)
+        singletons = {key for key, group in groups.items() if len(group) < 2}
+        if not singletons:
+            return list(groups.values())
+        ungrouped |= singletons
+
+
+def _replace_submodules(mod: nn.Module, replacements: Dict[nn.Module, nn.Module], memo: Dict[nn.Module, nn.Module]):
+    """
+    Returns :attr:`mod` with the submodules in :attr:`replacements` replaced.
+    The modules on the paths to them are shallow copies, which share their
+    parameters, buffers and other attributes with the originals.
+    """
+    if mod in replacements:
+        return replacements[mod]
+    if mod not in memo:
+        children = collections.OrderedDict(
+            (name, None if child is None else _replace_submodules(child, replacements, memo))
+            for name, child in mod._modules.items()
+        )
+        if all(children[name] is child for name, child in mod._modules.items()):
+            memo[mod] = mod
+        else:
+            memo[mod] = copy.copy(mod)
+            memo[mod]._modules = children
+    return memo[mod]
 
 
-def aot_module(mod: nn.Module, *args, **kwargs) -> nn.Module:
+class _RepeatedSubmodule(nn.Module):
+    """
+    Calls the function compiled for a group of structurally identical
+    submodules with the parameters and buffers of :attr:`submodule`.
+    """
+    def __init__(self, submodule: nn.Module, compiled_f: Callable):
+        super(_RepeatedSubmodule, self).__init__()
+        self.submodule = submodule
+        self.compiled_f = compiled_f
+
+    def forward(self, *args, **kwargs):
+        return self.compiled_f(
+            dict(_named_parameters(self.submodule, remove_duplicate=False)),
+            dict(_named_buffers(self.submodule, remove_duplicate=False)),
+            *args,
+            **kwargs,
+        )
+
+
+def aot_module(mod: nn.Module, *args, deduplicate_layers: bool = False, **kwargs) -> nn.Module:
     """
     Traces the forward and backward graph of :attr:`mod` using torch dispatch
     tracing mechanism. It is wrapper function, that underneath uses
@@ -546,12 +1614,26 @@ def aot_module(mod: nn.Module, *args, **kwargs) -> nn.Module:
     :func:`aot_module` lifts the parameters and buffers of ``nn.Module`` as inputs
     to a new callable which is then compiled through :func:`aot_function`.
 
+    With :attr:`deduplicate_layers`, the submodules of :attr:`mod` that are
+    structurally identical, i.e. of the same types, with the same attributes
+    and with parameters and buffers of the same shapes, are compiled instead
+    of :attr:`mod` as a whole. The identical submodules share one compiled
+    function, which takes the parameters and buffers of each of them as
+    inputs, so that e.g. the layers of a transformer are traced, partitioned
+    and compiled once, whatever their number. The rest of :attr:`mod` runs
+    eagerly, and :attr:`mod` itself is not modified. Submodules with forward
+    or backward hooks are not compiled. Dimensions in ``bucket_dims`` then
+    refer to the arguments of the submodules. Without repeated submodules,
+    :attr:`mod` is compiled as a whole.
+
     .. warning::
         This API is experimental and likely to change.
 
     Args:
         mod (Callable): A ``nn.Module`` module.
         args : args to be passed to :func:`aot_function`
+        deduplicate_layers (bool): Whether to compile structurally identical
+            submodules once, instead of :attr:`mod` as a whole.
         kwargs : kwargs to be passed to :func:`aot_function`
 
     Returns:
@@ -560,10 +1642,21 @@ def aot_module(mod: nn.Module, *args, **kwargs) -> nn.Module:
 
     """
 
+    # The parameters and buffers are passed as the first two arguments
+    if kwargs.get("bucket_dims") is not None:
+        kwargs["bucket_dims"] = {idx + 2: dim for idx, dim in kwargs["bucket_dims"].items()}
+
+    groups = _repeated_submodules(mod) if deduplicate_layers else []
+    if groups:
+        return _aot_module_deduplicated(mod, groups, *args, **kwargs)
+
     def functional_call(named_params, named_buffers, *args, **kwargs):
         params_and_buffers = {**named_params, **named_buffers}
         return _stateless.functional_call(mod, params_and_buffers, args, kwargs)
 
+    # The weights of mod are inputs, so the persistent cache ignores their values
+    functional_call._aot_lifted_modules = (mod,)
+    functional_call.__signature__ = _functional_call_signature(mod)
     compiled_f = aot_function(functional_call, *args, **kwargs)
 
     class AOTModule(nn.Module):
@@ -579,6 +1672,43 @@ def aot_module(mod: nn.Module, *args, **kwargs) -> nn.Module:
                 **kwargs,
             )
 
+        def partition_reports(self) -> List[PartitionReport]:
+            return compiled_f.partition_reports()
+
+    return AOTModule()
+
+
+def _aot_module_deduplicated(mod: nn.Module, groups: List[List[nn.Module]], *args, **kwargs) -> nn.Module:
+    compiled_fns = []
+    replacements = {}
+    for group in groups:
+        template = group[0]
+
+        def functional_call(named_params, named_buffers, *args, template=template, **kwargs):
+            params_and_buffers = {**named_params, **named_buffers}
+            return _stateless.functional_call(template, params_and_buffers, args, kwargs)
+
+        functional_call._aot_lifted_modules = (template,)
+        functional_call.__signature__ = _functional_call_signature(template)
+        compiled_f = aot_function(functional_call, *args, **kwargs)
+        compiled_fns.append(compiled_f)
+        for submodule in group:
+            replacements[submodule] = _RepeatedSubmodule(submodule, compiled_f)
+    # A copy of mod that calls the compiled functions instead of the repeated
+    # submodules, so that mod itself is left untouched
+    deduplicated = _replace_submodules(mod, replacements, {})
+
+    class AOTModule(nn.Module):
+        def __init__(self):
+            super(AOTModule, self).__init__()
+            self.orig_module = mod
+
+        def forward(self, *args, **kwargs):
+            return deduplicated(*args, **kwargs)
+
+        def partition_reports(self) -> List[PartitionReport]:
+            return [report for compiled_f in compiled_fns for report in compiled_f.partition_reports()]
+
     return AOTModule()
 
 
@@ -624,8 +1754,11 @@ def aot_module_simplified(mod: nn.Module, *top_args, **top_kwargs) -> nn.Module:
         decompositions: Optional[Dict] = None,
         hasher_type: str = "StaticShapeHasher",
         static_argnums: Optional[Tuple[int]] = None,
+        bucket_dims: Optional[Dict[int, int]] = None,
+        buckets: Optional[List[int]] = None,
     ) -> Callable:
         assert static_argnums is None
+        assert bucket_dims is None
         if bw_compiler is None:
             bw_compiler = fw_compiler
         compiled_fn = create_aot_autograd_function(
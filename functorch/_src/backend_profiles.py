@@ -0,0 +1,161 @@
+"""
+What the compilers of the partitioned graphs can fuse, for the
+rematerialization partitioners.
+
+Recomputing a value in the backward is cheap when the compiler of the
+backward fuses it into the kernel that uses it, so the partitioners only
+recompute the ops that the backend can fuse. A :class:`BackendProfile` lists
+these ops for a backend. :data:`nvfuser_profile` describes NVFuser, which
+:func:`ts_compile` uses on CUDA, :data:`nnc_profile` the TensorExpr kernels
+of :func:`tensorexpr_compile`, and :data:`tvm_profile` :func:`tvm_compile`.
+"""
+import math
+import operator
+from typing import Callable, Dict, Iterable, Optional
+
+import torch
+import torch.fx as fx
+
+from .compile_utils import get_aten_target
+
+aten = torch.ops.aten
+
+pointwise_ops = [aten.add, aten.sub, aten.div, aten.atan2, aten.mul, aten.max, aten.min, aten.pow, aten.remainder, aten.fmod, aten.__and__, aten.__or__, aten.__xor__, aten.__lshift__, aten.__rshift__, aten.eq, aten.ne, aten.ge, aten.gt, aten.le, aten.lt, aten.abs, aten.bitwise_not, aten.ceil, aten.floor, aten.frac, aten.neg, aten.relu, aten.round, aten.silu, aten.trunc, aten.log, aten.log10, aten.log1p, aten.log2, aten.lgamma, aten.exp, aten.expm1, aten.erf, aten.erfc, aten.cos, aten.acos, aten.cosh, aten.sin, aten.asin, aten.sinh, aten.tan, aten.atan, aten.tanh, aten.atanh, aten.sqrt, aten.rsqrt, aten.reciprocal, aten.sigmoid, aten.softplus, aten.threshold, aten.threshold_backward, aten.clamp, aten.where, aten.lerp, aten.addcmul, aten.gelu, aten.gelu_backward]  # noqa: E501
+misc_ops = [aten.to, aten.type_as, operator.getitem]
+
+reduction_ops = [aten.softmax, aten._softmax, aten._softmax_backward_data, aten.sum, aten.mean, aten._grad_sum_to_size, aten.sum_to_size, aten.amax]  # noqa: E501
+
+# not recomputed by default since these are kinda expensive/hard to fuse into
+# norm_ops = [aten.instance_norm, aten._batch_norm_impl_index, aten.native_batch_norm, aten.batch_norm, aten._batch_norm_impl_index_backward, aten.native_layer_norm, aten.layer_norm, aten.native_layer_norm_backward]  # noqa: E501
+
+# Not used by default since NVFuser can't fuse view ops
+# view_ops = [aten.expand, aten.clone, aten.transpose, aten.t, aten.view, aten._unsafe_view, aten.permute, aten.transpose, aten.t, aten._reshape_alias, aten.squeeze, aten.unsqueeze, aten.reshape, aten.cat, aten.slice, aten.split, aten.select, aten.repeat]  # noqa: E501
+
+# These are the view ops that NVFuser can fuse
+view_ops = [aten.squeeze, aten.unsqueeze]
+random_ops = [aten.native_dropout, aten.rand_like, aten.randn_like]
+compute_intensive_ops = [aten.mm, aten.convolution, aten.convolution_backward, aten.bmm, aten.addmm, aten.upsample_bilinear2d]  # noqa: E501
+unrecomputable_ops = random_ops + compute_intensive_ops
+
+recomputable_ops = set(
+    pointwise_ops
+    + misc_ops
+    + reduction_ops
+    + view_ops
+)
+fusible_ops = recomputable_ops | set(random_ops)
+
+# Ops that only move data, which loop-based code generators (NNC, TVM) fuse
+# by indexing their input
+injective_ops = [aten.expand, aten.transpose, aten.t, aten.view, aten._unsafe_view, aten.permute, aten._reshape_alias,
+                 aten.squeeze, aten.unsqueeze, aten.reshape, aten.cat, aten.slice, aten.select]
+
+
+class BackendProfile(object):
+    """
+    The ops that the compiler of the forward and backward graphs can fuse,
+    for :func:`min_cut_rematerialization_partition`,
+    :func:`memory_budget_partition` and :func:`activation_offload_partition`.
+
+    Only :attr:`recomputable_ops` are recomputed in the backward, and
+    :attr:`banned_ops` never are, even when a ``CostModel`` estimates them
+    to be cheap. A value is saved at its full size when one of its users
+    isn't fused with it, i.e. when they aren't both :attr:`fusible_ops`.
+    Recomputing a :attr:`reduction_ops` op is not allowed when its output is
+    more than 4x smaller than its inputs.
+
+    :attr:`op_costs` scales the estimated cost of recomputing the given ops,
+    e.g. ``{aten.exp: 4.0}`` for a backend where ``exp`` is 4x slower than a
+    load, or ``math.inf`` to never recompute it.
+
+    Derive a profile from a shipped one with :meth:`replace`, e.g.
+    ``nvfuser_profile.replace(op_costs={aten.erf: 4.0})``.
+
+    .. warning::
+        This API is experimental and likely to change.
+
+    Args:
+        name(str): The name of the backend.
+        fusible_ops(Iterable): Ops that the backend fuses with each other.
+        recomputable_ops(Iterable): Ops that are cheap to recompute.
+        banned_ops(Iterable): Ops that must not be recomputed.
+        reduction_ops(Iterable): Recomputable ops that reduce their input.
+        op_costs(Optional[Dict[Callable, float]]): Factors of the
+            recomputation cost of ops. Default: 1 for every op
+    """
+    def __init__(self, name: str, fusible_ops: Iterable, recomputable_ops: Iterable, banned_ops: Iterable,
+                 reduction_ops: Iterable = (), op_costs: Optional[Dict[Callable, float]] = None):
+        self.name = name
+        self.fusible_ops = frozenset(fusible_ops)
+        self.recomputable_ops = frozenset(recomputable_ops)
+        self.banned_ops = frozenset(banned_ops)
+        self.reduction_ops = frozenset(reduction_ops)
+        self.op_costs = dict(op_costs or {})
+
+    def __repr__(self):
+        return (
+            f"BackendProfile(name={self.name!r}, fusible_ops={len(self.fusible_ops)}, "
+            f"recomputable_ops={len(self.recomputable_ops)}, banned_ops={len(self.banned_ops)}, "
+            f"op_costs={len(self.op_costs)})"
+        )
+
+    def replace(self, **kwargs) -> "BackendProfile":
+        """Returns a copy of the profile with the given constructor arguments replaced."""
+        args = {
+            "name": self.name,
+            "fusible_ops": self.fusible_ops,
+            "recomputable_ops": self.recomputable_ops,
+            "banned_ops": self.banned_ops,
+            "reduction_ops": self.reduction_ops,
+            "op_costs": self.op_costs,
+        }
+        args.update(kwargs)
+        return BackendProfile(**args)
+
+    def is_fusible(self, node: fx.Node) -> bool:
+        return get_aten_target(node) in self.fusible_ops
+
+    def is_recomputable(self, node: fx.Node) -> bool:
+        return node.op == 'call_function' and get_aten_target(node) in self.recomputable_ops
+
+    def is_banned(self, node: fx.Node) -> bool:
+        if node.op != 'call_function':
+            return False
+        target = get_aten_target(node)
+        return target in self.banned_ops or self.op_costs.get(target, 1.0) == math.inf
+
+    def is_reduction(self, node: fx.Node) -> bool:
+        return get_aten_target(node) in self.reduction_ops
+
+    def cost_factor(self, node: fx.Node) -> float:
+        """The factor of the estimated cost of recomputing :attr:`node`."""
+        return self.op_costs.get(get_aten_target(node), 1.0)
+
+
+nvfuser_profile = BackendProfile(
+    "nvfuser",
+    fusible_ops=fusible_ops,
+    recomputable_ops=recomputable_ops,
+    banned_ops=random_ops,
+    reduction_ops=reduction_ops,
+)
+
+# The TensorExpr kernel generates loops for simple reductions and for data
+# movement, but not for random ops, which call back into ATen.
+nnc_reduction_ops = [aten.sum, aten.mean, aten.amax, aten.softmax, aten._softmax]
+nnc_profile = BackendProfile(
+    "nnc",
+    fusible_ops=pointwise_ops + misc_ops + injective_ops + nnc_reduction_ops,
+    recomputable_ops=pointwise_ops + misc_ops + injective_ops + nnc_reduction_ops,
+    banned_ops=random_ops,
+    reduction_ops=nnc_reduction_ops,
+)
+
+# Relay fuses injective ops and reductions into the elementwise ops around them
+tvm_profile = BackendProfile(
+    "tvm",
+    fusible_ops=pointwise_ops + misc_ops + injective_ops + reduction_ops,
+    recomputable_ops=pointwise_ops + misc_ops + injective_ops + reduction_ops,
+    banned_ops=random_ops,
+    reduction_ops=reduction_ops,
+)
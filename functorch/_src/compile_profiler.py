@@ -0,0 +1,180 @@
+"""
+Timings and graph sizes of the phases of AOT Autograd compilation.
+
+The compilation pipeline wraps each of its phases (tracing, functionalization,
+CSE, partitioning, the compilers, ...) in :func:`compile_phase`. Every
+finished phase is reported as a :class:`CompilePhaseEvent` to the callbacks
+registered with :func:`register_compile_callback`, and to the active
+:class:`CompileProfiler` objects. Nothing is measured while there are no
+listeners.
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+import torch.fx as fx
+
+_callbacks: List[Callable[["CompilePhaseEvent"], None]] = []
+
+
+def _num_nodes(graph) -> Optional[int]:
+    if isinstance(graph, fx.GraphModule):
+        graph = graph.graph
+    if isinstance(graph, fx.Graph):
+        return len(graph.nodes)
+    return None
+
+
+class CompilePhaseEvent(object):
+    """
+    A finished compilation phase. :attr:`start` and :attr:`duration` are in
+    seconds, :attr:`nodes_before` and :attr:`nodes_after` are the number of
+    nodes of the graph the phase transformed, or None. :attr:`metrics` holds
+    phase specific values, e.g. ``saved_bytes`` for the partitioner.
+    """
+    def __init__(self, name: str, graph=None):
+        self.name = name
+        self.nodes_before = _num_nodes(graph)
+        self.nodes_after = None
+        self.metrics: Dict[str, Any] = {}
+        self.thread_id = threading.get_ident()
+        self.graph = graph
+        self.start = time.perf_counter()
+        self.duration = 0.0
+
+    def __repr__(self):
+        return (
+            f"CompilePhaseEvent(name={self.name!r}, duration={self.duration:.6f}, "
+            f"nodes_before={self.nodes_before}, nodes_after={self.nodes_after}, metrics={self.metrics})"
+        )
+
+
+class _NullEvent(object):
+    """Stands in for an event while nobody listens, and ignores all updates."""
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        pass
+
+    @property
+    def metrics(self):
+        return {}
+
+
+_null_event = _NullEvent()
+
+
+@contextmanager
+def compile_phase(name: str, graph=None):
+    """
+    Measures the phase :attr:`name` of a compilation. :attr:`graph` is the
+    ``fx.Graph`` or ``fx.GraphModule`` that the phase transforms. Set the
+    ``graph`` attribute of the yielded event to the resulting graph if the
+    phase produces a new one, and add any metrics to its ``metrics``.
+    """
+    if not _callbacks:
+        yield _null_event
+        return
+    event = CompilePhaseEvent(name, graph)
+    try:
+        yield event
+    finally:
+        event.duration = time.perf_counter() - event.start
+        event.nodes_after = _num_nodes(event.graph)
+        event.graph = None
+        for callback in list(_callbacks):
+            callback(event)
+
+
+def is_profiling_compiles() -> bool:
+    """Returns True if the phases of compilations are being measured."""
+    return bool(_callbacks)
+
+
+def register_compile_callback(callback: Callable[[CompilePhaseEvent], None]):
+    """
+    Calls :attr:`callback` with a :class:`CompilePhaseEvent` whenever a phase
+    of a compilation finishes. Callbacks are invoked on the compiling thread.
+    """
+    _callbacks.append(callback)
+
+
+def remove_compile_callback(callback: Callable[[CompilePhaseEvent], None]):
+    _callbacks.remove(callback)
+
+
+class CompileProfiler(object):
+    """
+    Collects the phases of the compilations run while it is active.
+
+    Example::
+
+        >>> with CompileProfiler() as prof:
+        >>>     aot_fn(x)
+        >>> print(prof.summary())
+        >>> prof.export_chrome_trace("compile_trace.json")
+    """
+    def __init__(self):
+        self.events: List[CompilePhaseEvent] = []
+        self._lock = threading.Lock()
+
+    def _record(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def __enter__(self):
+        register_compile_callback(self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        remove_compile_callback(self._record)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Aggregates the events per phase: the number of ``calls``, the
+        ``total_time`` in seconds, the node counts of the last call, and the
+        sum of each numeric metric.
+        """
+        phases = defaultdict(lambda: {"calls": 0, "total_time": 0.0})
+        for event in self.events:
+            phase = phases[event.name]
+            phase["calls"] += 1
+            phase["total_time"] += event.duration
+            if event.nodes_before is not None:
+                phase["nodes_before"] = event.nodes_before
+            if event.nodes_after is not None:
+                phase["nodes_after"] = event.nodes_after
+            for k, v in event.metrics.items():
+                if isinstance(v, (int, float)):
+                    phase[k] = phase.get(k, 0) + v
+        return dict(phases)
+
+    def chrome_trace_events(self) -> List[Dict[str, Any]]:
+        pid = os.getpid()
+        trace_events = []
+        for event in self.events:
+            args = dict(event.metrics)
+            if event.nodes_before is not None:
+                args["nodes_before"] = event.nodes_before
+            if event.nodes_after is not None:
+                args["nodes_after"] = event.nodes_after
+            trace_events.append({
+                "name": event.name,
+                "cat": "aot_compile",
+                "ph": "X",
+                "ts": event.start * 1e6,
+                "dur": event.duration * 1e6,
+                "pid": pid,
+                "tid": event.thread_id,
+                "args": args,
+            })
+        return trace_events
+
+    def export_chrome_trace(self, path: str):
+        """Writes the events as a trace that chrome://tracing can open."""
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.chrome_trace_events()}, f)
@@ -1,7 +1,11 @@
 
+import copy
+import hashlib
+
 import torch
 import torch.fx as fx
-from torch.utils._pytree import tree_flatten
+
+from . import config
 
 aten = torch.ops.aten
 
@@ -18,51 +22,154 @@ rand_ops = [aten.dropout, aten._fused_dropout, aten._standard_gamma,
             aten.rand_like, aten.rand, aten.randint, aten.randn, aten.randperm]
 
 
-# return a new copy of torch.fx.graph.Graph with CSE applied to the input graph
+# Ops whose result doesn't depend on the order of their first two arguments
+commutative_ops = {aten.add.Tensor, aten.mul.Tensor, aten.maximum.default, aten.minimum.default,
+                   aten.eq.Tensor, aten.ne.Tensor, aten.logical_and.default, aten.logical_or.default,
+                   aten.logical_xor.default, aten.bitwise_and.Tensor, aten.bitwise_or.Tensor,
+                   aten.bitwise_xor.Tensor}
+
+# Constants computed by fx_graph_cse are stored in the module if they are at
+# most this large, or no larger than the constants they are computed from.
+MAX_FOLDED_CONSTANT_BYTES = 4096
+
+
+def _is_mutable(target):
+    return isinstance(target, torch._ops.OpOverload) and target._schema.is_mutable
+
+
+def _arg_key(arg, env):
+    """A hashable key of an argument of a node, with nodes replaced by their copy."""
+    if isinstance(arg, fx.Node):
+        return env[arg]
+    if isinstance(arg, (list, tuple)):
+        # Lists and tuples of the same elements are different arguments
+        return (type(arg),) + tuple(_arg_key(a, env) for a in arg)
+    if isinstance(arg, dict):
+        return (dict,) + tuple((k, _arg_key(v, env)) for k, v in arg.items())
+    if isinstance(arg, (bool, int, float)):
+        # 1, 1.0 and True are equal, but promote differently; -0.0 == 0.0
+        return (type(arg), repr(arg))
+    return arg
+
+
+def _get_attr(module, target):
+    for atom in target.split("."):
+        module = getattr(module, atom)
+    return module
+
+
+def _fold(node, constants):
+    """
+    Computes :attr:`node` if all its inputs are constants, and returns the
+    resulting tensor or None. :attr:`constants` maps the input nodes of
+    :attr:`node` that are constants to their value.
+    """
+    if (node.op != 'call_function' or not isinstance(node.target, torch._ops.OpOverload)
+            or get_aten_target(node) in rand_ops or node.target in _unfoldable_ops
+            or any(user.op == 'output' for user in node.users)):
+        return None
+    input_values = list(constants.values())
+    if any(value.is_meta for value in input_values):
+        return None
+    try:
+        with torch.no_grad():
+            result = node.target(*fx.node.map_arg(node.args, constants.get),
+                                 **fx.node.map_arg(node.kwargs, constants.get))
+    except Exception:
+        return None
+    if not isinstance(result, torch.Tensor) or result.is_meta:
+        return None
+    input_bytes = sum(value.numel() * value.element_size() for value in input_values)
+    if result.numel() * result.element_size() > max(MAX_FOLDED_CONSTANT_BYTES, input_bytes):
+        return None
+    return result
+
+
+def _is_constant_attr(target):
+    """
+    Whether the ``get_attr`` :attr:`target` is a tensor constant of
+    ``make_fx`` or a folded constant, rather than a parameter.
+    """
+    return target.startswith(("_tensor_constant", "_folded_constant"))
+
+
+# Factories of uninitialized memory, whose results are meant to be written to
+_unfoldable_ops = {aten.empty.memory_format, aten.empty_like.default, aten.empty_strided.default,
+                   aten.new_empty.default, aten.new_empty_strided.default}
+
+
 def fx_graph_cse(fx_g: torch.fx.graph.Graph):
+    """
+    Returns a copy of :attr:`fx_g` with common subexpressions eliminated: the
+    nodes that call the same function on the same arguments are replaced by
+    the first one. The arguments of commutative ops (see
+    :data:`commutative_ops`) are compared in any order. Random and in-place
+    ops are never eliminated.
+
+    With ``config.fold_constants``, ops whose inputs are all constants (the
+    tensor constants that ``make_fx`` records as ``_tensor_constant``
+    attributes, or nothing) are computed once and replaced by a constant
+    stored in the module that owns :attr:`fx_g`, if the graph has no in-place
+    ops and the constant is small (see :data:`MAX_FOLDED_CONSTANT_BYTES`).
+    ``make_fx`` records the buffers of modules as tensor constants as well,
+    so folding assumes that they aren't updated between calls.
+    """
     new_graph = fx.Graph()
     env = {}  # map from node in the old graph to node in the new graph
-    hash_env = {}  # map from hash to a node in the new graph
-    token_map = {}  # map from hash to token
+    hash_env = {}  # map from the key of a node to the node in the new graph that computes it
+
+    module = fx_g.owning_module
+    fold_constants = config.fold_constants and module is not None and not any(_is_mutable(n.target) for n in fx_g.nodes)
+    constants = {}  # map from a constant node in the new graph to its value
+    num_folded = 0
+    attr_names = set(dir(module)) if fold_constants else set()
+
     for n in fx_g.nodes:
         # The placeholder, output, and get_attr nodes are copied to the new grpah without change
         # do not CSE away random operations
-        if n.op == 'placeholder' or n.op == 'output' or n.op == 'get_attr' or get_aten_target(n) in rand_ops:
+        if (n.op == 'placeholder' or n.op == 'output' or n.op == 'get_attr' or get_aten_target(n) in rand_ops
+                or _is_mutable(n.target)):
             new_node = new_graph.node_copy(n, lambda x: env[x])
             env[n] = new_node
-        else:  # n.op == 'call_function', should never see n.op == 'call_module' or 'call_method'
-            # substitute args and kwargs memebrs to their mapping in env if exists
-            # specs can be used to reconstruct nested list/dictionaries
-            def substitute(arg_list):
-                arg_list, spec = tree_flatten(arg_list)
-                for i in range(len(arg_list)):
-                    v = arg_list[i]
-                    if isinstance(v, torch.fx.node.Node) and v in env:
-                        arg_list[i] = env[v]
-                return tuple(arg_list), spec
-            args, args_spec = substitute(n.args)
-            kwargs, kwargs_spec = substitute(n.kwargs)
-
-            # each token corresponds to a unique node
-            # nodes with the same token can be substituted
-            token = {"target": n.target, "args": args, "args_spec": args_spec,
-                     "kwargs": kwargs, "kwargs_spec": kwargs_spec}
-
-            # hash substituted args to a number, do not hash specs because specs are not hashable
-            hash_arg = hash((args, kwargs))
-            hash_val = (n.target, hash_arg)
-
-            # check if a node has a substitute and can be eliminated
-            hash_val_in_hash_env = hash_val in hash_env
-            if hash_val_in_hash_env and token_map[hash_val] == token:
-                env[n] = hash_env[hash_val]
-                continue
-
+            if n.op == 'get_attr' and fold_constants and _is_constant_attr(n.target):
+                value = _get_attr(module, n.target)
+                if isinstance(value, torch.Tensor) and not value.requires_grad:
+                    constants[new_node] = value
+            continue
+
+        # n.op == 'call_function', should never see n.op == 'call_module' or 'call_method'
+        args_key = _arg_key(n.args, env)
+        # add(a, b, alpha=2) is a + 2 * b, so only ops without kwargs are commutative
+        if (n.target in commutative_ops and len(n.args) == 2 and not n.kwargs
+                and all(isinstance(a, fx.Node) for a in n.args)):
+            args_key = (tuple,) + tuple(sorted(args_key[1:], key=id))
+        key = (n.target, args_key, _arg_key(n.kwargs, env))
+        try:
+            existing = hash_env.get(key)
+        except TypeError:  # unhashable arguments
+            key, existing = None, None
+        if existing is not None:
+            env[n] = existing
+            continue
+
+        value = None
+        if fold_constants and all(env[m] in constants for m in n.all_input_nodes):
+            value = _fold(n, {m: constants[env[m]] for m in n.all_input_nodes})
+        if value is not None:
+            name = f"_folded_constant{num_folded}"
+            while name in attr_names:
+                num_folded += 1
+                name = f"_folded_constant{num_folded}"
+            attr_names.add(name)
+            module.register_buffer(name, value, persistent=False)
+            new_node = new_graph.get_attr(name)
+            new_node.meta = copy.copy(n.meta)
+            constants[new_node] = value
+        else:
             new_node = new_graph.node_copy(n, lambda x: env[x])
-            env[n] = new_node
-            if not hash_val_in_hash_env:
-                hash_env[hash_val] = new_node
-                token_map[hash_val] = token
+        env[n] = new_node
+        if key is not None:
+            hash_env[key] = new_node
 
     return new_graph
 
@@ -78,3 +185,41 @@ def strip_overloads(gm):
         if isinstance(node.target, torch._ops.OpOverload):
             node.target = node.target.overloadpacket
     gm.recompile()
+
+
+def graph_hash(graph: fx.Graph, abstract_shapes: bool = False) -> str:
+    """
+    Returns a hex digest of the structure of :attr:`graph`: the op and target
+    of every node, the edges between the nodes and their constant arguments.
+    The shapes, strides and dtypes of the ``tensor_meta`` of the nodes are
+    included, unless :attr:`abstract_shapes` is True, in which case integer
+    arguments (sizes, dimensions, ...) are left out as well. Graphs traced
+    from the same function for different input shapes then hash the same.
+
+    Targets that are neither ops nor strings are hashed by their repr, so
+    digests are only meaningful within a process.
+    """
+    index = {}
+
+    def encode(arg):
+        if isinstance(arg, fx.Node):
+            return f"%{index[arg]}"
+        if isinstance(arg, (list, tuple)):
+            items = ",".join(encode(a) for a in arg)
+            return f"[{items}]" if isinstance(arg, list) else f"({items})"
+        if isinstance(arg, dict):
+            return "{" + ",".join(f"{k}:{encode(v)}" for k, v in arg.items()) + "}"
+        if abstract_shapes and isinstance(arg, int) and not isinstance(arg, bool):
+            return "int"
+        return repr(arg)
+
+    h = hashlib.sha256()
+    for idx, node in enumerate(graph.nodes):
+        index[node] = idx
+        line = f"{node.op} {node.target} {encode(node.args)} {encode(node.kwargs)}"
+        tensor_meta = node.meta.get("tensor_meta")
+        if not abstract_shapes and tensor_meta is not None and hasattr(tensor_meta, "shape"):
+            line += f" {tuple(tensor_meta.shape)} {tuple(tensor_meta.stride)} {tensor_meta.dtype}"
+        h.update(line.encode())
+        h.update(b"\n")
+    return h.hexdigest()
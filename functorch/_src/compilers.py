@@ -1,13 +1,22 @@
+import hashlib
+import threading
+import weakref
+
 import torch
 import torch.fx as fx
 import torch.nn as nn
 from functools import partial
-from typing import Callable, Iterable, Optional, Tuple, Union
+from typing import Callable, Dict, Iterable, Optional, Tuple, Union
 
 from .aot_autograd import aot_function, aot_module
 from .decompositions import get_decompositions
 from .partitioners import draw_graph, min_cut_rematerialization_partition
-from .compile_utils import strip_overloads
+from .compile_utils import graph_hash, strip_overloads
+from .compile_profiler import compile_phase
+from .memory_planner import ARENA_NAME_PREFIX
+from .persistent_cache import (
+    _IncompleteFingerprint, _update_fingerprint, deserialize_compiled, get_persistent_cache, serialize_compiled,
+)
 import time
 
 
@@ -21,19 +30,160 @@ def _canonicalize(fx_g):
     return fx_g
 
 
-def ts_compile(fx_g: fx.GraphModule, _) -> Callable:
+# Number of compiled graphs kept by ts_compile and tensorexpr_compile
+# Compiled graphs by the digest of their graph, for as long as something
+# else, e.g. the compilation cache of aot_function, holds on to them.
+_compiled_graph_cache: "weakref.WeakValueDictionary[str, Callable]" = weakref.WeakValueDictionary()
+_compiled_graph_cache_counts = {"hits": 0, "misses": 0}
+_compiled_graph_cache_lock = threading.Lock()
+
+
+_stable_target_types = (torch._ops.OpOverload, torch._ops.OpOverloadPacket)
+
+
+def _has_stable_targets(graph: fx.Graph) -> bool:
+    """
+    Whether the targets of the calls of :attr:`graph` are ops, builtins or
+    methods, which the digest of the graph describes the same way in every
+    process, unlike other functions, whose reprs contain their addresses,
+    and submodules, whose code it doesn't describe.
+    """
+    for node in graph.nodes:
+        if node.op == "call_module":
+            return False
+        if node.op != "call_function" or isinstance(node.target, _stable_target_types):
+            continue
+        if getattr(node.target, "__module__", None) not in ("_operator", "operator", "builtins", "math"):
+            return False
+    return True
+
+
+def _compiled_graph_key(compiler_name: str, fx_g: fx.GraphModule, example_inputs) -> Optional[str]:
+    """
+    Returns a digest of the code of :attr:`fx_g`, the metadata of its inputs
+    and the values of its constants, which identifies what :attr:`compiler_name`
+    compiles it to in any process. None if part of it can't be described,
+    or if :attr:`fx_g` has arenas of the memory planner, which compiled
+    graphs must not share.
+    """
+    if not _has_stable_targets(fx_g.graph):
+        return None
+    h = hashlib.sha256()
+    h.update(f"{compiler_name}:torch-{torch.__version__}:{graph_hash(fx_g.graph)}".encode())
+    for x in example_inputs or ():
+        if isinstance(x, torch.Tensor):
+            h.update(repr((tuple(x.shape), x.stride(), x.dtype, str(x.device), x.requires_grad)).encode())
+        else:
+            h.update(repr((type(x).__name__, x)).encode())
+    seen = set()
+    for node in fx_g.graph.nodes:
+        if node.op != "get_attr":
+            continue
+        if node.target.startswith(ARENA_NAME_PREFIX):
+            return None
+        value = fx_g
+        for atom in node.target.split("."):
+            value = getattr(value, atom)
+        if isinstance(value, torch.Tensor):
+            h.update(repr((node.target, str(value.device))).encode())
+        try:
+            _update_fingerprint(h, value, seen, strict=True)
+        except _IncompleteFingerprint:
+            return None
+    return h.hexdigest()
+
+
+def _cached_compile(compiler_name: str, compile_fn: Callable, fx_g: fx.GraphModule, example_inputs) -> Callable:
+    """
+    Returns :attr:`compile_fn` applied to :attr:`fx_g`, or, with
+    ``config.cache_compiled_graphs``, what it returned for an identical graph
+    before, which is shared rather than copied. TorchScript results are
+    shared across processes through the persistent cache, if one is
+    configured. Entries that fail to load count as misses.
+    """
+    from . import config
+
+    if not config.cache_compiled_graphs:
+        return compile_fn(fx_g, example_inputs)
+
+    with compile_phase("compiled_graph_cache", fx_g) as phase:
+        key = _compiled_graph_key(compiler_name, fx_g, example_inputs)
+        if key is None:
+            phase.metrics["hit"] = False
+            return compile_fn(fx_g, example_inputs)
+        with _compiled_graph_cache_lock:
+            compiled = _compiled_graph_cache.get(key)
+        persistent_cache = get_persistent_cache()
+        persistent_key = f"{compiler_name}-{key}"
+        if compiled is None and persistent_cache is not None:
+            entry = persistent_cache.load(persistent_key)
+            if entry is not None:
+                compiled = deserialize_compiled(entry.get("compiled"))
+        with _compiled_graph_cache_lock:
+            _compiled_graph_cache_counts["hits" if compiled is not None else "misses"] += 1
+        phase.metrics["hit"] = compiled is not None
+
+    if compiled is None:
+        compiled = compile_fn(fx_g, example_inputs)
+        if persistent_cache is not None:
+            data = serialize_compiled(compiled)
+            if data is not None:
+                persistent_cache.save(persistent_key, {"compiled": data})
+    with _compiled_graph_cache_lock:
+        try:
+            _compiled_graph_cache[key] = compiled
+        except TypeError:  # doesn't support weak references
+            pass
+    return compiled
+
+
+def compiled_graph_cache_stats() -> Dict[str, float]:
+    """
+    Returns the counters of the cache of :func:`ts_compile` and
+    :func:`tensorexpr_compile` since it was last cleared: the number of
+    ``hits`` and ``misses``, the ``hit_rate`` and the current number of
+    entries as ``size``.
+    """
+    with _compiled_graph_cache_lock:
+        hits, misses = _compiled_graph_cache_counts["hits"], _compiled_graph_cache_counts["misses"]
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "size": len(_compiled_graph_cache),
+        }
+
+
+def clear_compiled_graph_cache():
+    """Clears the cache of :func:`ts_compile` and :func:`tensorexpr_compile`, and its counters."""
+    with _compiled_graph_cache_lock:
+        _compiled_graph_cache.clear()
+        _compiled_graph_cache_counts["hits"] = 0
+        _compiled_graph_cache_counts["misses"] = 0
+
+
+def ts_compile(fx_g: fx.GraphModule, inps) -> Callable:
     """
-    Compiles the :attr:`fx_g` with Torchscript compiler.
+    Compiles the :attr:`fx_g` with Torchscript compiler. The default
+    ``nvfuser_profile`` of the partitioners describes what it fuses on CUDA.
+
+    With ``config.cache_compiled_graphs``, graphs with the same code, inputs
+    and constants are compiled once.
 
     .. warning::
         This API is experimental and likely to change.
 
     Args:
         fx_g(fx.GraphModule): The input Fx graph module to be compiled.
+        inps: The example inputs of :attr:`fx_g`.
 
     Returns:
         Torch scripted model.
     """
+    return _cached_compile("ts_compile", _ts_compile, fx_g, inps)
+
+
+def _ts_compile(fx_g: fx.GraphModule, _) -> Callable:
     for node in fx_g.graph.nodes:
         if (node.target == torch.ops.aten._to_copy and len(node.args) == 1
            and len(node.kwargs) == 1 and 'dtype' in node.kwargs):
@@ -53,17 +203,28 @@ def ts_compile(fx_g: fx.GraphModule, _) -> Callable:
 
     fx_g.recompile()
 
-    f = torch.jit.script(fx_g)
+    with compile_phase("ts_script", fx_g):
+        f = torch.jit.script(fx_g)
 
     torch._C._jit_pass_remove_mutation(f.graph)
 
-    f = torch.jit.freeze(f.eval())
-    f = torch.jit.optimize_for_inference(f)
+    with compile_phase("ts_freeze"):
+        f = torch.jit.freeze(f.eval())
+    with compile_phase("ts_optimize_for_inference"):
+        f = torch.jit.optimize_for_inference(f)
     return f
 
 
 def tensorexpr_compile(fx_module: fx.GraphModule, flat_args) -> Callable:
-    """Compiles the given fx_module using TensorExpr Kernel"""
+    """
+    Compiles the given fx_module using TensorExpr Kernel. Partition for it with
+    ``backend_profile=nnc_profile``. Like :func:`ts_compile`, it compiles
+    identical graphs once with ``config.cache_compiled_graphs``.
+    """
+    return _cached_compile("tensorexpr_compile", _tensorexpr_compile, fx_module, flat_args)
+
+
+def _tensorexpr_compile(fx_module: fx.GraphModule, flat_args) -> Callable:
     inp_devices = {i.device for i in flat_args if isinstance(i, torch.Tensor)}
     assert len(inp_devices) == 1
     inp_device = list(inp_devices)[0]
@@ -212,6 +373,10 @@ def _tvm_compile(
 
 
 def tvm_compile(target, tuning_logfile=None, use_ansor_tuning=False):
+    """
+    Returns a compiler that compiles Fx graphs with TVM for :attr:`target`.
+    Partition for it with ``backend_profile=tvm_profile``.
+    """
     return partial(
         _tvm_compile,
         target=target,
@@ -232,6 +397,56 @@ def nop(fx_g: fx.GraphModule, _) -> Callable:
     return fx_g
 
 
+class _BoxedCodeGen(fx.graph.CodeGen):
+    """
+    Generates a ``forward`` that takes its inputs as a single list, and clears
+    the list once it has unpacked it.
+    """
+    def gen_fn_def(self, free_vars, maybe_return_annotation):
+        lines = [f"def forward(self, args){maybe_return_annotation}:"]
+        if free_vars:
+            lines.append(f"    {', '.join(free_vars)}, = args")
+        lines.append("    args.clear()")
+        return "\n".join(lines)
+
+    def process_inputs(self, *args):
+        return (list(args),)
+
+
+def make_boxed_module(fx_g: fx.GraphModule) -> fx.GraphModule:
+    """
+    Changes the code of :attr:`fx_g` to take its inputs as a single list,
+    which it clears after unpacking it. The generated code already drops each
+    intermediate after its last use; with the inputs no longer held by the
+    caller, they are freed after their last use too, e.g. the tensors saved
+    for the backward. The ``_boxed_call`` attribute of the module is set, so
+    that :func:`aot_function` calls it with a list.
+
+    .. warning::
+        This API is experimental and likely to change.
+
+    """
+    fx_g.graph.set_codegen(_BoxedCodeGen())
+    fx_g.recompile()
+    fx_g._boxed_call = True
+    return fx_g
+
+
+def boxed_nop(fx_g: fx.GraphModule, _) -> Callable:
+    """
+    Returns the :attr:`fx_g` Fx graph module, run by Python like with
+    :func:`nop`, but boxed with :func:`make_boxed_module` so that its inputs
+    and intermediates are freed as soon as they are dead. This lowers the
+    peak memory of the backward, which otherwise keeps every saved tensor
+    alive until it returns.
+
+    .. warning::
+        This API is experimental and likely to change.
+
+    """
+    return make_boxed_module(fx_g)
+
+
 def simple_ts_compile(fx_g, _):
     strip_overloads(fx_g)
     f = torch.jit.script(fx_g)
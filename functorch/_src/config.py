@@ -7,5 +7,78 @@
 """
 Global flags for aot autograd
 """
+import os
 
 use_functionalize = False
+
+# Directory of the on-disk cache of partitioned (and, for TorchScript
+# compilers, compiled) graphs. Persistent caching is disabled when None. The
+# entries are unpickled, so only point this to a directory you trust.
+persistent_cache_dir = os.environ.get("FUNCTORCH_PERSISTENT_CACHE_DIR", None)
+
+# Maximum number of entries of the aot_function compilation cache, in total and
+# per compiled function. Least recently used entries are evicted past these
+# bounds. None means unbounded. See set_compile_cache_capacity.
+compile_cache_capacity = None
+compile_cache_per_function_capacity = None
+
+# Compile aot_function on a cache miss in a background thread, and serve calls
+# eagerly until the compiled function is ready. See wait_for_async_compiles.
+async_compile = False
+async_compile_workers = 1
+
+# Compile the backward graph of aot_function in a worker thread while the
+# forward graph is compiled and run, instead of after it. The backward is
+# compiled for uninitialized example inputs with the metadata of the traced
+# graph. The compilers must be thread-safe.
+parallel_compile = False
+parallel_compile_workers = 2
+
+# How aot_function traces the joint forward and backward graph: "real" runs it
+# on the actual inputs, "meta" on meta tensors, which only compute metadata and
+# don't allocate memory, and "fake" on PyTorch's fake tensors, if available.
+# Tracing falls back to "real" if the other modes fail.
+tracing_mode = "real"
+
+# Compile the backward of aot_function again for the stride layout of
+# non-contiguous cotangents (e.g. the expanded gradient of a sum), instead of
+# copying them to contiguous tensors.
+specialize_backward_strides = False
+
+# Plan the memory of the intermediates of the partitioned forward and backward
+# graphs before compiling them: ops with an out= variant write into a
+# preallocated arena, shared by intermediates with disjoint lifetimes. See
+# functorch.compile.plan_memory.
+memory_planning = False
+
+# Build a PartitionReport of the saved tensors and the peak memory of the
+# graphs of every aot_function compilation, returned by its
+# partition_reports() method. They are also built while a CompileProfiler is
+# active.
+partition_reports = False
+
+# Reuse the cut of min_cut_rematerialization_partition for joint graphs with
+# the same structure, e.g. traced again for a new batch size, instead of
+# solving the max-flow problem again. The cut is valid for any sizes, but
+# not always the one that saves the fewest bytes for the new ones. See
+# partition_cache_stats.
+cache_partitions = False
+
+# Compute the ops of graphs whose inputs are all tensor constants once in
+# fx_graph_cse, and replace them by their result. make_fx records the
+# buffers of modules as tensor constants, so only enable it if they aren't
+# updated between calls.
+fold_constants = False
+
+# Rewrite the joint forward and backward graph of aot_function with the
+# registered fusion patterns before partitioning it, e.g. to replace ops that
+# the compilers can't fuse by equivalent elementwise ops and reductions. See
+# functorch.compile.register_fusion_pattern.
+rewrite_fusion_patterns = False
+
+# Compile graphs with the same code, input metadata and constants, e.g. the
+# forward of identical layers, once in ts_compile and tensorexpr_compile, and
+# share the result. Graphs with arenas of the memory planner are compiled
+# separately. With persistent_cache_dir set, TorchScript results are shared
+# across processes. See functorch.compile.compiled_graph_cache_stats.
+cache_compiled_graphs = False
@@ -0,0 +1,245 @@
+"""
+Estimates of the cost of the ATen ops of a traced graph, for the
+rematerialization partitioners.
+
+The cost of a node is estimated from the metadata of the node and of its
+inputs with a roofline model: an op takes as long as the larger of its
+floating point work at :attr:`CostModel.peak_flops` and its memory traffic at
+:attr:`CostModel.memory_bandwidth`. Both rates can be measured on the local
+machine with :meth:`CostModel.calibrate`. The cost of offloading a value to
+host memory, instead of saving it on the device or recomputing it, is its
+transfer time at :attr:`CostModel.offload_bandwidth`.
+"""
+import time
+from typing import Callable, Dict, Optional
+
+import torch
+import torch.fx as fx
+
+from .compile_utils import get_aten_target, rand_ops
+from .backend_profiles import pointwise_ops, reduction_ops, misc_ops
+from .partitioners import _concrete_dim, _is_tensor, _node_size, _prod, _tensor_value
+
+aten = torch.ops.aten
+
+# Ops that only move data or change metadata. Views don't read or write any
+# memory, the others copy their input.
+view_ops = [aten.view, aten._unsafe_view, aten._reshape_alias, aten.reshape, aten.expand, aten.t, aten.transpose,
+            aten.permute, aten.squeeze, aten.unsqueeze, aten.slice, aten.select, aten.alias, aten.detach]
+copy_ops = [aten.clone, aten.cat, aten.repeat, aten._to_copy] + misc_ops
+
+flop_formulas: Dict[Callable, Callable[[fx.Node], int]] = {}
+
+
+def register_flop_formula(*ops):
+    """
+    Registers a function that returns the number of floating point operations
+    of a node calling one of :attr:`ops`, given the node.
+    """
+    def register(fn):
+        for op in ops:
+            flop_formulas[op] = fn
+        return fn
+    return register
+
+
+def _shape(node):
+    return [_concrete_dim(dim) for dim in _tensor_value(node).shape]
+
+
+def _numel(node):
+    return _prod(_shape(node))
+
+
+def _has_tensor_meta(arg):
+    return isinstance(arg, fx.Node) and _is_tensor(arg)
+
+
+@register_flop_formula(*pointwise_ops)
+def _pointwise_flop(node):
+    return _numel(node)
+
+
+@register_flop_formula(*reduction_ops)
+def _reduction_flop(node):
+    return sum(_numel(arg) for arg in node.all_input_nodes if _has_tensor_meta(arg))
+
+
+@register_flop_formula(*(view_ops + copy_ops))
+def _no_flop(node):
+    return 0
+
+
+@register_flop_formula(aten.mm, aten.bmm)
+def _matmul_flop(node):
+    # [..., m, k] @ [..., k, n]
+    return 2 * _numel(node) * _shape(node.args[0])[-1]
+
+
+@register_flop_formula(aten.addmm)
+def _addmm_flop(node):
+    return 2 * _numel(node) * _shape(node.args[1])[-1] + _numel(node)
+
+
+def _conv_flop(input_shape, weight_shape, output_shape, transposed):
+    # Every output (input, for transposed convolutions) element is a dot
+    # product over the kernel and the input channels of its group.
+    kernel = _prod(weight_shape[2:])
+    if transposed:
+        return 2 * _prod(input_shape) * weight_shape[1] * kernel
+    return 2 * _prod(output_shape) * weight_shape[1] * kernel
+
+
+@register_flop_formula(aten.convolution)
+def _convolution_flop(node):
+    transposed = node.args[6]
+    return _conv_flop(_shape(node.args[0]), _shape(node.args[1]), _shape(node), transposed)
+
+
+@register_flop_formula(aten.convolution_backward)
+def _convolution_backward_flop(node):
+    # The gradients of the input and of the weight each cost a convolution
+    grad_output, input, weight = node.args[:3]
+    transposed = node.args[7]
+    output_mask = node.args[10]
+    fw_flop = _conv_flop(_shape(input), _shape(weight), _shape(grad_output), transposed)
+    return fw_flop * sum(1 for needed in output_mask[:2] if needed)
+
+
+class CostModel(object):
+    """
+    A roofline cost model of the ATen ops of a joint graph, used by
+    :func:`min_cut_rematerialization_partition` and
+    :func:`memory_budget_partition` to weigh the cost of recomputing a value
+    in the backward against the cost of saving it.
+
+    A value is saved when it is written in the forward and read in the
+    backward, and recomputing it reads its inputs and does its floating point
+    work; its output is assumed to be fused into its users. Recomputing a
+    value is allowed if it takes at most :attr:`max_recompute_ratio` times as
+    long as saving it. Random ops, and ops without a registered FLOP formula,
+    are never recomputed.
+
+    Add FLOP formulas for other ops with :func:`register_flop_formula`, or
+    override :meth:`flops` in a subclass.
+
+    .. warning::
+        This API is experimental and likely to change.
+
+    Args:
+        peak_flops(float): Floating point operations per second.
+        memory_bandwidth(float): Bytes read or written per second.
+        max_recompute_ratio(float): How many times longer than saving a value
+            recomputing it may take. The default of 2 allows recomputing
+            pointwise ops, and reductions whose output is at most 4x smaller
+            than their input.
+        offload_bandwidth(float): Bytes copied per second between the device
+            and pinned host memory.
+    """
+    def __init__(self, peak_flops: float = 1e13, memory_bandwidth: float = 1e12, max_recompute_ratio: float = 2.0,
+                 offload_bandwidth: float = 2.5e10):
+        self.peak_flops = peak_flops
+        self.memory_bandwidth = memory_bandwidth
+        self.max_recompute_ratio = max_recompute_ratio
+        self.offload_bandwidth = offload_bandwidth
+
+    def __repr__(self):
+        return (
+            f"CostModel(peak_flops={self.peak_flops:.3g}, memory_bandwidth={self.memory_bandwidth:.3g}, "
+            f"max_recompute_ratio={self.max_recompute_ratio}, offload_bandwidth={self.offload_bandwidth:.3g})"
+        )
+
+    def flops(self, node: fx.Node) -> Optional[int]:
+        """The floating point operations of :attr:`node`, or None if unknown."""
+        if node.op != 'call_function' or not _has_tensor_meta(node):
+            return None
+        formula = flop_formulas.get(get_aten_target(node))
+        if formula is None:
+            return None
+        return formula(node)
+
+    def input_bytes(self, node: fx.Node) -> int:
+        """The bytes that :attr:`node` reads."""
+        if get_aten_target(node) in view_ops:
+            return 0
+        return sum(_node_size(arg) for arg in set(node.all_input_nodes) if _has_tensor_meta(arg))
+
+    def bytes_accessed(self, node: fx.Node) -> int:
+        """The bytes that :attr:`node` reads and writes."""
+        if get_aten_target(node) in view_ops:
+            return 0
+        return self.input_bytes(node) + _node_size(node)
+
+    def compute_time(self, node: fx.Node) -> Optional[float]:
+        """The estimated run time of :attr:`node` in seconds, or None if unknown."""
+        flops = self.flops(node)
+        if flops is None:
+            return None
+        return max(flops / self.peak_flops, self.bytes_accessed(node) / self.memory_bandwidth)
+
+    def recompute_time(self, node: fx.Node) -> Optional[float]:
+        """The estimated time to recompute :attr:`node` in the backward, or None if unknown."""
+        flops = self.flops(node)
+        if flops is None:
+            return None
+        return max(flops / self.peak_flops, self.input_bytes(node) / self.memory_bandwidth)
+
+    def save_time(self, node: fx.Node) -> float:
+        """The time to write :attr:`node` in the forward and read it back in the backward."""
+        return 2 * _node_size(node) / self.memory_bandwidth
+
+    def offload_time(self, node: fx.Node) -> float:
+        """The time to copy :attr:`node` to host memory in the forward and back in the backward."""
+        return 2 * _node_size(node) / self.offload_bandwidth
+
+    def ban_recomputation(self, node: fx.Node, cost_factor: float = 1.0) -> bool:
+        """
+        Returns True if :attr:`node` should be saved rather than recomputed.
+        :attr:`cost_factor` scales its estimated recomputation time.
+        """
+        if node.op != 'call_function':
+            return False
+        if get_aten_target(node) in rand_ops:
+            return True
+        recompute_time = self.recompute_time(node)
+        if recompute_time is None:
+            return True
+        return recompute_time * cost_factor > self.max_recompute_ratio * self.save_time(node)
+
+    @classmethod
+    def calibrate(cls, device="cpu", dtype=torch.float32, size: int = 1024, repeat: int = 10, **kwargs) -> "CostModel":
+        """
+        Measures :attr:`peak_flops` with a matrix multiplication and
+        :attr:`memory_bandwidth` with an addition of :attr:`size` x
+        :attr:`size` matrices on :attr:`device`, and on CUDA devices
+        :attr:`offload_bandwidth` with a copy to pinned memory. Returns a cost
+        model with the measured rates. :attr:`kwargs` are passed to the
+        constructor.
+        """
+        device = torch.device(device)
+        a = torch.randn(size, size, device=device, dtype=dtype)
+        b = torch.randn(size, size, device=device, dtype=dtype)
+        out = torch.empty(size, size, device=device, dtype=dtype)
+
+        def best_time(fn):
+            fn()
+            best = float("inf")
+            for _ in range(repeat):
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                fn()
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                best = min(best, time.perf_counter() - start)
+            return max(best, 1e-9)
+
+        mm_time = best_time(lambda: torch.mm(a, b, out=out))
+        add_time = best_time(lambda: torch.add(a, b, out=out))
+        kwargs["peak_flops"] = 2 * size ** 3 / mm_time
+        kwargs["memory_bandwidth"] = 3 * a.numel() * a.element_size() / add_time
+        if device.type == "cuda":
+            host = torch.empty(size, size, dtype=dtype, pin_memory=True)
+            copy_time = best_time(lambda: host.copy_(a, non_blocking=True))
+            kwargs["offload_bandwidth"] = a.numel() * a.element_size() / copy_time
+        return cls(**kwargs)
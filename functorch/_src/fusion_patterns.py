@@ -0,0 +1,492 @@
+"""
+Pattern-based rewrites of the joint forward and backward graphs of
+:func:`aot_function`.
+
+A :class:`FusionPattern` replaces a subgraph of ATen ops by an equivalent
+subgraph that the compilers of the partitioned graphs fuse better, e.g. ops
+that NVFuser or NNC can't generate code for by the elementwise ops and
+reductions they compute. Patterns and replacements are Python functions,
+which are traced into joint graphs like the function compiled by
+:func:`aot_function`, so a rewrite replaces the forward ops of a pattern
+together with their gradients. :func:`apply_fusion_patterns` runs between
+tracing and partitioning when ``config.rewrite_fusion_patterns`` is set.
+"""
+import itertools
+import math
+import threading
+from typing import Callable, Dict, List, Optional, Sequence
+
+import torch
+import torch.fx as fx
+import torch.nn.functional as F
+import torch.utils._pytree as pytree
+
+from .python_key import make_fx
+
+fusion_patterns: Dict[str, "FusionPattern"] = {}
+
+
+class _Scalar(object):
+    """
+    A literal argument of a traced pattern that depends on its example
+    inputs, e.g. a size, a dropout probability or a dtype. :attr:`key`
+    identifies its value in the first trace, and :attr:`other` is its value
+    in the second one.
+    """
+    __slots__ = ("key", "other")
+
+    def __init__(self, value, other):
+        self.key = (type(value), value)
+        self.other = other
+
+
+def _template(arg, other, node_map):
+    """
+    Returns :attr:`arg` of a node of the first trace of a pattern with the
+    literals that differ in the second trace, :attr:`other`, replaced by
+    :class:`_Scalar`. Raises ValueError if the traces differ otherwise.
+    """
+    if isinstance(arg, fx.Node):
+        if node_map.get(arg) is not other:
+            raise ValueError("different nodes")
+        return arg
+    if isinstance(arg, (list, tuple)):
+        if not isinstance(other, (list, tuple)) or isinstance(arg, tuple) != isinstance(other, tuple) \
+                or len(arg) != len(other):
+            raise ValueError(f"{arg} and {other} have different structures")
+        items = [_template(a, o, node_map) for a, o in zip(arg, other)]
+        return tuple(items) if isinstance(arg, tuple) else items
+    if isinstance(arg, dict):
+        if not isinstance(other, dict) or list(arg) != list(other):
+            raise ValueError(f"{arg} and {other} have different keys")
+        return {k: _template(v, other[k], node_map) for k, v in arg.items()}
+    if type(arg) is not type(other):
+        raise ValueError(f"{arg} and {other} have different types")
+    if arg == other:
+        return arg
+    return _Scalar(arg, other)
+
+
+def _shape_and_dtype(node):
+    tensor_meta = node.meta.get("tensor_meta")
+    if not hasattr(tensor_meta, "shape"):
+        return None
+    return [*tensor_meta.shape, tensor_meta.dtype]
+
+
+class _TracedJoint(object):
+    """
+    The joint graph of a pattern or replacement traced for two sets of
+    example inputs. The literals of :attr:`templates` that differ between
+    the traces are :class:`_Scalar`, and :attr:`scalars` maps their keys to
+    their value in the second trace.
+    """
+    def __init__(self, first: fx.GraphModule, second: fx.GraphModule):
+        first_nodes = list(first.graph.nodes)
+        second_nodes = list(second.graph.nodes)
+        if len(first_nodes) != len(second_nodes):
+            raise ValueError("the example inputs are traced into graphs of different sizes")
+        node_map = {}
+        self.templates = {}
+        self.input_templates = {}
+        self.scalars = {}
+        for node, other in zip(first_nodes, second_nodes):
+            if node.op != other.op or node.target != other.target:
+                raise ValueError(f"the example inputs are traced into different ops, {node.target} and {other.target}")
+            node_map[node] = other
+            args = _template(node.args, other.args, node_map)
+            kwargs = _template(node.kwargs, other.kwargs, node_map)
+            self.templates[node] = (args, kwargs)
+            self._add_scalars((args, kwargs))
+            if node.op == "placeholder":
+                # The sizes and dtypes of the inputs bind scalars as well
+                self.input_templates[node] = _template(_shape_and_dtype(node), _shape_and_dtype(other), node_map)
+                self._add_scalars(self.input_templates[node])
+        self.graph = first.graph
+        self.placeholders = [node for node in first_nodes if node.op == "placeholder"]
+        output = first_nodes[-1]
+        self.outputs = list(pytree.tree_flatten(output.args[0])[0]) if output.args[0] is not None else []
+        self.output_nodes = []
+        for out in self.outputs:
+            if isinstance(out, fx.Node) and out.op != "placeholder" and out not in self.output_nodes:
+                self.output_nodes.append(out)
+
+    def _add_scalars(self, template):
+        for leaf in pytree.tree_flatten(template)[0]:
+            if isinstance(leaf, _Scalar) and self.scalars.setdefault(leaf.key, leaf.other) != leaf.other:
+                raise ValueError(f"the example value {leaf.key[1]} can't be told apart from other values")
+
+
+def _trace_joint(fn, args, requires_grad, device, tracing_mode, decompositions):
+    from .aot_autograd import create_joint_forward_backward, normalize_as_list
+
+    args = [
+        arg.detach().to(device).requires_grad_(grad) if isinstance(arg, torch.Tensor) else arg
+        for arg, grad in zip(args, requires_grad)
+    ]
+    tensor_idxs = [idx for idx, arg in enumerate(args) if isinstance(arg, torch.Tensor)]
+
+    def flat_fn(*tensors):
+        full_args = list(args)
+        for idx, tensor in zip(tensor_idxs, tensors):
+            full_args[idx] = tensor
+        return normalize_as_list(fn(*full_args))
+
+    primals = [args[idx] for idx in tensor_idxs]
+    with torch.no_grad():
+        tangents = [torch.randn_like(out) for out in flat_fn(*primals)]
+    joint = make_fx(create_joint_forward_backward(flat_fn), decompositions, tracing_mode=tracing_mode)(
+        primals, tangents
+    )
+    joint.graph.eliminate_dead_code()
+    return joint
+
+
+class FusionPattern(object):
+    """
+    Rewrites the joint graphs of :func:`aot_function` that compute
+    :attr:`pattern` to compute :attr:`replacement` instead. Both are
+    functions of the same arguments that return the same values, and their
+    gradients replace each other as well.
+
+    To match graphs of any shape, the functions are traced for the two sets
+    of arguments returned by :attr:`example_inputs`, whose tensors should
+    differ in their sizes and dtype and whose other arguments in their
+    values. The literals that differ between the two traces of the pattern,
+    and the sizes and dtypes of its inputs, are read from the graph that
+    matches it, and the replacement may only use those. Literals that don't
+    differ, e.g. dimensions or broadcast sizes of 1, must be equal in the
+    graph, so the pattern matches graphs of the same rank.
+
+    A pattern is traced for every subset of its floating point tensor
+    arguments that require grad, on the device of the graph, the first time
+    it is applied.
+
+    .. warning::
+        This API is experimental and likely to change.
+
+    Args:
+        name(str): The name of the pattern.
+        pattern(Callable): The function computing the ops to replace.
+        replacement(Callable): The function that replaces it.
+        example_inputs(Callable): Returns two tuples of example arguments.
+    """
+    def __init__(self, name: str, pattern: Callable, replacement: Callable, example_inputs: Callable):
+        self.name = name
+        self.pattern = pattern
+        self.replacement = replacement
+        self.example_inputs = example_inputs
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"FusionPattern(name={self.name!r})"
+
+    def variants(self, device, tracing_mode="real", decompositions=None):
+        """
+        Returns the ``(pattern, replacement)`` pairs of :class:`_TracedJoint`
+        of the pattern, one for every subset of the arguments that require
+        grad.
+        """
+        if decompositions is None:
+            from .aot_autograd import aot_autograd_decompositions
+            decompositions = aot_autograd_decompositions
+        key = (torch.device(device), tracing_mode, frozenset(decompositions))
+        with self._lock:
+            if key not in self._variants:
+                self._variants[key] = self._trace(key[0], tracing_mode, decompositions)
+            return self._variants[key]
+
+    def _trace(self, device, tracing_mode, decompositions):
+        first, second = self.example_inputs()
+        differentiable = [isinstance(arg, torch.Tensor) and arg.is_floating_point() for arg in first]
+        variants = []
+        for grads in itertools.product([False, True], repeat=sum(differentiable)):
+            grads = iter(grads)
+            requires_grad = [next(grads) if d else False for d in differentiable]
+            traced = []
+            for fn in (self.pattern, self.replacement):
+                traced.append(_TracedJoint(
+                    _trace_joint(fn, first, requires_grad, device, tracing_mode, decompositions),
+                    _trace_joint(fn, second, requires_grad, device, tracing_mode, decompositions),
+                ))
+            pattern, replacement = traced
+            for key, other in replacement.scalars.items():
+                if pattern.scalars.get(key, other) != other or key not in pattern.scalars:
+                    raise ValueError(
+                        f"The replacement of the fusion pattern {self.name} uses {key[1]}, which depends on its "
+                        "inputs but isn't used by the pattern"
+                    )
+            if [out is None for out in pattern.outputs] != [out is None for out in replacement.outputs]:
+                raise ValueError(f"The pattern and replacement of {self.name} compute different gradients")
+            if pattern.output_nodes:
+                variants.append((pattern, replacement))
+        return variants
+
+
+def register_fusion_pattern(name: str, replacement: Callable, example_inputs: Callable):
+    """
+    Registers the decorated function as the pattern of a
+    :class:`FusionPattern` named :attr:`name`, which
+    :func:`apply_fusion_patterns` applies by default.
+
+    .. warning::
+        This API is experimental and likely to change.
+    """
+    def register(pattern):
+        fusion_patterns[name] = FusionPattern(name, pattern, replacement, example_inputs)
+        return pattern
+    return register
+
+
+class _Match(object):
+    def __init__(self, nodes=None, scalars=None):
+        self.nodes: Dict[fx.Node, fx.Node] = dict(nodes or {})
+        self.scalars: Dict = dict(scalars or {})
+        self.matched = {g for p, g in self.nodes.items() if p.op != "placeholder"}
+
+    def copy(self):
+        return _Match(self.nodes, self.scalars)
+
+
+def _match_arg(pattern, p, g, match):
+    if isinstance(p, fx.Node):
+        return isinstance(g, fx.Node) and _match_node(pattern, p, g, match)
+    if isinstance(p, _Scalar):
+        if type(g) is not p.key[0]:
+            return False
+        bound = match.scalars.setdefault(p.key, g)
+        return bound is g or bound == g
+    if isinstance(p, (list, tuple)):
+        return (isinstance(g, (list, tuple)) and isinstance(g, tuple) == isinstance(p, tuple) and len(g) == len(p)
+                and all(_match_arg(pattern, a, b, match) for a, b in zip(p, g)))
+    if isinstance(p, dict):
+        return (isinstance(g, dict) and set(g) == set(p)
+                and all(_match_arg(pattern, v, g[k], match) for k, v in p.items()))
+    return type(g) is type(p) and g == p
+
+
+def _match_node(pattern, p, g, match):
+    if p in match.nodes:
+        return match.nodes[p] is g
+    if p.op == "placeholder":
+        match.nodes[p] = g
+        # Inputs of a different rank only leave their sizes unbound
+        template = pattern.input_templates.get(p)
+        shape_and_dtype = _shape_and_dtype(g)
+        if template is None or shape_and_dtype is None or len(template) != len(shape_and_dtype):
+            return True
+        return _match_arg(pattern, template, shape_and_dtype, match)
+    if g in match.matched or p.op != g.op or p.target != g.target:
+        return False
+    args, kwargs = pattern.templates[p]
+    if len(args) != len(g.args) or set(kwargs) != set(g.kwargs):
+        return False
+    match.nodes[p] = g
+    match.matched.add(g)
+    return (all(_match_arg(pattern, a, b, match) for a, b in zip(args, g.args))
+            and all(_match_arg(pattern, v, g.kwargs[k], match) for k, v in kwargs.items()))
+
+
+def _find_match(pattern: _TracedJoint, anchor: fx.Node, nodes_by_target) -> Optional[_Match]:
+    """
+    Matches the outputs of :attr:`pattern` to nodes of a graph, starting by
+    its first output at :attr:`anchor`. Only the outputs of a match may be
+    used by the rest of the graph.
+    """
+    match = _Match()
+    first, *others = pattern.output_nodes
+    if not _match_node(pattern, first, anchor, match):
+        return None
+    for out in others:
+        if out in match.nodes:
+            continue
+        for candidate in nodes_by_target.get(out.target, ()):
+            trial = match.copy()
+            if _match_node(pattern, out, candidate, trial):
+                match = trial
+                break
+        else:
+            return None
+    returned = set(pattern.output_nodes)
+    for p, g in match.nodes.items():
+        if p.op != "placeholder" and p not in returned and any(user not in match.matched for user in g.users):
+            return None
+    return match
+
+
+def _rewrite(graph: fx.Graph, pattern: _TracedJoint, replacement: _TracedJoint, match: _Match, pos,
+             last_placeholder: fx.Node) -> bool:
+    """
+    Replaces the nodes of :attr:`match` by :attr:`replacement`. Every node of
+    the replacement is inserted right after the last node it depends on, and
+    the rewrite is skipped if that is too late for a user of an output.
+    :attr:`pos` maps the nodes of :attr:`graph` to their index.
+    """
+    if any(key not in match.scalars for key in replacement.scalars):
+        return False
+    bindings = dict(zip(replacement.placeholders, (match.nodes.get(p) for p in pattern.placeholders)))
+    earliest = min(match.matched, key=lambda g: pos[g])
+    default_anchor = max(earliest.prev, last_placeholder, key=lambda n: pos[n])
+
+    # Schedule the replacement before changing the graph
+    anchors = {}
+    for node in replacement.graph.nodes:
+        if node.op == "placeholder":
+            if bindings.get(node) is None and node.users:
+                return False
+            continue
+        if node.op == "output":
+            continue
+        deps = [bindings[arg] if arg.op == "placeholder" else anchors[arg] for arg in node.all_input_nodes]
+        anchors[node] = max(deps + [default_anchor], key=lambda n: pos[n])
+    outputs = []
+    for p_out, r_out in zip(pattern.outputs, replacement.outputs):
+        if not isinstance(p_out, fx.Node) or p_out.op == "placeholder":
+            continue
+        g_out = match.nodes[p_out]
+        ready = pos[bindings[r_out] if r_out.op == "placeholder" else anchors[r_out]]
+        if any(pos[user] <= ready for user in g_out.users if user not in match.matched):
+            return False
+        outputs.append((g_out, r_out))
+
+    env = dict(bindings)
+    tail = {}
+
+    def scalar(arg):
+        return match.scalars[arg.key] if isinstance(arg, _Scalar) else arg
+
+    for node in replacement.graph.nodes:
+        if node.op in ("placeholder", "output"):
+            continue
+        args, kwargs = replacement.templates[node]
+        args = pytree.tree_map(scalar, fx.node.map_arg(args, env.get))
+        kwargs = pytree.tree_map(scalar, fx.node.map_arg(kwargs, env.get))
+        anchor = anchors[node]
+        with graph.inserting_after(tail.get(anchor, anchor)):
+            env[node] = tail[anchor] = graph.create_node(node.op, node.target, tuple(args), kwargs)
+
+    for g_out, r_out in outputs:
+        if r_out.op != "placeholder":
+            env[r_out].meta = g_out.meta
+        g_out.replace_all_uses_with(env[r_out])
+    for g in sorted(match.matched, key=lambda g: pos[g], reverse=True):
+        graph.erase_node(g)
+    return True
+
+
+def apply_fusion_patterns(fx_g: fx.GraphModule, patterns: Optional[Sequence[FusionPattern]] = None,
+                          device=None, tracing_mode: str = "real", decompositions: Optional[Dict] = None) -> int:
+    """
+    Rewrites the subgraphs of the joint graph :attr:`fx_g` that match one of
+    :attr:`patterns`, the registered patterns by default, in place. The new
+    nodes have no ``tensor_meta``; trace the graph again to compute it.
+
+    .. warning::
+        This API is experimental and likely to change.
+
+    Args:
+        fx_g(fx.GraphModule): A joint graph traced by :func:`aot_function`.
+        patterns(Optional[Sequence[FusionPattern]]): The patterns to apply.
+        device: The device of the tensors of :attr:`fx_g`. Default: CPU
+        tracing_mode(str): The tracing mode :attr:`fx_g` was traced with.
+        decompositions(Optional[Dict]): The decompositions :attr:`fx_g` was
+            traced with. Default: those of :func:`aot_function`
+
+    Returns:
+        Returns the number of rewritten subgraphs.
+    """
+    if patterns is None:
+        patterns = list(fusion_patterns.values())
+    device = torch.device("cpu") if device is None else device
+    graph = fx_g.graph
+    num_rewrites = 0
+
+    def positions():
+        pos = {node: idx for idx, node in enumerate(graph.nodes)}
+        pos[graph._root] = -1
+        return pos
+
+    for fusion_pattern in patterns:
+        for pattern, replacement in fusion_pattern.variants(device, tracing_mode, decompositions):
+            pos = positions()
+            last_placeholder = max((n for n in graph.nodes if n.op == "placeholder"), key=lambda n: pos[n],
+                                   default=graph._root)
+            nodes_by_target: Dict[object, List[fx.Node]] = {}
+            for node in graph.nodes:
+                nodes_by_target.setdefault(node.target, []).append(node)
+            for anchor in list(nodes_by_target.get(pattern.output_nodes[0].target, ())):
+                if anchor not in pos:  # rewritten
+                    continue
+                match = _find_match(pattern, anchor, nodes_by_target)
+                if match is None or not _rewrite(graph, pattern, replacement, match, pos, last_placeholder):
+                    continue
+                num_rewrites += 1
+                for g in match.matched:
+                    nodes_by_target[g.target].remove(g)
+                pos = positions()
+    if num_rewrites:
+        graph.lint()
+        fx_g.recompile()
+    return num_rewrites
+
+
+def _example_inputs(first_shapes, second_shapes, first_scalars=(), second_scalars=()):
+    """Random float and double tensors of the given shapes, followed by the scalars."""
+    first = tuple(torch.randn(shape) for shape in first_shapes) + tuple(first_scalars)
+    second = tuple(torch.randn(shape, dtype=torch.float64) for shape in second_shapes) + tuple(second_scalars)
+    return first, second
+
+
+def _gelu(x):
+    return x * 0.5 * (1.0 + torch.erf(x * (1.0 / math.sqrt(2.0))))
+
+
+def _bias_gelu_dropout_fused(input, bias, p):
+    return F.dropout(_gelu(input + bias), p, training=True)
+
+
+# The gelu backward is computed by elementwise ops, which fuse with the
+# dropout mask and the sum of the gradient of the bias.
+@register_fusion_pattern(
+    "bias_gelu_dropout", _bias_gelu_dropout_fused,
+    lambda: _example_inputs([[2, 3, 5], [5]], [[4, 6, 7], [7]], [0.3], [0.6]),
+)
+def _bias_gelu_dropout(input, bias, p):
+    return F.dropout(F.gelu(input + bias), p, training=True)
+
+
+def _layer_norm_residual_fused(input, residual, weight, bias, eps):
+    x = input + residual
+    mean = x.mean(-1, keepdim=True)
+    centered = x - mean
+    var = (centered * centered).mean(-1, keepdim=True)
+    return centered * torch.rsqrt(var + eps) * weight + bias
+
+
+# native_layer_norm and its backward are single kernels that no fuser
+# generates code for, so they neither fuse with the residual add nor get
+# recomputed by the min-cut partitioner.
+@register_fusion_pattern(
+    "layer_norm_residual", _layer_norm_residual_fused,
+    lambda: _example_inputs([[2, 3, 5], [2, 3, 5], [5], [5]], [[4, 6, 7], [4, 6, 7], [7], [7]], [1e-5], [1e-6]),
+)
+def _layer_norm_residual(input, residual, weight, bias, eps):
+    return F.layer_norm(input + residual, input.shape[-1:], weight, bias, eps)
+
+
+def _softmax_mask_dropout_fused(scores, mask, p):
+    x = scores + mask
+    exp = torch.exp(x - x.amax(-1, keepdim=True).detach())
+    return F.dropout(exp / exp.sum(-1, keepdim=True), p, training=True)
+
+
+# The softmax and its backward become a max, a sum and elementwise ops,
+# which fuse with the mask and the dropout. The mask is broadcast over the
+# heads and queries of the attention scores.
+@register_fusion_pattern(
+    "softmax_mask_dropout", _softmax_mask_dropout_fused,
+    lambda: _example_inputs([[2, 3, 5, 5], [2, 1, 1, 5]], [[4, 6, 7, 7], [4, 1, 1, 7]], [0.3], [0.6]),
+)
+def _softmax_mask_dropout(scores, mask, p):
+    return F.dropout(torch.softmax(scores + mask, -1), p, training=True)
@@ -0,0 +1,236 @@
+"""
+Static memory planning for the partitioned forward and backward graphs.
+
+:func:`plan_memory` computes the lifetimes of the intermediate tensors of a
+graph, packs the tensors whose lifetimes don't overlap into the same region
+of a preallocated arena per dtype, and rewrites the ops that produce them to
+write into their region with their ``out=`` variant. The graph then runs without
+allocating these intermediates.
+"""
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torch.fx as fx
+
+from .compile_profiler import compile_phase
+from .partition_report import _node_bytes, _storage_roots, _unknown_aliases
+
+# Offsets of the buffers in the arenas are multiples of this many bytes
+ARENA_ALIGNMENT = 64
+
+# Prefix of the names of the arena buffers that plan_memory adds to modules
+ARENA_NAME_PREFIX = "_memory_arena_"
+
+_out_variants: Dict[torch._ops.OpOverload, Optional[torch._ops.OpOverload]] = {}
+
+
+def _arguments(schema) -> List[Tuple[str, str]]:
+    return [(arg.name, str(arg.type)) for arg in schema.arguments]
+
+
+def out_variant(op) -> Optional[torch._ops.OpOverload]:
+    """
+    Returns the overload of :attr:`op` that takes the same arguments, plus
+    an ``out`` tensor to write its result into, or None. Only functional ops
+    returning a single tensor have one.
+    """
+    if not isinstance(op, torch._ops.OpOverload):
+        return None
+    if op in _out_variants:
+        return _out_variants[op]
+    result = None
+    schema = op._schema
+    functional = (
+        len(schema.returns) == 1 and str(schema.returns[0].type) == "Tensor"
+        and all(arg.alias_info is None for arg in schema.arguments)
+        and schema.returns[0].alias_info is None
+    )
+    if functional:
+        expected = _arguments(schema) + [("out", "Tensor")]
+        packet = op.overloadpacket
+        for name in packet.overloads():
+            overload = getattr(packet, name)
+            if _arguments(overload._schema) == expected and overload._schema.arguments[-1].is_out:
+                result = overload
+                break
+    _out_variants[op] = result
+    return result
+
+
+def _is_contiguous(tensor_meta):
+    expected = 1
+    for size, stride in reversed(list(zip(tensor_meta.shape, tensor_meta.stride))):
+        if size != 1 and stride != expected:
+            return False
+        expected *= size
+    return True
+
+
+class MemoryPlan(object):
+    """
+    The buffers :func:`plan_memory` placed in the arenas of a graph.
+
+    :attr:`offsets` maps the names of the planned nodes to their offset in
+    bytes in the arena of their dtype. The arenas take :attr:`arena_bytes`
+    bytes in total. :attr:`total_bytes` is what allocating every planned
+    buffer separately allocates in total, and
+    :attr:`naive_peak_bytes` is the most memory these buffers occupy at once
+    when each is freed after its last use, which is the smallest arena
+    possible.
+    """
+    def __init__(self, offsets: Dict[str, int], sizes: Dict[str, int], arena_bytes: int, naive_peak_bytes: int):
+        self.offsets = offsets
+        self.sizes = sizes
+        self.arena_bytes = arena_bytes
+        self.naive_peak_bytes = naive_peak_bytes
+
+    @property
+    def num_planned(self) -> int:
+        return len(self.offsets)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.sizes.values())
+
+    def __repr__(self):
+        return (
+            f"MemoryPlan(num_planned={self.num_planned}, arena_bytes={self.arena_bytes}, "
+            f"naive_peak_bytes={self.naive_peak_bytes}, total_bytes={self.total_bytes})"
+        )
+
+
+def _place(buffers):
+    """
+    Assigns offsets to the ``(node, size, start, end)`` :attr:`buffers`, such
+    that buffers with overlapping lifetimes ``[start, end]`` don't overlap in
+    memory. Larger buffers are placed first, at the lowest offset that fits.
+    """
+    placed = []
+    offsets = {}
+    arena_bytes = 0
+    for node, size, start, end in sorted(buffers, key=lambda b: (-b[1], b[2])):
+        conflicts = sorted(
+            (offset, offset + other_size) for offset, other_size, other_start, other_end in placed
+            if other_start <= end and start <= other_end
+        )
+        offset = 0
+        for conflict_start, conflict_end in conflicts:
+            if offset + size <= conflict_start:
+                break
+            offset = max(offset, -(-conflict_end // ARENA_ALIGNMENT) * ARENA_ALIGNMENT)
+        placed.append((offset, size, start, end))
+        offsets[node] = offset
+        arena_bytes = max(arena_bytes, offset + size)
+    return offsets, arena_bytes
+
+
+def plan_memory(fx_module: fx.GraphModule, example_inputs) -> fx.GraphModule:
+    """
+    Rewrites the ops of :attr:`fx_module` that have an ``out=`` variant to
+    write their results into arenas allocated once, one per dtype, on the
+    device of the :attr:`example_inputs`, instead of allocating them.
+    Intermediates whose lifetimes don't overlap share memory. The lifetime of
+    a tensor lasts until the last use of any of its aliases, by the alias
+    annotations of the schemas of the ops. Outputs and the tensors they
+    alias, tensors that ops without a schema take, and ops whose results are
+    not contiguous, are left alone. The :class:`MemoryPlan` is stored in the
+    ``memory_plan`` attribute of the module.
+
+    The arenas are reused by every call of the module, so the module must not
+    run concurrently in several threads.
+
+    .. warning::
+        This API is experimental and likely to change.
+
+    Args:
+        fx_module(fx.GraphModule): A graph with ``tensor_meta`` metadata,
+            e.g. a forward or backward graph of a partitioner.
+        example_inputs: The inputs of :attr:`fx_module`.
+
+    Returns:
+        Returns :attr:`fx_module`, rewritten.
+    """
+    graph = fx_module.graph
+    tensors = [x for x in example_inputs if isinstance(x, torch.Tensor)]
+    device = tensors[0].device if tensors else torch.device("cpu")
+
+    with compile_phase("memory_planning", fx_module) as phase:
+        nodes = list(graph.nodes)
+        node_idx = {node: idx for idx, node in enumerate(nodes)}
+        roots = _storage_roots(graph)
+        # Buffers that ops without a schema might alias can't be planned, as
+        # their lifetimes are unknown, and neither can those that alias an output.
+        escaping = _unknown_aliases(graph, roots)
+        last_use: Dict[fx.Node, int] = {}
+        for node in nodes:
+            for arg in node.all_input_nodes:
+                last_use[roots[arg]] = node_idx[node]
+                if node.op == "output":
+                    escaping.add(roots[arg])
+
+        buffers = []
+        for node in nodes:
+            if node.op != "call_function" or roots[node] is not node or node in escaping:
+                continue
+            tensor_meta = node.meta.get("tensor_meta")
+            if tensor_meta is None or not hasattr(tensor_meta, "shape") or not _is_contiguous(tensor_meta):
+                continue
+            if out_variant(node.target) is None or node not in last_use:
+                continue
+            buffers.append((node, _node_bytes(node), node_idx[node], last_use[node]))
+
+        # Every dtype has its own arena, so buffers are plain strided views
+        offsets: Dict[fx.Node, int] = {}
+        arena_sizes: Dict[torch.dtype, int] = {}
+        for dtype in {node.meta["tensor_meta"].dtype for node, _, _, _ in buffers}:
+            dtype_offsets, arena_sizes[dtype] = _place([b for b in buffers if b[0].meta["tensor_meta"].dtype == dtype])
+            offsets.update(dtype_offsets)
+        arena_bytes = sum(arena_sizes.values())
+
+        # The peak of the planned buffers when they are allocated separately
+        live = naive_peak_bytes = 0
+        events = sorted([(start, size) for _, size, start, _ in buffers]
+                        + [(end + 0.5, -size) for _, size, _, end in buffers])
+        for _, delta in events:
+            live += delta
+            naive_peak_bytes = max(naive_peak_bytes, live)
+
+        if offsets:
+            first = next(node for node in nodes if node.op != "placeholder")
+            arenas = {}
+            for dtype, size in arena_sizes.items():
+                name = f"{ARENA_NAME_PREFIX}{str(dtype).replace('torch.', '')}"
+                element_size = torch.empty((), dtype=dtype).element_size()
+                fx_module.register_buffer(name, torch.empty(size // element_size, dtype=dtype, device=device),
+                                          persistent=False)
+                with graph.inserting_before(first):
+                    arenas[dtype] = (graph.get_attr(name), element_size)
+            for node, offset in offsets.items():
+                tensor_meta = node.meta["tensor_meta"]
+                arena, element_size = arenas[tensor_meta.dtype]
+                with graph.inserting_before(node):
+                    region = graph.call_function(
+                        torch.ops.aten.as_strided.default,
+                        (arena, list(tensor_meta.shape), list(tensor_meta.stride), offset // element_size),
+                    )
+                    kwargs = dict(node.kwargs)
+                    kwargs["out"] = region
+                    out_node = graph.call_function(out_variant(node.target), node.args, kwargs)
+                out_node.meta = node.meta
+                node.replace_all_uses_with(out_node)
+                graph.erase_node(node)
+            graph.lint()
+            fx_module.recompile()
+
+        plan = MemoryPlan(
+            {node.name: offset for node, offset in offsets.items()},
+            {node.name: size for node, size, _, _ in buffers},
+            arena_bytes,
+            naive_peak_bytes,
+        )
+        phase.graph = fx_module
+        phase.metrics["num_planned"] = plan.num_planned
+        phase.metrics["arena_bytes"] = plan.arena_bytes
+        phase.metrics["naive_peak_bytes"] = plan.naive_peak_bytes
+    fx_module.memory_plan = plan
+    return fx_module
@@ -0,0 +1,138 @@
+"""
+Minimum s-t cut of a flow network, used by the rematerialization partitioner.
+
+The network is stored in integer-indexed arrays, and the maximum flow is found
+with Dinic's algorithm. The returned partition is the same as the one of
+``networkx.minimum_cut``: the sink side holds exactly the nodes that can reach
+the sink in the residual network, which doesn't depend on the maximum flow
+that was found.
+"""
+import math
+from collections import deque
+from typing import List, Set, Tuple, Union
+
+Capacity = Union[int, float]
+
+
+class FlowGraph(object):
+    """
+    A directed graph with edge capacities over the nodes ``0..num_nodes-1``.
+    Capacities may be ``math.inf``.
+    """
+    def __init__(self, num_nodes: int = 0):
+        self.num_nodes = num_nodes
+        # Edge 2i is the i-th added edge, and edge 2i + 1 its reverse edge
+        # in the residual network.
+        self.edge_to: List[int] = []
+        self.edge_cap: List[Capacity] = []
+        self.adj: List[List[int]] = [[] for _ in range(num_nodes)]
+
+    def add_node(self) -> int:
+        self.adj.append([])
+        self.num_nodes += 1
+        return self.num_nodes - 1
+
+    def add_edge(self, u: int, v: int, capacity: Capacity):
+        e = len(self.edge_to)
+        self.edge_to.append(v)
+        self.edge_cap.append(capacity)
+        self.adj[u].append(e)
+        self.edge_to.append(u)
+        self.edge_cap.append(0)
+        self.adj[v].append(e + 1)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.edge_to) // 2
+
+    def _levels(self, cap, source, sink):
+        level = [-1] * self.num_nodes
+        level[source] = 0
+        queue = deque([source])
+        edge_to, adj = self.edge_to, self.adj
+        while queue:
+            u = queue.popleft()
+            for e in adj[u]:
+                v = edge_to[e]
+                if level[v] < 0 and cap[e] > 0:
+                    level[v] = level[u] + 1
+                    queue.append(v)
+        return level if level[sink] >= 0 else None
+
+    def _blocking_flow(self, cap, level, source, sink):
+        edge_to, adj = self.edge_to, self.adj
+        next_edge = [0] * self.num_nodes
+        flow = 0
+        path: List[int] = []
+        u = source
+        while True:
+            if u == sink:
+                pushed = min(cap[e] for e in path)
+                if pushed == math.inf:
+                    raise RuntimeError("Infinite capacity path, flow unbounded above.")
+                for e in path:
+                    cap[e] -= pushed
+                    cap[e ^ 1] += pushed
+                flow += pushed
+                path.clear()
+                u = source
+                continue
+            edges = adj[u]
+            i = next_edge[u]
+            while i < len(edges):
+                e = edges[i]
+                v = edge_to[e]
+                if cap[e] > 0 and level[v] == level[u] + 1:
+                    break
+                i += 1
+            next_edge[u] = i
+            if i < len(edges):
+                path.append(edges[i])
+                u = edge_to[edges[i]]
+            elif not path:
+                return flow
+            else:
+                # Dead end, retreat and skip the edge that led here
+                level[u] = -1
+                e = path.pop()
+                u = edge_to[e ^ 1]
+                next_edge[u] += 1
+
+    def minimum_cut(self, source: int, sink: int) -> Tuple[Capacity, Tuple[Set[int], Set[int]]]:
+        """
+        Returns the value of a minimum cut between :attr:`source` and
+        :attr:`sink`, and the partition of the nodes into its source and sink
+        sides.
+        """
+        cap = list(self.edge_cap)
+        flow = 0
+        while True:
+            level = self._levels(cap, source, sink)
+            if level is None:
+                break
+            flow += self._blocking_flow(cap, level, source, sink)
+
+        # The nodes that can reach the sink in the residual network
+        edge_to, adj = self.edge_to, self.adj
+        reaches_sink = [False] * self.num_nodes
+        reaches_sink[sink] = True
+        queue = deque([sink])
+        while queue:
+            v = queue.popleft()
+            for e in adj[v]:
+                u = edge_to[e]
+                if not reaches_sink[u] and cap[e ^ 1] > 0:
+                    reaches_sink[u] = True
+                    queue.append(u)
+        non_reachable = {u for u in range(self.num_nodes) if reaches_sink[u]}
+        reachable = {u for u in range(self.num_nodes) if not reaches_sink[u]}
+        return flow, (reachable, non_reachable)
+
+    def cut_edges(self, reachable: Set[int]) -> List[Tuple[int, int]]:
+        """Returns the edges from :attr:`reachable` to the other nodes."""
+        cutset = []
+        for u in reachable:
+            for e in self.adj[u]:
+                if e % 2 == 0 and self.edge_to[e] not in reachable:
+                    cutset.append((u, self.edge_to[e]))
+        return cutset
@@ -0,0 +1,258 @@
+"""
+What crosses the boundary between the forward and backward graphs of a
+partitioned joint graph, and how much memory the graphs use.
+
+A :class:`PartitionReport` lists the tensors that the forward graph saves for
+the backward, with the reason the partitioner gave for saving each of them,
+and estimates the memory in use while each graph runs by the liveness of
+the values of its nodes.
+"""
+import operator
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import torch
+import torch.fx as fx
+
+from .partitioners import _is_tensor, _node_size, _tensor_value
+
+
+def _node_bytes(node: fx.Node) -> int:
+    if not _is_tensor(node):
+        return 0
+    return _node_size(node)
+
+
+# Views whose schemas don't annotate that they alias their input
+_unannotated_views = {torch.ops.aten._unsafe_view.default}
+
+
+def _aliased_input(node: fx.Node) -> Optional[fx.Node]:
+    """
+    The input of :attr:`node` whose memory its output shares according to the
+    alias annotations of the schema of its op, e.g. the base of a view, the
+    tensor updated by an in-place op or the ``out`` tensor of an out variant.
+    None if the output is newly allocated.
+    """
+    if node.target in _unannotated_views:
+        return node.args[0]
+    schema = getattr(node.target, "_schema", None)
+    if schema is None:
+        return None
+    returned = [ret.alias_info for ret in schema.returns if ret.alias_info is not None]
+    if not returned:
+        return None
+    # Lists of views (e.g. of split) only annotate their elements
+    alias_sets = set().union(*(info.before_set for info in returned))
+    for i, arg in enumerate(schema.arguments):
+        if arg.alias_info is None or (alias_sets and not alias_sets & arg.alias_info.before_set):
+            continue
+        value = node.args[i] if i < len(node.args) and not arg.kwarg_only else node.kwargs.get(arg.name)
+        if isinstance(value, (list, tuple)):
+            value = next((v for v in value if isinstance(v, fx.Node)), None)
+        if isinstance(value, fx.Node):
+            return value
+    return None
+
+
+def _storage_roots(graph: fx.Graph) -> Dict[fx.Node, fx.Node]:
+    """
+    Maps every node to the node that allocated its memory: views, the results
+    of in-place and out variant ops, and elements of tuples share the memory
+    of their base. Ops without a schema are assumed to allocate theirs, see
+    :func:`_unknown_aliases` for the inputs they might alias.
+    """
+    roots = {}
+    for node in graph.nodes:
+        roots[node] = node
+        if node.op != "call_function":
+            continue
+        if node.target is operator.getitem and isinstance(node.args[0], fx.Node):
+            roots[node] = roots[node.args[0]]
+            continue
+        base = _aliased_input(node)
+        if base is not None:
+            roots[node] = roots[base]
+    return roots
+
+
+def _unknown_aliases(graph: fx.Graph, roots: Dict[fx.Node, fx.Node]) -> Set[fx.Node]:
+    """
+    The roots of the inputs of the nodes of :attr:`graph` whose ops have no
+    schema, e.g. Python functions or modules, whose outputs might alias them.
+    """
+    unknown = set()
+    for node in graph.nodes:
+        if node.op in ("placeholder", "output", "get_attr"):
+            continue
+        if node.op == "call_function" and (node.target is operator.getitem or hasattr(node.target, "_schema")):
+            continue
+        unknown.update(roots[arg] for arg in node.all_input_nodes)
+    return unknown
+
+
+def memory_timeline(graph_module) -> List[Tuple[str, int]]:
+    """
+    Estimates the bytes in use after each node of :attr:`graph_module` runs,
+    from the ``tensor_meta`` of its nodes. Inputs stay alive for the whole
+    graph, since the caller holds them, and intermediates are freed after
+    their last use unless they are outputs. Views share the memory of their
+    base.
+
+    Returns a list of ``(node name, bytes in use)`` pairs, with the bytes in
+    use including the memory allocated by the node before anything is freed.
+    """
+    graph = graph_module.graph if isinstance(graph_module, fx.GraphModule) else graph_module
+    roots = _storage_roots(graph)
+    sizes: Dict[fx.Node, int] = {}
+    last_use: Dict[fx.Node, fx.Node] = {}
+    pinned = set()
+    for node in graph.nodes:
+        root = roots[node]
+        if root is node:
+            sizes[node] = _node_bytes(node)
+        elif node.target is operator.getitem and not _is_tensor(root):
+            # The elements of a tuple are allocated by the op that returns it
+            sizes[root] += _node_bytes(node)
+        if node.op == "placeholder":
+            pinned.add(root)
+        for arg in node.all_input_nodes:
+            if node.op == "output":
+                pinned.add(roots[arg])
+            last_use[roots[arg]] = node
+
+    frees: Dict[fx.Node, List[fx.Node]] = {}
+    for root, user in last_use.items():
+        if root not in pinned:
+            frees.setdefault(user, []).append(root)
+
+    timeline = []
+    live = 0
+    for node in graph.nodes:
+        if roots[node] is node:
+            live += sizes.get(node, 0)
+        timeline.append((node.name, live))
+        for root in frees.get(node, []):
+            live -= sizes.get(root, 0)
+    return timeline
+
+
+def peak_memory(graph_module) -> int:
+    """The largest number of bytes in use in :func:`memory_timeline`."""
+    return max((live for _, live in memory_timeline(graph_module)), default=0)
+
+
+class SavedTensor(object):
+    """
+    A value that the forward graph saves for the backward. :attr:`op` is the
+    target of the node that computes it, or ``"input"``, and :attr:`reason`
+    is why the partitioner saves it rather than recomputing it.
+    """
+    def __init__(self, name: str, op: str, shape: Optional[Tuple[int, ...]], dtype: Optional[torch.dtype],
+                 nbytes: int, reason: str):
+        self.name = name
+        self.op = op
+        self.shape = shape
+        self.dtype = dtype
+        self.nbytes = nbytes
+        self.reason = reason
+
+    def __repr__(self):
+        return (
+            f"SavedTensor(name={self.name!r}, op={self.op!r}, shape={self.shape}, dtype={self.dtype}, "
+            f"nbytes={self.nbytes}, reason={self.reason!r})"
+        )
+
+
+class PartitionReport(object):
+    """
+    The saved tensors of a partitioned joint graph, and the memory timelines
+    (see :func:`memory_timeline`) of its forward and backward graphs. With
+    ``config.memory_planning``, :attr:`fw_memory_plan` and
+    :attr:`bw_memory_plan` are the ``MemoryPlan`` objects of the graphs.
+
+    .. warning::
+        This API is experimental and likely to change.
+    """
+    fw_memory_plan = None
+    bw_memory_plan = None
+
+    def __init__(self, saved_tensors: List[SavedTensor], fw_timeline: List[Tuple[str, int]],
+                 bw_timeline: List[Tuple[str, int]]):
+        self.saved_tensors = saved_tensors
+        self.fw_timeline = fw_timeline
+        self.bw_timeline = bw_timeline
+
+    @classmethod
+    def from_modules(cls, fw_module: fx.GraphModule, bw_module: fx.GraphModule, num_outs: int) -> "PartitionReport":
+        """
+        Creates the report of the forward and backward graphs returned by a
+        partitioner. The forward graph returns :attr:`num_outs` outputs,
+        followed by the saved values.
+        """
+        output = next(node for node in fw_module.graph.nodes if node.op == "output")
+        saved_tensors = []
+        for node in list(output.args[0])[num_outs:]:
+            if not isinstance(node, fx.Node):
+                continue
+            # Offloaded values are saved through a call to the offloader
+            if node.op == "call_method" and node.target == "offload":
+                node = node.args[1]
+            tensor_meta = _tensor_value(node)
+            has_meta = hasattr(tensor_meta, "shape")
+            saved_tensors.append(SavedTensor(
+                name=node.name,
+                op="input" if node.op == "placeholder" else str(node.target),
+                shape=tuple(tensor_meta.shape) if has_meta else None,
+                dtype=tensor_meta.dtype if has_meta else None,
+                nbytes=_node_bytes(node),
+                reason=node.meta.get("partition_reason", "unknown"),
+            ))
+        return cls(saved_tensors, memory_timeline(fw_module), memory_timeline(bw_module))
+
+    @property
+    def num_saved(self) -> int:
+        return len(self.saved_tensors)
+
+    @property
+    def saved_bytes(self) -> int:
+        return sum(saved.nbytes for saved in self.saved_tensors)
+
+    @property
+    def fw_peak_memory(self) -> int:
+        return max((live for _, live in self.fw_timeline), default=0)
+
+    @property
+    def bw_peak_memory(self) -> int:
+        return max((live for _, live in self.bw_timeline), default=0)
+
+    def summary(self) -> Dict[str, Any]:
+        summary = {
+            "num_saved": self.num_saved,
+            "saved_bytes": self.saved_bytes,
+            "fw_peak_memory": self.fw_peak_memory,
+            "bw_peak_memory": self.bw_peak_memory,
+        }
+        for graph, plan in (("fw", self.fw_memory_plan), ("bw", self.bw_memory_plan)):
+            if plan is not None:
+                summary[f"{graph}_arena_bytes"] = plan.arena_bytes
+                summary[f"{graph}_naive_peak_bytes"] = plan.naive_peak_bytes
+        return summary
+
+    def __str__(self):
+        rows = [("name", "op", "shape", "dtype", "bytes", "reason")]
+        for saved in self.saved_tensors:
+            rows.append((saved.name, saved.op, str(list(saved.shape)) if saved.shape is not None else "?",
+                         str(saved.dtype).replace("torch.", ""), str(saved.nbytes), saved.reason))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = ["  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows]
+        lines.append(
+            f"{self.num_saved} saved tensors, {self.saved_bytes} bytes; estimated peak memory: "
+            f"forward {self.fw_peak_memory} bytes, backward {self.bw_peak_memory} bytes"
+        )
+        for graph, plan in (("forward", self.fw_memory_plan), ("backward", self.bw_memory_plan)):
+            if plan is not None:
+                lines.append(
+                    f"{graph} memory plan: {plan.num_planned} buffers in a {plan.arena_bytes} byte arena, "
+                    f"{plan.naive_peak_bytes} bytes at peak and {plan.total_bytes} bytes in total unplanned"
+                )
+        return "\n".join(lines)
@@ -5,9 +5,28 @@ import math
 import torch.utils._pytree as pytree
 import copy
 import os
+import threading
+import warnings
+from collections import OrderedDict
 from torch.fx.passes import graph_drawer
-from typing import Tuple
-from .compile_utils import fx_graph_cse, get_aten_target
+from typing import Dict, Optional, Tuple
+from . import config
+from .compile_utils import fx_graph_cse, get_aten_target, graph_hash, rand_ops
+from .compile_profiler import compile_phase
+from .min_cut import FlowGraph
+from .backend_profiles import (  # noqa: F401
+    BackendProfile,
+    compute_intensive_ops,
+    fusible_ops,
+    misc_ops,
+    nvfuser_profile,
+    pointwise_ops,
+    random_ops,
+    recomputable_ops,
+    reduction_ops,
+    unrecomputable_ops,
+    view_ops,
+)
 
 
 class InvalidNodeBase(object):
@@ -86,6 +105,11 @@ def _extract_fwd_bwd_outputs(joint_module: fx.GraphModule):
     return fwd_outputs, bwd_outputs
 
 
+def _set_saved_reason(node, reason):
+    """Records why the partitioner saves :attr:`node`, for the partition report."""
+    node.meta["partition_reason"] = reason
+
+
 def _extract_fwd_bwd_modules(joint_module: fx.GraphModule, saved_values):
     fwd_outputs, bwd_outputs = _extract_fwd_bwd_outputs(joint_module)
     primal_inputs = list(filter(_is_primal, joint_module.graph.nodes))
@@ -147,14 +171,17 @@ def default_partition(
         if node.name not in forward_node_names:
             continue
         # Since we can't save tuple of tensor values, we need to flatten out what we're saving
-        if 'tensor_meta' not in node.meta and node.op == 'call_function':
+        if not _is_tensor(node) and node.op == 'call_function':
             users = node.users
             assert all(user.target == operator.getitem for user in users)
             for user in users:
                 saved_values.append(user)
         else:
             saved_values.append(node)
-    saved_values = list(set(saved_values))
+    # Keep the order of the graph, so that identical graphs are partitioned identically
+    saved_values = list(dict.fromkeys(saved_values))
+    for node in saved_values:
+        _set_saved_reason(node, "input" if node.op == 'placeholder' else "forward value")
 
     return _extract_fwd_bwd_modules(joint_module, saved_values)
 
@@ -166,29 +193,133 @@ def _prod(x):
     return s
 
 
-def _size_of(metadata):
-    sizes = {
-        torch.float: 4,
-        torch.float16: 2,
-        torch.bfloat16: 2,
-        torch.float32: 4,
-        torch.float64: 8,
-        torch.int: 4,
-        torch.int8: 1,
-        torch.int16: 2,
-        torch.int32: 4,
-        torch.int64: 8,
-        torch.uint8: 1,
-        torch.bool: 1,
-    }
+# Bytes per element of the dtypes that torch.empty can't create. Sub-byte
+# types pack several elements in a byte.
+_quantized_element_sizes = {
+    torch.quint8: 1,
+    torch.qint8: 1,
+    torch.qint32: 4,
+    torch.quint4x2: 0.5,
+}
+if hasattr(torch, "quint2x4"):
+    _quantized_element_sizes[torch.quint2x4] = 0.25
+_element_sizes: Dict[torch.dtype, float] = {}
+
+# The size assumed for dimensions of symbolic shapes without a known value
+SYMBOLIC_DIM_HINT = 1024
+
+
+def _element_size(dtype: torch.dtype) -> float:
+    if dtype not in _element_sizes:
+        if dtype in _quantized_element_sizes:
+            size = _quantized_element_sizes[dtype]
+        elif hasattr(dtype, "itemsize"):
+            size = dtype.itemsize
+        else:
+            size = torch.empty((), dtype=dtype).element_size()
+        _element_sizes[dtype] = size
+    return _element_sizes[dtype]
+
+
+def _concrete_dim(dim) -> int:
+    """The value of a dimension of a shape, or a guess if it is symbolic."""
+    if isinstance(dim, int):
+        return dim
+    hint = getattr(getattr(dim, "node", None), "hint", None)
+    if isinstance(hint, int):
+        return hint
+    try:
+        return int(dim)
+    except (TypeError, ValueError, RuntimeError):
+        return SYMBOLIC_DIM_HINT
+
+
+def _numel(shape) -> int:
+    return _prod(_concrete_dim(dim) for dim in shape)
+
+
+def _size_of(metadata) -> int:
+    """
+    The bytes of a tensor described by :attr:`metadata`, a ``TensorMetadata``,
+    a tensor (e.g. a fake tensor) or a tuple of them, for ops returning
+    several tensors. Symbolic dimensions are counted as their hint, or
+    :data:`SYMBOLIC_DIM_HINT` if they don't have one.
+    """
+    if isinstance(metadata, (list, tuple)) and not hasattr(metadata, "shape"):
+        return sum(_size_of(m) for m in metadata if hasattr(m, "shape"))
+    return int(math.ceil(_numel(metadata.shape) * _element_size(metadata.dtype)))
+
+
+def _tensor_value(node: fx.Node):
+    """
+    The metadata of the value of :attr:`node`: its ``tensor_meta``, or for
+    graphs traced with fake tensors its ``val``. Tuples of tensors are
+    returned as tuples. None if the value isn't made of tensors.
+    """
+    value = node.meta.get("tensor_meta")
+    if value is None:
+        value = node.meta.get("val")
+    if hasattr(value, "shape"):
+        return value
+    if isinstance(value, (list, tuple)) and value and all(hasattr(v, "shape") for v in value):
+        return tuple(value)
+    return None
+
+
+def _is_tensor(node: fx.Node) -> bool:
+    """Whether :attr:`node` is a single tensor, i.e. can be saved for the backward."""
+    return hasattr(_tensor_value(node), "shape")
+
 
-    numel = _prod(metadata.shape)
-    dtype = metadata.dtype
+def _node_size(node: fx.Node) -> Optional[int]:
+    """The bytes of the tensor, or tuple of tensors, of :attr:`node`, or None for other values."""
+    value = _tensor_value(node)
+    return None if value is None else _size_of(value)
 
-    if dtype not in sizes:
-        raise NotImplementedError("Don't know the size of dtype ", dtype)
 
-    return numel * sizes[dtype]
+# The cuts of min_cut_rematerialization_partition, as the indices of the saved
+# nodes, by the structure of the joint graph and the partitioner settings.
+_PARTITION_CACHE_CAPACITY = 256
+_partition_cache: "OrderedDict[Tuple, Tuple[int, ...]]" = OrderedDict()
+_partition_cache_counts = {"hits": 0, "misses": 0}
+_partition_cache_lock = threading.Lock()
+
+
+def _partition_cache_key(graph, profile, cost_model):
+    profile_key = (
+        profile.name, profile.fusible_ops, profile.recomputable_ops, profile.banned_ops, profile.reduction_ops,
+        frozenset(profile.op_costs.items()),
+    )
+    # The repr of a cost model rounds its fields, so key on their exact values
+    cost_model_key = None
+    if cost_model is not None:
+        cost_model_key = (type(cost_model), tuple(sorted((k, repr(v)) for k, v in vars(cost_model).items())))
+    return (graph_hash(graph, abstract_shapes=True), profile_key, cost_model_key)
+
+
+def partition_cache_stats() -> Dict[str, float]:
+    """
+    Returns the counters of the cache of the cuts of
+    :func:`min_cut_rematerialization_partition` since it was last cleared:
+    the number of ``hits`` and ``misses``, the ``hit_rate`` and the current
+    number of entries as ``size``.
+    """
+    with _partition_cache_lock:
+        hits, misses = _partition_cache_counts["hits"], _partition_cache_counts["misses"]
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "size": len(_partition_cache),
+        }
+
+
+def clear_partition_cache():
+    """Clears the cache of the cuts of :func:`min_cut_rematerialization_partition`, and its counters."""
+    with _partition_cache_lock:
+        _partition_cache.clear()
+        _partition_cache_counts["hits"] = 0
+        _partition_cache_counts["misses"] = 0
 
 
 # Used for some investigative purposes
@@ -202,7 +333,7 @@ def _count_ops(graph):
 
 
 def min_cut_rematerialization_partition(
-    joint_module: fx.GraphModule, _joint_inputs
+    joint_module: fx.GraphModule, _joint_inputs, cost_model=None, backend_profile: Optional[BackendProfile] = None
 ) -> Tuple[fx.GraphModule, fx.GraphModule]:
     """
     Partitions the joint graph such that the backward recomputes the forward.
@@ -218,21 +349,26 @@ def min_cut_rematerialization_partition(
     Args:
         joint_module(fx.GraphModule): The joint forward and backward graph. This
             is the result of AOT Autograd tracing.
+        cost_model(Optional[CostModel]): Decides which forward ops may be
+            recomputed by comparing their estimated recomputation time with
+            the time to save their output, instead of using fixed op lists.
+            Default: None
+        backend_profile(Optional[BackendProfile]): The ops that the
+            compilers of the graphs can fuse and recompute. Default:
+            ``nvfuser_profile``
 
     Returns:
         Returns the generated forward and backward Fx graph modules.
     """
-    try:
-        import networkx as nx
-    except ImportError:
-        raise RuntimeError("Need networkx installed to perform smart recomputation heuristics")
-
+    profile = backend_profile if backend_profile is not None else nvfuser_profile
     joint_module.graph.eliminate_dead_code()
     joint_module.recompile()
     fx_g = joint_module.graph
 
     #  add the CSE pass
-    cse_graph = fx_graph_cse(fx_g)
+    with compile_phase("fx_graph_cse", fx_g) as phase:
+        cse_graph = fx_graph_cse(fx_g)
+        phase.graph = cse_graph
     joint_module.graph = cse_graph
     full_bw_graph = joint_module.graph
 
@@ -267,53 +403,30 @@ def min_cut_rematerialization_partition(
             for user in node.users:
                 node.dist_from_bw = min(node.dist_from_bw, user.dist_from_bw + 1)
 
-    aten = torch.ops.aten
-
-    pointwise_ops = [aten.add, aten.sub, aten.div, aten.atan2, aten.mul, aten.max, aten.min, aten.pow, aten.remainder, aten.fmod, aten.__and__, aten.__or__, aten.__xor__, aten.__lshift__, aten.__rshift__, aten.eq, aten.ne, aten.ge, aten.gt, aten.le, aten.lt, aten.abs, aten.bitwise_not, aten.ceil, aten.floor, aten.frac, aten.neg, aten.relu, aten.round, aten.silu, aten.trunc, aten.log, aten.log10, aten.log1p, aten.log2, aten.lgamma, aten.exp, aten.expm1, aten.erf, aten.erfc, aten.cos, aten.acos, aten.cosh, aten.sin, aten.asin, aten.sinh, aten.tan, aten.atan, aten.tanh, aten.atanh, aten.sqrt, aten.rsqrt, aten.reciprocal, aten.sigmoid, aten.softplus, aten.threshold, aten.threshold_backward, aten.clamp, aten.where, aten.lerp, aten.addcmul, aten.gelu, aten.gelu_backward]  # noqa: E501
-    misc_ops = [aten.to, aten.type_as, operator.getitem]
-
-    reduction_ops = [aten.softmax, aten._softmax, aten._softmax_backward_data, aten.sum, aten.mean, aten._grad_sum_to_size, aten.sum_to_size, aten.amax]  # noqa: E501
-
-    # not recomputed by default since these are kinda expensive/hard to fuse into
-    # norm_ops = [aten.instance_norm, aten._batch_norm_impl_index, aten.native_batch_norm, aten.batch_norm, aten._batch_norm_impl_index_backward, aten.native_layer_norm, aten.layer_norm, aten.native_layer_norm_backward]  # noqa: E501
-
-    # Not used by default since NVFuser can't fuse view ops
-    # view_ops = [aten.expand, aten.clone, aten.transpose, aten.t, aten.view, aten._unsafe_view, aten.permute, aten.transpose, aten.t, aten._reshape_alias, aten.squeeze, aten.unsqueeze, aten.reshape, aten.cat, aten.slice, aten.split, aten.select, aten.repeat]  # noqa: E501
-
-    # These are the view ops that NVFuser can fuse
-    view_ops = [aten.squeeze, aten.unsqueeze]
-    random_ops = [aten.native_dropout, aten.rand_like, aten.randn_like]
-    compute_intensive_ops = [aten.mm, aten.convolution, aten.convolution_backward, aten.bmm, aten.addmm, aten.upsample_bilinear2d]  # noqa: E501
-    unrecomputable_ops = random_ops + compute_intensive_ops
-
-    recomputable_ops = set(
-        pointwise_ops
-        + misc_ops
-        + reduction_ops
-        + view_ops
-    )
-    fusible_ops = recomputable_ops | set(random_ops)
-
     AGGRESSIVE_RECOMPUTATION = False
 
     def ban_recomputation(node):
+        if node.op != 'call_function':
+            return False
+        if profile.is_banned(node):
+            return True
+        if cost_model is not None:
+            return cost_model.ban_recomputation(node, cost_factor=profile.cost_factor(node))
         if AGGRESSIVE_RECOMPUTATION:
-            return (node.op == 'call_function' and get_aten_target(node) in unrecomputable_ops)
+            return get_aten_target(node) in compute_intensive_ops
         else:
-            if node.op != 'call_function':
-                return False
-            if get_aten_target(node) not in recomputable_ops:
+            if not profile.is_recomputable(node):
                 return True
             # If the output of the reduction is 4x smaller (arbitrary choice),
             # then we don't allow recomputation.
-            if get_aten_target(node) in reduction_ops:
-                input_tensors_size = sum(_size_of(i.meta['tensor_meta']) for i in node.args if isinstance(i, fx.Node))
-                output_size = _size_of(node.meta['tensor_meta'])
+            if profile.is_reduction(node):
+                input_tensors_size = sum(_node_size(i) or 0 for i in node.args if isinstance(i, fx.Node))
+                output_size = _node_size(node) or 0
                 return (output_size * 4 < input_tensors_size)
             return False
 
     def is_fusible(a, b):
-        return get_aten_target(a) in fusible_ops and get_aten_target(b) in fusible_ops
+        return profile.is_fusible(a) and profile.is_fusible(b)
 
     def is_materialized(node):
         if node.op == 'placeholder':
@@ -322,7 +435,7 @@ def min_cut_rematerialization_partition(
         return not all(is_fusible(node, user) for user in node.users)
 
     def get_node_weight(node):
-        mem_sz = _size_of(node.meta['tensor_meta'])
+        mem_sz = _node_size(node)
 
         # Heuristic to bias towards nodes closer to the backwards pass
         mem_sz = int(mem_sz + node.dist_from_bw)
@@ -332,52 +445,479 @@ def min_cut_rematerialization_partition(
         else:
             return mem_sz * 2
 
-    nx_graph = nx.DiGraph()
-    for node in full_bw_graph.nodes:
-        if node.op == 'output':
-            continue
+    # Graphs traced again for new sizes, e.g. for a new batch size, reuse the
+    # cut of the first graph with the same structure. It is still a valid
+    # partition, if not always the one that saves the fewest bytes.
+    nodes = list(full_bw_graph.nodes)
+    cache_key = None
+    cut_indices = None
+    if config.cache_partitions:
+        with compile_phase("partition_cache") as phase:
+            cache_key = _partition_cache_key(full_bw_graph, profile, cost_model)
+            with _partition_cache_lock:
+                cut_indices = _partition_cache.get(cache_key)
+                if cut_indices is not None:
+                    _partition_cache.move_to_end(cache_key)
+                    _partition_cache_counts["hits"] += 1
+                else:
+                    _partition_cache_counts["misses"] += 1
+            phase.metrics["hit"] = cut_indices is not None
+
+    if cut_indices is not None:
+        cut_nodes = {nodes[idx].name for idx in cut_indices}
+    else:
+        # Every node of the joint graph is split into an "in" and an "out" node of
+        # the flow network, connected by an edge weighted with its size. Cutting
+        # that edge means saving the node for the backward.
+        node_ids = {node: 2 * i + 2 for i, node in enumerate(nodes)}
+        source, sink = 0, 1
+        flow_graph = FlowGraph(2 * len(nodes) + 2)
+        for node in nodes:
+            if node.op == 'output':
+                continue
+            node_in = node_ids[node]
+            node_out = node_in + 1
 
-        if node in required_bw_nodes:
-            nx_graph.add_edge(node.name + "_in", "sink", capacity=math.inf)
-            continue
+            if node in required_bw_nodes:
+                flow_graph.add_edge(node_in, sink, math.inf)
+                continue
+
+            if node.op == 'placeholder' and "primals" in node.target:
+                flow_graph.add_edge(source, node_in, math.inf)
+
+            # If a node can't be recomputed (too expensive or involves randomness),
+            # we prevent it from being recomputed by adding an inf edge to the source
+            # We only need to ban nodes in the fw pass, as those are the only ones that would be recomputed.
+            if ban_recomputation(node) and node in required_fw_nodes:
+                flow_graph.add_edge(source, node_in, math.inf)
+
+            # Only tensors can be saved, not tuples of them or other values
+            if not _is_tensor(node):
+                weight = math.inf
+            else:
+                weight = get_node_weight(node)
 
-        if node.op == 'placeholder' and "primals" in node.target:
-            nx_graph.add_edge("source", node.name + "_in", capacity=math.inf)
+            # Creates the weights on the "node" edge
+            flow_graph.add_edge(node_in, node_out, weight)
+            for user in node.users:
+                flow_graph.add_edge(node_out, node_ids[user], math.inf)
+
+        with compile_phase("min_cut") as phase:
+            cut_value, partition = flow_graph.minimum_cut(source, sink)
+            phase.metrics["flow_graph_nodes"] = flow_graph.num_nodes
+            phase.metrics["flow_graph_edges"] = flow_graph.num_edges
+        reachable, non_reachable = partition
+        cutset = flow_graph.cut_edges(reachable)
+
+        cut_nodes = set()
+        for node_in, node_out in cutset:
+            assert node_in % 2 == 0 and node_out == node_in + 1
+            cut_nodes.add(nodes[node_in // 2 - 1].name)
+
+        if cache_key is not None:
+            node_idx = {node: idx for idx, node in enumerate(nodes)}
+            with _partition_cache_lock:
+                _partition_cache[cache_key] = tuple(sorted(node_idx[name_to_node[name]] for name in cut_nodes))
+                while len(_partition_cache) > _PARTITION_CACHE_CAPACITY:
+                    _partition_cache.popitem(last=False)
+
+    # To make this stuff deterministic
+    node_idx = {node: idx for idx, node in enumerate(joint_module.graph.nodes)}
+    saved_values = sorted((name_to_node[node] for node in cut_nodes), key=lambda x: node_idx[x])
+    for node in saved_values:
+        if node.op == 'placeholder':
+            _set_saved_reason(node, "input")
+        elif ban_recomputation(node):
+            _set_saved_reason(node, "recomputation banned")
+        else:
+            _set_saved_reason(node, "min-cut")
+    return _extract_fwd_bwd_modules(joint_module, saved_values)
 
-        # If a node can't be recomputed (too expensive or involves randomness),
-        # we prevent it from being recomputed by adding an inf edge to the source
-        # We only need to ban nodes in the fw pass, as those are the only ones that would be recomputed.
-        if ban_recomputation(node) and node in required_fw_nodes:
-            nx_graph.add_edge("source", node.name + "_in", capacity=math.inf)
 
-        if 'tensor_meta' not in node.meta:
-            weight = math.inf
+def _saved_forward_values(bwd_outputs, forward_node_names):
+    """
+    The forward values that the backward outputs depend on, as in
+    :func:`default_partition`. Tuples can't be saved, so their elements are.
+    """
+    saved = set()
+    needed = set()
+    stack = [node for node in bwd_outputs if isinstance(node, fx.Node)]
+    while stack:
+        node = stack.pop()
+        if node in needed:
+            continue
+        needed.add(node)
+        if node.name in forward_node_names and _is_tensor(node):
+            saved.add(node)
+        elif node.name in forward_node_names and node.op == 'call_function':
+            saved.update(user for user in node.users if user in needed)
         else:
-            weight = get_node_weight(node)
+            stack.extend(node.all_input_nodes)
+    return saved
 
-        # Creates the weights on the "node" edge
-        nx_graph.add_edge(node.name + "_in", node.name + "_out", capacity=weight)
-        for user in node.users:
-            nx_graph.add_edge(node.name + "_out", user.name + "_in", capacity=math.inf)
 
-    cut_value, partition = nx.minimum_cut(nx_graph, "source", "sink")
-    reachable, non_reachable = partition
-    cutset = set()
-    for u, nbrs in ((n, nx_graph[n]) for n in reachable):
-        cutset.update((u, v) for v in nbrs if v in non_reachable)
+def _is_recomputable(node, cost_model=None, profile=nvfuser_profile):
+    if profile.is_banned(node):
+        return False
+    if cost_model is not None:
+        return (node.op == 'call_function' and get_aten_target(node) not in rand_ops
+                and cost_model.recompute_time(node) is not None)
+    return profile.is_recomputable(node)
 
-    cut_nodes = set()
-    for node_in, node_out in cutset:
-        assert node_in[:-3] == node_out[:-4]
-        node_name = node_in[:-3]
-        cut_nodes.add(node_name)
+
+def _recompute_cost(node, cost_model=None, profile=nvfuser_profile):
+    """
+    A rough estimate of the work needed to recompute :attr:`node`: the
+    estimated time of :attr:`cost_model`, or the number of elements it reads
+    and writes, scaled by the cost factor of its op in :attr:`profile`.
+    """
+    if cost_model is not None:
+        return cost_model.recompute_time(node) * profile.cost_factor(node)
+    cost = _numel(_tensor_value(node).shape)
+    for arg in node.all_input_nodes:
+        if _is_tensor(arg):
+            cost += _numel(_tensor_value(arg).shape)
+    return cost * profile.cost_factor(node)
+
+
+def memory_budget_partition(
+    joint_module: fx.GraphModule, _joint_inputs, memory_budget: Optional[int] = None, cost_model=None,
+    backend_profile: Optional[BackendProfile] = None,
+) -> Tuple[fx.GraphModule, fx.GraphModule]:
+    """
+    Partitions the joint graph such that the tensors saved for the backward
+    fit in :attr:`memory_budget` bytes, recomputing as little as possible.
+
+    Starting from the partition of :func:`default_partition`, which recomputes
+    nothing, saved tensors are repeatedly replaced by the inputs they are
+    computed from, and recomputed in the backward. Every step picks the saved
+    tensor that frees the most bytes per unit of estimated recomputation
+    work, until the saved tensors fit in the budget. Only the ops that
+    :func:`min_cut_rematerialization_partition` would recompute are
+    considered, or with a :attr:`cost_model`, all the ops it can estimate
+    except random ones. If the budget can't be met this way, the partition of
+    :func:`min_cut_rematerialization_partition` is used instead. Its cut
+    weighs the saved bytes against the cost of recomputing ops rather than
+    minimizing the bytes, so it may not meet the budget either, in which
+    case a warning is issued.
+
+    Use it with ``functools.partial`` to set the budget, e.g.
+    ``partial(memory_budget_partition, memory_budget=2 * 1024 ** 3)``.
+
+    .. warning::
+        This API is experimental and likely to change.
+
+    Args:
+        joint_module(fx.GraphModule): The joint forward and backward graph. This
+            is the result of AOT Autograd tracing.
+        memory_budget(Optional[int]): The maximum number of bytes of saved
+            tensors. Default: None (no limit, i.e. recompute nothing)
+        cost_model(Optional[CostModel]): Estimates the time to recompute ops,
+            and which ops can be recomputed. Default: None
+        backend_profile(Optional[BackendProfile]): The ops that the
+            compilers of the graphs can recompute, and their relative
+            recomputation costs. Default: ``nvfuser_profile``
+
+    Returns:
+        Returns the generated forward and backward Fx graph modules.
+    """
+    profile = backend_profile if backend_profile is not None else nvfuser_profile
+    joint_module.graph.eliminate_dead_code()
+    joint_module.recompile()
+
+    primal_inputs = list(filter(_is_primal, joint_module.graph.nodes))
+    fwd_outputs, bwd_outputs = _extract_fwd_bwd_outputs(joint_module)
+    forward_only_graph = _extract_graph_with_inputs_outputs(joint_module.graph, primal_inputs, fwd_outputs)
+    forward_node_names = {node.name for node in forward_only_graph.nodes if node.op != 'output'}
+
+    def is_saveable(node):
+        return node.name in forward_node_names and _is_tensor(node)
+
+    saved = _saved_forward_values(bwd_outputs, forward_node_names)
+
+    def size_of(node):
+        return _node_size(node)
+
+    saved_bytes = sum(size_of(node) for node in saved)
+    recompute_cost = 0
+    with compile_phase("memory_budget") as phase:
+        while memory_budget is not None and saved_bytes > memory_budget:
+            best, best_score, best_freed = None, 0, 0
+            for node in saved:
+                if not _is_recomputable(node, cost_model, profile):
+                    continue
+                inputs = node.all_input_nodes
+                if not all(is_saveable(arg) for arg in inputs):
+                    continue
+                freed = size_of(node) - sum(size_of(arg) for arg in set(inputs) if arg not in saved)
+                if freed <= 0:
+                    continue
+                cost = _recompute_cost(node, cost_model, profile)
+                score = freed / cost if cost > 0 else math.inf
+                if score > best_score:
+                    best, best_score, best_freed = node, score, freed
+            if best is None:
+                break
+            saved.remove(best)
+            saved.update(best.all_input_nodes)
+            saved_bytes -= best_freed
+            recompute_cost += _recompute_cost(best, cost_model, profile)
+        phase.metrics["budget_saved_bytes"] = saved_bytes
+        phase.metrics["recompute_cost"] = recompute_cost
+
+    if memory_budget is not None and saved_bytes > memory_budget:
+        fw_module, bw_module = min_cut_rematerialization_partition(
+            joint_module, _joint_inputs, cost_model=cost_model, backend_profile=backend_profile
+        )
+        min_cut_saved_bytes = sum(
+            _node_size(node) or 0 for node in bw_module.graph.nodes if _is_primal(node)
+        )
+        if min_cut_saved_bytes > memory_budget:
+            warnings.warn(
+                f"memory_budget_partition saves {min_cut_saved_bytes} bytes for the backward, "
+                f"which exceeds the memory budget of {memory_budget} bytes"
+            )
+        return fw_module, bw_module
 
     # To make this stuff deterministic
     node_idx = {node: idx for idx, node in enumerate(joint_module.graph.nodes)}
-    saved_values = sorted((name_to_node[node] for node in cut_nodes), key=lambda x: node_idx[x])
+    saved_values = sorted(saved, key=lambda x: node_idx[x])
+    for node in saved_values:
+        if node.op == 'placeholder':
+            _set_saved_reason(node, "input")
+        elif not _is_recomputable(node, cost_model, profile):
+            _set_saved_reason(node, "not recomputable")
+        else:
+            _set_saved_reason(node, "within memory budget")
     return _extract_fwd_bwd_modules(joint_module, saved_values)
 
 
+_offload_streams = {}
+
+
+def _offload_stream(device):
+    if device not in _offload_streams:
+        _offload_streams[device] = torch.cuda.Stream(device)
+    return _offload_streams[device]
+
+
+class HostOffloader(torch.nn.Module):
+    """
+    Moves saved tensors to pinned host memory in the forward, and back to
+    their device in the backward, for :func:`activation_offload_partition`.
+    The copies are issued on a side CUDA stream, so they overlap with the
+    computation. Tensors that already are in host memory are left as they
+    are.
+
+    A forward graph calls :meth:`offload` on the saved tensors. A backward
+    graph calls :meth:`prefetch` on all of them first, and :meth:`wait`
+    before the first use of each. Subclass it to move tensors elsewhere.
+
+    .. warning::
+        This API is experimental and likely to change.
+    """
+    def offload(self, tensor):
+        if not tensor.is_cuda:
+            return tensor
+        stream = _offload_stream(tensor.device)
+        stream.wait_stream(torch.cuda.current_stream(tensor.device))
+        with torch.cuda.stream(stream):
+            host = torch.empty_strided(tensor.size(), tensor.stride(), dtype=tensor.dtype, pin_memory=True)
+            host.copy_(tensor, non_blocking=True)
+        tensor.record_stream(stream)
+        return host
+
+    def prefetch(self, tensor, device):
+        if device.type != "cuda" or tensor.device == device:
+            return tensor
+        with torch.cuda.stream(_offload_stream(device)):
+            return tensor.to(device, non_blocking=True)
+
+    def wait(self, tensor):
+        if tensor.is_cuda and tensor.device in _offload_streams:
+            current = torch.cuda.current_stream(tensor.device)
+            current.wait_stream(_offload_streams[tensor.device])
+            tensor.record_stream(current)
+        return tensor
+
+
+_host_offloader = HostOffloader()
+
+
+def _node_devices(joint_module: fx.GraphModule, joint_inputs) -> Dict[str, torch.device]:
+    """
+    The devices of the values of the nodes of :attr:`joint_module`, by name:
+    the devices of the :attr:`joint_inputs` for placeholders, the ``device``
+    argument of ops that have one, and otherwise the device of the first
+    tensor input of the op.
+    """
+    flat_inputs = pytree.tree_flatten(joint_inputs)[0]
+    default = next((x.device for x in flat_inputs if isinstance(x, torch.Tensor)), torch.device("cpu"))
+    devices = {}
+    placeholders = (node for node in joint_module.graph.nodes if node.op == 'placeholder')
+    for node, value in zip(placeholders, flat_inputs):
+        if isinstance(value, torch.Tensor):
+            devices[node.name] = value.device
+    for node in joint_module.graph.nodes:
+        if node.name in devices:
+            continue
+        val = node.meta.get("val")
+        if isinstance(val, torch.Tensor):
+            devices[node.name] = val.device
+        elif node.kwargs.get("device") is not None:
+            devices[node.name] = torch.device(node.kwargs["device"])
+        else:
+            devices[node.name] = next(
+                (devices[arg.name] for arg in node.all_input_nodes if arg.name in devices), default
+            )
+    return devices
+
+
+def _insert_offloads(fwd_module, bwd_module, offloaded_names, num_fwd_outputs, offloader, devices):
+    """
+    Offloads the saved values named :attr:`offloaded_names` at the end of
+    :attr:`fwd_module`, and prefetches them at the start of :attr:`bwd_module`
+    to their :attr:`devices`.
+    """
+    fwd_graph = fwd_module.graph
+    output = next(node for node in fwd_graph.nodes if node.op == 'output')
+    outputs = list(output.args[0])
+    fwd_module._offloader = offloader
+    with fwd_graph.inserting_before(output):
+        offloader_node = fwd_graph.get_attr("_offloader")
+        for i in range(num_fwd_outputs, len(outputs)):
+            if outputs[i].name in offloaded_names:
+                outputs[i] = fwd_graph.call_method("offload", (offloader_node, outputs[i]))
+    output.args = (outputs,)
+
+    bwd_graph = bwd_module.graph
+    placeholders = [node for node in bwd_graph.nodes if node.op == 'placeholder']
+    offloaded = [node for node in placeholders if node.name in offloaded_names]
+    bwd_module._offloader = offloader
+    prefetched = {}
+    with bwd_graph.inserting_after(placeholders[-1]):
+        offloader_node = bwd_graph.get_attr("_offloader")
+    with bwd_graph.inserting_after(offloader_node):
+        for node in reversed(offloaded):
+            prefetched[node] = bwd_graph.call_method("prefetch", (offloader_node, node, devices[node.name]))
+    node_idx = {node: idx for idx, node in enumerate(bwd_graph.nodes)}
+    for node, prefetch in prefetched.items():
+        users = [user for user in node.users if user is not prefetch]
+        first_user = min(users, key=lambda user: node_idx[user])
+        with bwd_graph.inserting_before(first_user):
+            ready = bwd_graph.call_method("wait", (offloader_node, prefetch))
+        for user in users:
+            user.replace_input_with(node, ready)
+
+    for module in (fwd_module, bwd_module):
+        module.graph.lint()
+        module.recompile()
+
+
+def activation_offload_partition(
+    joint_module: fx.GraphModule, _joint_inputs, min_offload_bytes: int = 1 << 20, cost_model=None, offloader=None,
+    backend_profile: Optional[BackendProfile] = None,
+) -> Tuple[fx.GraphModule, fx.GraphModule]:
+    """
+    Partitions the joint graph such that large saved tensors are kept in host
+    memory between the forward and the backward, instead of in device memory.
+
+    Starting from the tensors that :func:`default_partition` saves, each
+    intermediate tensor of at least :attr:`min_offload_bytes`, largest first,
+    is either recomputed in the backward from the inputs it is computed from,
+    or offloaded: copied to pinned host memory at the end of the forward and
+    prefetched at the start of the backward, asynchronously. Whichever the
+    :attr:`cost_model` estimates to be faster is chosen. Smaller tensors and
+    the inputs stay on the device.
+
+    Offloading is done by :attr:`offloader` objects called from the
+    generated graphs, so use it with compilers that run Python code, e.g.
+    :func:`nop`.
+
+    .. warning::
+        This API is experimental and likely to change.
+
+    Args:
+        joint_module(fx.GraphModule): The joint forward and backward graph. This
+            is the result of AOT Autograd tracing.
+        min_offload_bytes(int): The size of the smallest tensor to offload or
+            recompute. Default: 1 MiB
+        cost_model(Optional[CostModel]): Estimates the time to recompute and
+            to offload tensors. Default: ``CostModel()``
+        offloader(Optional[HostOffloader]): Copies tensors between host and
+            device memory. Default: a shared :class:`HostOffloader`
+        backend_profile(Optional[BackendProfile]): The ops that must not be
+            recomputed, and the relative recomputation costs of ops.
+            Default: ``nvfuser_profile``
+
+    Returns:
+        Returns the generated forward and backward Fx graph modules.
+    """
+    from .cost_model import CostModel
+    if cost_model is None:
+        cost_model = CostModel()
+    profile = backend_profile if backend_profile is not None else nvfuser_profile
+    if offloader is None:
+        offloader = _host_offloader
+    joint_module.graph.eliminate_dead_code()
+    joint_module.recompile()
+
+    primal_inputs = list(filter(_is_primal, joint_module.graph.nodes))
+    fwd_outputs, bwd_outputs = _extract_fwd_bwd_outputs(joint_module)
+    forward_only_graph = _extract_graph_with_inputs_outputs(joint_module.graph, primal_inputs, fwd_outputs)
+    forward_node_names = {node.name for node in forward_only_graph.nodes if node.op != 'output'}
+
+    def is_saveable(node):
+        return node.name in forward_node_names and _is_tensor(node)
+
+    def size_of(node):
+        return _node_size(node)
+
+    saved = _saved_forward_values(bwd_outputs, forward_node_names)
+    offloaded = set()
+    decided = set()
+    num_recomputed = 0
+    with compile_phase("offload") as phase:
+        while True:
+            candidates = [node for node in saved if node.op != 'placeholder' and node not in decided
+                          and size_of(node) >= min_offload_bytes]
+            if not candidates:
+                break
+            node = max(candidates, key=size_of)
+            decided.add(node)
+            recompute_time = math.inf
+            inputs = set(node.all_input_nodes)
+            if (_is_recomputable(node, cost_model, profile) and all(is_saveable(arg) for arg in inputs)
+                    and sum(size_of(arg) for arg in inputs - saved) < size_of(node)):
+                recompute_time = _recompute_cost(node, cost_model, profile)
+            if recompute_time <= cost_model.offload_time(node):
+                saved.remove(node)
+                saved.update(inputs)
+                num_recomputed += 1
+            else:
+                offloaded.add(node)
+        phase.metrics["num_offloaded"] = len(offloaded)
+        phase.metrics["offloaded_bytes"] = sum(size_of(node) for node in offloaded)
+        phase.metrics["num_recomputed"] = num_recomputed
+
+    # To make this stuff deterministic
+    node_idx = {node: idx for idx, node in enumerate(joint_module.graph.nodes)}
+    saved_values = sorted(saved, key=lambda x: node_idx[x])
+    for node in saved_values:
+        if node in offloaded:
+            _set_saved_reason(node, "offloaded to host")
+        elif node.op == 'placeholder':
+            _set_saved_reason(node, "input")
+        else:
+            _set_saved_reason(node, "smaller than min_offload_bytes")
+    fwd_module, bwd_module = _extract_fwd_bwd_modules(joint_module, saved_values)
+    offloaded_names = {node.name for node in saved_values if node in offloaded}
+    if offloaded_names:
+        devices = _node_devices(joint_module, _joint_inputs)
+        _insert_offloads(fwd_module, bwd_module, offloaded_names, len(fwd_outputs), offloader, devices)
+    return fwd_module, bwd_module
+
+
 def draw_graph(traced: torch.fx.GraphModule, fname: str, figname: str = "fx_graph", clear_meta=True):
     if clear_meta:
         new_graph = copy.deepcopy(traced.graph)
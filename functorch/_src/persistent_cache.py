@@ -0,0 +1,291 @@
+"""
+On-disk cache for AOT Autograd.
+
+The in-memory ``CompileCache`` keys on ``id(fn)`` and ``id(compiler)``, which
+are meaningless across processes. This module computes a stable fingerprint
+of everything that influences the traced joint graph (the function's code and
+closures, the decompositions, the partitioner and the compilers, and the input
+specialization) and uses it to store the partitioned forward and backward
+graphs on disk. When the compiled result is TorchScript, the serialized module
+is stored as well so that a hit skips compilation too.
+"""
+import ctypes
+import functools
+import hashlib
+import io
+import os
+import pickle
+import sys
+import tempfile
+import types
+from typing import Any, Dict, Optional
+
+import torch
+import torch.nn as nn
+
+# Bump this whenever the format of a cache entry changes.
+CACHE_FORMAT_VERSION = 1
+
+# Recursion limit for fingerprinting nested closures and referenced globals.
+_MAX_FINGERPRINT_DEPTH = 8
+
+
+class _IncompleteFingerprint(Exception):
+    """Raised for values read by the traced function that can't be fingerprinted."""
+
+
+# Top-level packages whose functions are identified by name only, as they are
+# covered by the versions in the key
+_LIBRARY_PACKAGES = {"torch", "functorch", "numpy"} | set(getattr(sys, "stdlib_module_names", ()))
+
+
+def _is_library(module_name: Optional[str]) -> bool:
+    return module_name is None or module_name.split(".")[0] in _LIBRARY_PACKAGES
+
+
+def _tensor_bytes(t: torch.Tensor) -> bytes:
+    if t.is_meta or t.layout != torch.strided or t.is_quantized:
+        return b"<no data>"
+    t = t.detach().cpu().contiguous()
+    return ctypes.string_at(t.data_ptr(), t.numel() * t.element_size())
+
+
+def _update_fingerprint(h, obj, seen, depth=0, strict=False, lifted=()):
+    """
+    Feeds a process-independent description of :attr:`obj` into the hash
+    object :attr:`h`. Object identities and addresses are never used.
+
+    With :attr:`strict`, :attr:`obj` is read by the traced function, so its
+    value may end up in the graph: tensors and the parameters and buffers of
+    modules are hashed by value, and :class:`_IncompleteFingerprint` is
+    raised for values that can't be described. The parameters and buffers of
+    the modules in :attr:`lifted` are inputs of the graph, and only their
+    metadata is hashed.
+    """
+    if depth > _MAX_FINGERPRINT_DEPTH:
+        if strict:
+            raise _IncompleteFingerprint("values are nested too deeply")
+        h.update(b"<depth>")
+        return
+
+    def rec(x, strict=strict):
+        _update_fingerprint(h, x, seen, depth + 1, strict, lifted)
+
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        h.update(repr((type(obj).__name__, obj)).encode())
+    elif isinstance(obj, (torch.dtype, torch.device, torch.memory_format, torch.layout)):
+        h.update(repr(obj).encode())
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"{type(obj).__name__}[{len(obj)}]".encode())
+        for x in obj:
+            rec(x)
+    elif isinstance(obj, dict):
+        h.update(f"dict[{len(obj)}]".encode())
+        for k, v in sorted(obj.items(), key=lambda kv: repr(kv[0])):
+            h.update(repr(k).encode())
+            rec(v)
+    elif isinstance(obj, torch.Tensor):
+        # Tensors captured in closures become constants of the traced graph.
+        h.update(repr((tuple(obj.shape), obj.dtype, obj.device.type)).encode())
+        h.update(_tensor_bytes(obj))
+    elif isinstance(obj, nn.Module):
+        h.update(f"module:{type(obj).__module__}.{type(obj).__qualname__}".encode())
+        h.update(repr(obj).encode())
+        # The parameters and buffers of modules captured by the traced function
+        # become constants of the graph, unless aot_module lifts them to inputs.
+        with_values = strict and not any(obj is m for m in lifted)
+        for name, p in list(obj.named_parameters()) + list(obj.named_buffers()):
+            h.update(repr((name, tuple(p.shape), p.dtype)).encode())
+            if with_values:
+                h.update(_tensor_bytes(p))
+        if id(obj) not in seen:
+            seen.add(id(obj))
+            rec(getattr(type(obj), "forward", None))
+    elif isinstance(obj, types.CodeType):
+        h.update(obj.co_code)
+        h.update(repr((obj.co_name, obj.co_names, obj.co_varnames, obj.co_freevars)).encode())
+        for const in obj.co_consts:
+            rec(const)
+    elif isinstance(obj, functools.partial):
+        h.update(b"partial")
+        rec(obj.func)
+        rec(obj.args)
+        rec(obj.keywords)
+    elif isinstance(obj, types.MethodType):
+        rec(obj.__func__)
+        rec(obj.__self__)
+    elif isinstance(obj, types.FunctionType):
+        h.update(f"fn:{obj.__module__}.{obj.__qualname__}".encode())
+        if id(obj) in seen or (depth > 0 and _is_library(obj.__module__)):
+            return
+        seen.add(id(obj))
+        rec(obj.__code__)
+        rec(obj.__defaults__)
+        for cell in obj.__closure__ or ():
+            try:
+                rec(cell.cell_contents)
+            except ValueError:
+                h.update(b"<empty cell>")
+        # The globals that the function reads, including helpers from other
+        # modules and the attributes it reads from imported modules.
+        names = obj.__code__.co_names
+        for name in names:
+            if name not in obj.__globals__:
+                continue
+            value = obj.__globals__[name]
+            h.update(f"global:{name}".encode())
+            rec(value)
+            if isinstance(value, types.ModuleType) and not _is_library(value.__name__):
+                for attr in names:
+                    if attr in vars(value):
+                        h.update(f"attr:{attr}".encode())
+                        rec(vars(value)[attr])
+    elif isinstance(obj, types.ModuleType):
+        h.update(f"module:{obj.__name__}".encode())
+    elif isinstance(obj, type):
+        h.update(f"type:{obj.__module__}.{obj.__qualname__}".encode())
+    elif isinstance(obj, (types.BuiltinFunctionType, types.BuiltinMethodType)):
+        h.update(f"builtin:{getattr(obj, '__module__', None)}.{obj.__qualname__}".encode())
+        if not isinstance(obj.__self__, (types.ModuleType, type)) and obj.__self__ is not None:
+            rec(obj.__self__)
+    else:
+        # OpOverloads, OpOverloadPackets and friends have stable reprs. Anything
+        # whose repr contains an address is reduced to its type, unless its
+        # value matters.
+        r = repr(obj)
+        if " at 0x" in r or " object at " in r:
+            if strict:
+                raise _IncompleteFingerprint(f"can't fingerprint {type(obj).__qualname__} objects")
+            r = f"{type(obj).__module__}.{type(obj).__qualname__}"
+        h.update(r.encode())
+
+
+def _input_spec(flat_tensor_args, static_args, grad_state):
+    spec = []
+    for arg in flat_tensor_args:
+        if isinstance(arg, torch.Tensor):
+            spec.append((
+                tuple(arg.shape),
+                tuple(arg.stride()),
+                arg.dtype,
+                arg.device.type,
+                grad_state and arg.requires_grad,
+            ))
+        else:
+            spec.append(repr(arg))
+    # Python's hash() of static args is salted per process, so use their repr.
+    spec.append(tuple(repr(arg) for arg in static_args))
+    spec.append(grad_state)
+    return spec
+
+
+def compute_cache_key(
+    fn, fw_compiler, bw_compiler, partition_fn, decompositions, flat_tensor_args, static_args, grad_state
+) -> Optional[str]:
+    """
+    Returns a stable hex digest identifying the compiled artifacts of
+    :attr:`fn` for the given inputs. Identical keys in different processes
+    imply identical joint graphs and partitions.
+
+    The values that :attr:`fn` reads from its closure and globals are part of
+    the key, including captured tensors and module weights, which become
+    constants of the graph. Returns None if one of them can't be
+    fingerprinted, in which case nothing should be persisted.
+    """
+    import functorch
+    from . import config
+
+    h = hashlib.sha256()
+    seen = set()
+    h.update(f"v{CACHE_FORMAT_VERSION}:torch-{torch.__version__}".encode())
+    h.update(f"functorch-{getattr(functorch, '__version__', None)}".encode())
+    try:
+        _update_fingerprint(h, fn, seen, strict=True, lifted=getattr(fn, "_aot_lifted_modules", ()))
+    except _IncompleteFingerprint:
+        return None
+    _update_fingerprint(h, fw_compiler, seen)
+    _update_fingerprint(h, bw_compiler, seen)
+    _update_fingerprint(h, partition_fn, seen)
+    _update_fingerprint(h, decompositions or {}, seen)
+    _update_fingerprint(h, config.use_functionalize, seen)
+    if config.rewrite_fusion_patterns:
+        from .fusion_patterns import fusion_patterns
+        _update_fingerprint(h, [(p.name, p.pattern, p.replacement) for p in fusion_patterns.values()], seen)
+    _update_fingerprint(h, _input_spec(flat_tensor_args, static_args, grad_state), seen)
+    return h.hexdigest()
+
+
+def serialize_compiled(compiled) -> Optional[bytes]:
+    """
+    Serializes a compiled forward or backward when that is possible, i.e. for
+    TorchScript modules. Returns None otherwise.
+    """
+    if not isinstance(compiled, torch.jit.ScriptModule):
+        return None
+    buffer = io.BytesIO()
+    try:
+        torch.jit.save(compiled, buffer)
+    except Exception:
+        return None
+    return buffer.getvalue()
+
+
+def deserialize_compiled(data: Optional[bytes]):
+    """Loads a compiled forward or backward, or returns None if that fails."""
+    if data is None:
+        return None
+    try:
+        return torch.jit.load(io.BytesIO(data))
+    except Exception:
+        return None
+
+
+class PersistentCompileCache(object):
+    """
+    A directory of pickled cache entries, one file per key. Writes are atomic
+    so that concurrent workers can share a directory. Entries are unpickled,
+    which can run arbitrary code, so the directory must be trusted.
+    """
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(key), "rb") as f:
+                entry = pickle.load(f)
+        except Exception:
+            # Missing, truncated or corrupt entries are misses
+            return None
+        if not isinstance(entry, dict):
+            return None
+        if entry.get("version") != CACHE_FORMAT_VERSION:
+            return None
+        return entry
+
+    def save(self, key: str, entry: Dict[str, Any]):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = {**entry, "version": CACHE_FORMAT_VERSION}
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(entry, f)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def get_persistent_cache() -> Optional[PersistentCompileCache]:
+    """
+    Returns the on-disk cache configured by ``config.persistent_cache_dir``,
+    or None when persistent caching is disabled.
+    """
+    from . import config
+
+    if not config.persistent_cache_dir:
+        return None
+    return PersistentCompileCache(config.persistent_cache_dir)
@@ -4,7 +4,79 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 __all__ = ["make_fx", "ProxyTensor", "dispatch_trace", "PythonKeyTracer", "pythonkey_decompose"]
-from torch.fx.experimental.proxy_tensor import make_fx, ProxyTensor, dispatch_trace, PythonKeyTracer, decompose
+import functools
+import inspect
+
+import torch
+import torch.fx as fx
+import torch.utils._pytree as pytree
+from torch.fx.experimental.proxy_tensor import (
+    make_fx as _make_fx, ProxyTensor, dispatch_trace, PythonKeyTracer, decompose
+)
 
 pythonkey_decompose = decompose
 PythonTensor = ProxyTensor
+
+_HAS_FAKE_TRACING = "tracing_mode" in inspect.signature(_make_fx).parameters
+
+
+def _replace_meta_device(graph_module: fx.GraphModule, device: torch.device):
+    """
+    Replaces the meta device in the args of the nodes of :attr:`graph_module`,
+    e.g. of factory functions, by :attr:`device`.
+    """
+    meta = torch.device("meta")
+
+    def replace(arg):
+        return device if isinstance(arg, torch.device) and arg == meta else arg
+
+    for node in graph_module.graph.nodes:
+        if node.op == "get_attr":
+            attr = getattr(graph_module, node.target, None)
+            if isinstance(attr, torch.Tensor) and attr.is_meta:
+                raise RuntimeError(
+                    f"Tracing with meta tensors created the tensor constant {node.target}, whose "
+                    "value is unknown. Trace with real tensors instead."
+                )
+        node.args = fx.node.map_aggregate(node.args, replace)
+        node.kwargs = fx.node.map_aggregate(node.kwargs, replace)
+    graph_module.recompile()
+
+
+def make_fx(f, decomposition_table=None, tracing_mode="real"):
+    """
+    Returns a function that traces :attr:`f` into an ``fx.GraphModule`` of
+    aten ops when called with example args.
+
+    With ``tracing_mode="real"``, :attr:`f` is run on the example args.
+    ``tracing_mode="meta"`` runs it on meta copies of the tensor args, so
+    that only their shapes, dtypes and strides are computed (and recorded in
+    the ``tensor_meta`` of the nodes) while no memory is allocated. The meta
+    device in the traced graph is replaced by the device of the tensor args,
+    which must be the same for all of them. ``tracing_mode="fake"`` uses
+    PyTorch's fake tensors, if the installed version supports them.
+    """
+    if tracing_mode == "real":
+        return _make_fx(f, decomposition_table)
+    if tracing_mode == "fake":
+        if not _HAS_FAKE_TRACING:
+            raise RuntimeError("This version of PyTorch can't trace with fake tensors, use tracing_mode='meta'")
+        return _make_fx(f, decomposition_table, tracing_mode="fake")
+    if tracing_mode != "meta":
+        raise ValueError(f"Unknown tracing_mode {tracing_mode}, expected 'real', 'meta' or 'fake'")
+
+    @functools.wraps(f)
+    def wrapped(*args):
+        flat_args, _ = pytree.tree_flatten(args)
+        devices = {x.device for x in flat_args if isinstance(x, torch.Tensor) and not x.is_meta}
+        if len(devices) > 1:
+            raise RuntimeError(f"tracing_mode='meta' needs all tensor args on one device, got {devices}")
+        meta_args = pytree.tree_map(
+            lambda x: x.detach().to("meta").requires_grad_(x.requires_grad) if isinstance(x, torch.Tensor) else x,
+            args,
+        )
+        graph_module = _make_fx(f, decomposition_table)(*meta_args)
+        _replace_meta_device(graph_module, devices.pop() if devices else torch.device("cpu"))
+        return graph_module
+
+    return wrapped
@@ -8,6 +8,11 @@ from .._src.aot_autograd import (
     compiled_module,
     num_of_recompilations,
     clear_compile_cache,
+    compile_cache_stats,
+    set_compile_cache_capacity,
+    wait_for_async_compiles,
+    TensorSpec,
+    CallSpec,
     aot_module_simplified,
 )
 from .._src.compilers import (
@@ -15,16 +20,36 @@ from .._src.compilers import (
     tvm_compile,
     draw_graph_compile,
     nop,
+    boxed_nop,
+    make_boxed_module,
     nnc_jit,
     memory_efficient_fusion,
     debug_compile,
     print_compile,
-    default_decompositions
+    default_decompositions,
+    compiled_graph_cache_stats,
+    clear_compiled_graph_cache,
 )
 from .._src.partitioners import (
     min_cut_rematerialization_partition,
+    memory_budget_partition,
+    activation_offload_partition,
+    HostOffloader,
     default_partition,
+    partition_cache_stats,
+    clear_partition_cache,
     draw_graph,
     draw_joint_graph,
 )
+from .._src.backend_profiles import BackendProfile, nvfuser_profile, nnc_profile, tvm_profile
+from .._src.cost_model import CostModel, register_flop_formula
+from .._src.partition_report import PartitionReport, SavedTensor, memory_timeline
+from .._src.memory_planner import plan_memory, MemoryPlan
+from .._src.fusion_patterns import FusionPattern, register_fusion_pattern, apply_fusion_patterns
+from .._src.compile_profiler import (
+    CompileProfiler,
+    CompilePhaseEvent,
+    register_compile_callback,
+    remove_compile_callback,
+)
 from .._src import config
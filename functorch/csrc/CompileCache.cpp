@@ -16,6 +16,9 @@
 #include <torch/csrc/jit/tensorexpr/codegen.h>
 #include <torch/csrc/utils/pybind.h>
 
+#include <iterator>
+#include <list>
+
 using namespace torch::jit::tensorexpr;
 
 namespace {
@@ -132,6 +135,10 @@ hash_key_t static_hasher(const LocalState &state, const at::Tensor &v) {
 
 /// ArgCompileCache is a templated class allowing plugging of different types of
 /// Hasher/Specialization Keys.
+///
+/// Entries are kept in least-recently-used order. When a global capacity or a
+/// per-function capacity is set, inserting past it evicts the least recently
+/// used entry (of the same function, for the per-function limit).
 struct CompileCache {
 public:
   CompileCache() = default;
@@ -150,15 +157,26 @@ public:
       return seed;
     }
   };
-  using Cache = std::unordered_map<hash_key_t, py::object, vector_hasher>;
+
+  /// A cached compiled function along with the id of the function it was
+  /// compiled from, which is needed for per-function eviction.
+  struct Entry {
+    hash_key_t key;
+    int64_t id;
+    py::object compileFn;
+  };
+  /// Entries ordered from most to least recently used.
+  using EntryList = std::list<Entry>;
+  using Cache =
+      std::unordered_map<hash_key_t, EntryList::iterator, vector_hasher>;
 
   /// Compute the set of specialization keys based on the inputs to
   /// the kernel.
-  hash_key_t computeCacheKey(PyObject *args,
-                             const std::vector<at::Tensor> &tensorArgs,
+  hash_key_t computeCacheKey(const std::vector<at::Tensor> &tensorArgs,
                              int numTensorArgs, const std::string &hasherType,
                              int64_t id, int64_t fw_compiler_id,
-                             int64_t bw_compiler_id) {
+                             int64_t bw_compiler_id,
+                             const std::vector<int64_t> &staticHashes) {
     LocalState state;
     hash_key_t cacheKey;
     for (int i = 0; i < numTensorArgs; ++i) {
@@ -181,13 +199,122 @@ public:
     cacheKey.push_back(bw_compiler_id);
     cacheKey.push_back(numTensorArgs);
 
+    // Cache the hashes of the static args.
+    cacheKey.insert(cacheKey.end(), staticHashes.begin(), staticHashes.end());
+    return cacheKey;
+  }
+
+  hash_key_t computeCacheKey(PyObject *args,
+                             const std::vector<at::Tensor> &tensorArgs,
+                             int numTensorArgs, const std::string &hasherType,
+                             int64_t id, int64_t fw_compiler_id,
+                             int64_t bw_compiler_id) {
     // Cache the non-tensor args. Currently, all the non-tensor args are cached.
+    std::vector<int64_t> staticHashes;
     for (int i = numTensorArgs; i < PyTuple_Size(args); i++) {
       PyObject *arg = PyTuple_GET_ITEM(args, i);
       assert(PyLong_Check(arg));
-      cacheKey.push_back(PyLong_AsLong(arg));
+      staticHashes.push_back(PyLong_AsLongLong(arg));
     }
-    return cacheKey;
+    return computeCacheKey(tensorArgs, numTensorArgs, hasherType, id,
+                           fw_compiler_id, bw_compiler_id, staticHashes);
+  }
+
+  /// Flatten `obj` into `leaves` in the same order as pytree: tuples and lists
+  /// in order, dicts by sorted keys. Only exact tuples, lists and dicts are
+  /// traversed and only tensors and None are accepted as leaves. Returns false
+  /// for anything else (e.g. namedtuples or other registered pytree nodes), in
+  /// which case the caller has to take the Python path.
+  bool flattenTensorArgs(PyObject *obj, std::vector<PyObject *> &leaves) {
+    if (obj == Py_None || THPVariable_Check(obj)) {
+      leaves.push_back(obj);
+      return true;
+    }
+    if (PyTuple_CheckExact(obj)) {
+      for (Py_ssize_t i = 0; i < PyTuple_GET_SIZE(obj); ++i) {
+        if (!flattenTensorArgs(PyTuple_GET_ITEM(obj, i), leaves)) {
+          return false;
+        }
+      }
+      return true;
+    }
+    if (PyList_CheckExact(obj)) {
+      for (Py_ssize_t i = 0; i < PyList_GET_SIZE(obj); ++i) {
+        if (!flattenTensorArgs(PyList_GET_ITEM(obj, i), leaves)) {
+          return false;
+        }
+      }
+      return true;
+    }
+    if (PyDict_CheckExact(obj)) {
+      py::list keys = py::reinterpret_steal<py::list>(PyDict_Keys(obj));
+      if (PyList_Sort(keys.ptr()) != 0) {
+        // Unorderable keys. Let pytree report the error.
+        PyErr_Clear();
+        return false;
+      }
+      for (Py_ssize_t i = 0; i < PyList_GET_SIZE(keys.ptr()); ++i) {
+        PyObject *value = PyDict_GetItem(obj, PyList_GET_ITEM(keys.ptr(), i));
+        if (!flattenTensorArgs(value, leaves)) {
+          return false;
+        }
+      }
+      return true;
+    }
+    return false;
+  }
+
+  /// Fast path of aot_function. Separates out the static args given by the
+  /// sorted `staticArgnums`, hashes them, flattens the remaining args and the
+  /// kwargs, and looks up the cache, all without going through Python.
+  ///
+  /// Returns a pair of the cached object (or None on a miss) and the list of
+  /// flat tensor args. The list is None if the args could not be flattened
+  /// here, in which case nothing was looked up.
+  py::tuple atArgs(int64_t id, int64_t fw_compiler_id, int64_t bw_compiler_id,
+                   const std::string &hasherType,
+                   const std::vector<int64_t> &staticArgnums,
+                   const py::tuple &args, const py::dict &kwargs) {
+    std::vector<PyObject *> leaves;
+    std::vector<int64_t> staticHashes;
+    auto numArgs = static_cast<int64_t>(PyTuple_GET_SIZE(args.ptr()));
+    size_t staticIndex = 0;
+    for (int64_t i = 0; i < numArgs; ++i) {
+      PyObject *arg = PyTuple_GET_ITEM(args.ptr(), i);
+      if (staticIndex < staticArgnums.size() &&
+          staticArgnums[staticIndex] == i) {
+        ++staticIndex;
+        Py_hash_t hash = PyObject_Hash(arg);
+        if (hash == -1 && PyErr_Occurred()) {
+          PyErr_Clear();
+          return py::make_tuple(py::none(), py::none());
+        }
+        staticHashes.push_back(hash);
+      } else if (!flattenTensorArgs(arg, leaves)) {
+        return py::make_tuple(py::none(), py::none());
+      }
+    }
+    if (!flattenTensorArgs(kwargs.ptr(), leaves)) {
+      return py::make_tuple(py::none(), py::none());
+    }
+
+    int numTensorArgs = leaves.size();
+    py::list flatTensorArgs(numTensorArgs);
+    std::vector<at::Tensor> tensorArgs(numTensorArgs);
+    for (int i = 0; i < numTensorArgs; ++i) {
+      PyList_SET_ITEM(flatTensorArgs.ptr(), i,
+                      py::reinterpret_borrow<py::object>(leaves[i])
+                          .release()
+                          .ptr());
+      if (leaves[i] != Py_None) {
+        tensorArgs[i] = THPVariable_Unpack(leaves[i]);
+      }
+    }
+
+    hash_key_t cacheKey =
+        computeCacheKey(tensorArgs, numTensorArgs, hasherType, id,
+                        fw_compiler_id, bw_compiler_id, staticHashes);
+    return py::make_tuple(lookup(cacheKey), flatTensorArgs);
   }
 
   std::vector<at::Tensor> parsePythonArgs(int numTensorArgs, PyObject *args) {
@@ -223,13 +350,7 @@ public:
     hash_key_t cacheKey =
         computeCacheKey(args, tensorArgs, numTensorArgs, hasherType, id,
                         fw_compiler_id, bw_compiler_id);
-
-    auto item = cache_.find(cacheKey); // protected by GIL
-
-    if (C10_LIKELY(item != cache_.end())) {
-      return item->second;
-    }
-    return py::none();
+    return lookup(cacheKey);
   }
 
   /// Insert a new compiled functions for new tensor properties.
@@ -241,17 +362,107 @@ public:
     hash_key_t cacheKey =
         computeCacheKey(args, tensorArgs, numTensorArgs, hasherType, id,
                         fw_compiler_id, bw_compiler_id);
-    cache_.emplace(cacheKey, compileFn);
+    auto item = cache_.find(cacheKey);
+    if (item != cache_.end()) {
+      item->second->compileFn = compileFn;
+      entries_.splice(entries_.begin(), entries_, item->second);
+      return;
+    }
+    entries_.push_front(Entry{cacheKey, id, compileFn});
+    cache_.emplace(std::move(cacheKey), entries_.begin());
+    ++numEntriesPerFunction_[id];
+    evict(id);
+  }
+
+  /// Set the maximum number of entries in total and per function. Zero means
+  /// unbounded. Shrinking the capacities evicts entries right away.
+  void setCapacity(int64_t capacity, int64_t perFunctionCapacity) {
+    capacity_ = capacity;
+    perFunctionCapacity_ = perFunctionCapacity;
+    // evict() can erase elements of numEntriesPerFunction_, so collect the ids
+    // first.
+    std::vector<int64_t> ids;
+    ids.reserve(numEntriesPerFunction_.size());
+    for (const auto &count : numEntriesPerFunction_) {
+      ids.push_back(count.first);
+    }
+    for (int64_t id : ids) {
+      evict(id);
+    }
+    evict(/*id=*/-1);
   }
 
   const int64_t size() const { return cache_.size(); }
+  const int64_t capacity() const { return capacity_; }
+  const int64_t perFunctionCapacity() const { return perFunctionCapacity_; }
+  const int64_t hits() const { return hits_; }
+  const int64_t misses() const { return misses_; }
+  const int64_t evictions() const { return evictions_; }
 
   /// Clear the cache.
-  void clear() { cache_.clear(); }
+  void clear() {
+    cache_.clear();
+    entries_.clear();
+    numEntriesPerFunction_.clear();
+    hits_ = 0;
+    misses_ = 0;
+    evictions_ = 0;
+  }
 
 private:
+  py::object lookup(const hash_key_t &cacheKey) {
+    auto item = cache_.find(cacheKey); // protected by GIL
+
+    if (C10_LIKELY(item != cache_.end())) {
+      ++hits_;
+      // Mark the entry as the most recently used one.
+      entries_.splice(entries_.begin(), entries_, item->second);
+      return item->second->compileFn;
+    }
+    ++misses_;
+    return py::none();
+  }
+
+  /// Evict least recently used entries until the per-function capacity for
+  /// the function with id `id` and the global capacity are satisfied.
+  /// Unknown ids only enforce the global capacity.
+  void evict(int64_t id) {
+    auto count = numEntriesPerFunction_.find(id);
+    if (perFunctionCapacity_ > 0 && count != numEntriesPerFunction_.end()) {
+      auto it = entries_.end();
+      while (count->second > perFunctionCapacity_ && it != entries_.begin()) {
+        --it;
+        if (it->id == id) {
+          it = erase(it);
+        }
+      }
+    }
+    while (capacity_ > 0 && static_cast<int64_t>(entries_.size()) > capacity_) {
+      erase(std::prev(entries_.end()));
+    }
+  }
+
+  EntryList::iterator erase(EntryList::iterator it) {
+    auto count = numEntriesPerFunction_.find(it->id);
+    if (--count->second == 0) {
+      numEntriesPerFunction_.erase(count);
+    }
+    cache_.erase(it->key);
+    ++evictions_;
+    return entries_.erase(it);
+  }
+
   /// Compilation cache holding key and the compiled function.
   Cache cache_;
+  EntryList entries_;
+  std::unordered_map<int64_t, int64_t> numEntriesPerFunction_;
+
+  int64_t capacity_ = 0;
+  int64_t perFunctionCapacity_ = 0;
+
+  int64_t hits_ = 0;
+  int64_t misses_ = 0;
+  int64_t evictions_ = 0;
 };
 
 static CompileCache *createCompileCache() { return new CompileCache(); }
@@ -280,8 +491,27 @@ void initCompileCacheBindings(PyObject *module) {
              self.insert(id, fw_compiler_id, bw_compiler_id, numTensorArgs,
                          hasherType, compileFn, args.ptr());
            })
+      .def("at_args",
+           [](CompileCache &self, int64_t id, int64_t fw_compiler_id,
+              int64_t bw_compiler_id, const std::string &hasherType,
+              const std::vector<int64_t> &staticArgnums, const py::tuple &args,
+              const py::dict &kwargs) {
+             return self.atArgs(id, fw_compiler_id, bw_compiler_id, hasherType,
+                                staticArgnums, args, kwargs);
+           })
+      .def("set_capacity",
+           [](CompileCache &self, int64_t capacity,
+              int64_t perFunctionCapacity) {
+             self.setCapacity(capacity, perFunctionCapacity);
+           })
       .def("clear", [](CompileCache &self) { self.clear(); })
-      .def("size", [](CompileCache &self) { return self.size(); });
+      .def("size", [](CompileCache &self) { return self.size(); })
+      .def("capacity", [](CompileCache &self) { return self.capacity(); })
+      .def("per_function_capacity",
+           [](CompileCache &self) { return self.perFunctionCapacity(); })
+      .def("hits", [](CompileCache &self) { return self.hits(); })
+      .def("misses", [](CompileCache &self) { return self.misses(); })
+      .def("evictions", [](CompileCache &self) { return self.evictions(); });
 }
 
 } // namespace functorch
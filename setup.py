@@ -49,7 +49,7 @@ requirements = [
 ]
 
 extras = {}
-extras["aot"] = ["networkx", ]
+extras["aot"] = []
 
 
 class clean(distutils.command.clean.clean):
@@ -1,10 +1,18 @@
+import collections
+import gc
+import os
+import shutil
+import tempfile
+import threading
+import warnings
 import torch
 
 import functorch
 from torch.testing._internal.common_utils import run_tests, TestCase, IS_WINDOWS
 import unittest
 
-from functorch.compile import aot_function, nop
+from functorch._src.persistent_cache import get_persistent_cache
+from functorch.compile import aot_function, aot_module, nop, ts_compile, default_partition, config, TensorSpec, CallSpec
 
 
 class TestCompileCache(TestCase):
@@ -680,5 +688,663 @@ class TestCompileCacheStaticArgs(TestCase):
         assert total_recomps == 7
 
 
+_GLOBAL_SCALE = None
+
+
+class CountingPartitioner:
+    def __init__(self):
+        self.num_calls = 0
+
+    def __call__(self, joint_module, joint_inputs):
+        self.num_calls += 1
+        return default_partition(joint_module, joint_inputs)
+
+
+@unittest.skipIf(IS_WINDOWS, 'test broken on windows')
+class TestPersistentCompileCache(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.old_cache_dir = config.persistent_cache_dir
+        config.persistent_cache_dir = self.cache_dir
+        functorch.compile.clear_compile_cache()
+
+    def tearDown(self):
+        config.persistent_cache_dir = self.old_cache_dir
+        functorch.compile.clear_compile_cache()
+        shutil.rmtree(self.cache_dir)
+
+    def check(self, fn, aot_fn, *args):
+        ref_args = [a.clone().detach().requires_grad_(True) for a in args]
+        res_args = [a.clone().detach().requires_grad_(True) for a in args]
+        ref = fn(*ref_args)
+        ref.sum().backward()
+        res = aot_fn(*res_args)
+        res.sum().backward()
+        assert torch.allclose(res, ref)
+        for ref_arg, res_arg in zip(ref_args, res_args):
+            assert torch.allclose(ref_arg.grad, res_arg.grad)
+
+    def test_hit_skips_tracing(self):
+        def fn(x, y):
+            return (x * y).sin()
+
+        partitioner = CountingPartitioner()
+        a = torch.randn(4, 5)
+        b = torch.randn(4, 5)
+        self.check(fn, aot_function(fn, nop, partition_fn=partitioner), a, b)
+        self.assertEqual(partitioner.num_calls, 1)
+
+        # Simulate a new process by dropping the in-memory cache
+        functorch.compile.clear_compile_cache()
+        self.check(fn, aot_function(fn, nop, partition_fn=partitioner), a, b)
+        self.assertEqual(partitioner.num_calls, 1)
+
+        # A new input specialization is a miss
+        self.check(fn, aot_function(fn, nop, partition_fn=partitioner), torch.randn(3), torch.randn(3))
+        self.assertEqual(partitioner.num_calls, 2)
+
+    def test_different_functions(self):
+        def f(x):
+            return x.sin()
+
+        def g(x):
+            return x.cos()
+
+        partitioner = CountingPartitioner()
+        a = torch.randn(3)
+        self.check(f, aot_function(f, nop, partition_fn=partitioner), a)
+        self.check(g, aot_function(g, nop, partition_fn=partitioner), a)
+        self.assertEqual(partitioner.num_calls, 2)
+
+    def test_output_spec(self):
+        def fn(x):
+            return {'a': x.sin(), 'b': [x.cos()]}
+
+        x = torch.randn(3, requires_grad=True)
+        ref = fn(x)
+        aot_function(fn, nop)(x)
+        functorch.compile.clear_compile_cache()
+        res = aot_function(fn, nop)(x)
+        self.assertEqual(ref, res)
+
+    def test_captured_weights(self):
+        linear = torch.nn.Linear(4, 4)
+
+        def fn(x):
+            return linear(x).sin()
+
+        partitioner = CountingPartitioner()
+        a = torch.randn(2, 4)
+        self.check(fn, aot_function(fn, nop, partition_fn=partitioner), a)
+        # The weights are constants of the graph, so new values are a miss
+        with torch.no_grad():
+            linear.weight.add_(1)
+        functorch.compile.clear_compile_cache()
+        self.check(fn, aot_function(fn, nop, partition_fn=partitioner), a)
+        self.assertEqual(partitioner.num_calls, 2)
+
+    def test_global_values(self):
+        global _GLOBAL_SCALE
+
+        def fn(x):
+            return x * _GLOBAL_SCALE
+
+        partitioner = CountingPartitioner()
+        a = torch.randn(3)
+        _GLOBAL_SCALE = torch.tensor(2.0)
+        self.check(fn, aot_function(fn, nop, partition_fn=partitioner), a)
+        _GLOBAL_SCALE = torch.tensor(3.0)
+        functorch.compile.clear_compile_cache()
+        self.check(fn, aot_function(fn, nop, partition_fn=partitioner), a)
+        self.assertEqual(partitioner.num_calls, 2)
+
+    def test_unknown_captured_value(self):
+        class Opaque:
+            scale = 2.0
+
+        opaque = Opaque()
+
+        def fn(x):
+            return x * opaque.scale
+
+        self.check(fn, aot_function(fn, nop), torch.randn(3))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_corrupt_entry(self):
+        def fn(x):
+            return x.cos()
+
+        partitioner = CountingPartitioner()
+        a = torch.randn(3)
+        self.check(fn, aot_function(fn, nop, partition_fn=partitioner), a)
+        for name in os.listdir(self.cache_dir):
+            with open(os.path.join(self.cache_dir, name), "wb") as f:
+                f.write(b"garbage")
+        functorch.compile.clear_compile_cache()
+        self.check(fn, aot_function(fn, nop, partition_fn=partitioner), a)
+        self.assertEqual(partitioner.num_calls, 2)
+
+    def test_corrupt_compiled_graph(self):
+        def fn(x):
+            return x.sin()
+
+        persistent_cache = get_persistent_cache()
+        a = torch.randn(3, requires_grad=True)
+        config.cache_compiled_graphs = True
+        try:
+            self.check(fn, aot_function(fn, ts_compile), a)
+            # Compiled graphs that can't be deserialized are compiled again
+            for name in os.listdir(self.cache_dir):
+                key = name[:-len(".pt")]
+                if "compiled" in persistent_cache.load(key):
+                    persistent_cache.save(key, {"compiled": b"garbage"})
+                else:
+                    os.remove(os.path.join(self.cache_dir, name))
+            functorch.compile.clear_compile_cache()
+            functorch.compile.clear_compiled_graph_cache()
+            self.check(fn, aot_function(fn, ts_compile), a)
+            self.assertEqual(functorch.compile.compiled_graph_cache_stats()["misses"], 2)
+        finally:
+            config.cache_compiled_graphs = False
+            functorch.compile.clear_compiled_graph_cache()
+
+    def test_torchscript(self):
+        def fn(x, y):
+            return x * y + y
+
+        partitioner = CountingPartitioner()
+        a = torch.randn(4)
+        b = torch.randn(4)
+        self.check(fn, aot_function(fn, ts_compile, partition_fn=partitioner), a, b)
+        functorch.compile.clear_compile_cache()
+        self.check(fn, aot_function(fn, ts_compile, partition_fn=partitioner), a, b)
+        self.assertEqual(partitioner.num_calls, 1)
+
+
+@unittest.skipIf(IS_WINDOWS, 'test broken on windows')
+class TestCompiledGraphCache(TestCase):
+    def setUp(self):
+        functorch.compile.clear_compile_cache()
+        functorch.compile.clear_compiled_graph_cache()
+        config.cache_compiled_graphs = True
+
+    def tearDown(self):
+        config.cache_compiled_graphs = False
+        functorch.compile.clear_compile_cache()
+        functorch.compile.clear_compiled_graph_cache()
+
+    def test_identical_graphs(self):
+        def f(x, y):
+            return (x * y).sin()
+
+        def g(a, b):
+            return (a * b).sin()
+
+        x = torch.randn(4, requires_grad=True)
+        y = torch.randn(4, requires_grad=True)
+        aot_function(f, ts_compile)(x, y).sum().backward()
+        stats = functorch.compile.compiled_graph_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (0, 2))
+
+        # The forward and backward graphs of g are the same as those of f
+        res = aot_function(g, ts_compile)(x.detach().requires_grad_(True), y)
+        self.assertEqual(res, g(x, y))
+        stats = functorch.compile.compiled_graph_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 2))
+
+        # Other shapes are compiled again
+        aot_function(g, ts_compile)(torch.randn(3, requires_grad=True), torch.randn(3))
+        self.assertEqual(functorch.compile.compiled_graph_cache_stats()["misses"], 4)
+
+        # Entries don't outlive the compiled functions that use them
+        del res
+        functorch.compile.clear_compile_cache()
+        gc.collect()
+        self.assertEqual(functorch.compile.compiled_graph_cache_stats()["size"], 0)
+
+    def test_memory_planned_graphs(self):
+        def f(x):
+            return x.cos().cos().sum()
+
+        def g(x):
+            return x.cos().cos().sum()
+
+        # Compiled graphs with arenas would share them, so they aren't cached
+        config.memory_planning = True
+        try:
+            x = torch.randn(4, requires_grad=True)
+            self.assertEqual(aot_function(f, ts_compile)(x), f(x))
+            self.assertEqual(aot_function(g, ts_compile)(x), g(x))
+        finally:
+            config.memory_planning = False
+        stats = functorch.compile.compiled_graph_cache_stats()
+        self.assertEqual((stats["hits"], stats["size"]), (0, 0))
+
+    def test_different_constants(self):
+        def f(x):
+            return x + torch.tensor([1.0, 2.0])
+
+        def g(x):
+            return x + torch.tensor([3.0, 4.0])
+
+        x = torch.randn(2)
+        self.assertEqual(aot_function(f, ts_compile)(x), f(x))
+        self.assertEqual(aot_function(g, ts_compile)(x), g(x))
+        # Only the backward graphs, which don't use the constants, are the same
+        stats = functorch.compile.compiled_graph_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 3))
+
+    def test_disabled(self):
+        def fn(x):
+            return x.cos()
+
+        config.cache_compiled_graphs = False
+        x = torch.randn(3)
+        aot_function(fn, ts_compile)(x)
+        self.assertEqual(functorch.compile.compiled_graph_cache_stats()["size"], 0)
+
+
+@unittest.skipIf(IS_WINDOWS, 'test broken on windows')
+class TestCompileCacheEviction(TestCase):
+    def setUp(self):
+        functorch.compile.clear_compile_cache()
+
+    def tearDown(self):
+        functorch.compile.set_compile_cache_capacity(None, None)
+        functorch.compile.clear_compile_cache()
+
+    def test_global_capacity(self):
+        def fn(x):
+            return x.sin()
+
+        functorch.compile.set_compile_cache_capacity(2)
+        aot_fn = aot_function(fn, nop)
+        for s in [2, 3, 4]:
+            aot_fn(torch.randn(s, requires_grad=True))
+        stats = functorch.compile.compile_cache_stats()
+        self.assertEqual(stats["size"], 2)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["misses"], 3)
+
+        # Most recently used entries are still cached
+        aot_fn(torch.randn(4, requires_grad=True))
+        self.assertEqual(functorch.compile.compile_cache_stats()["hits"], 1)
+
+        # The evicted entry is recompiled
+        aot_fn(torch.randn(2, requires_grad=True))
+        self.assertEqual(functorch.compile.num_of_recompilations(), 4)
+
+    def test_lru_order(self):
+        def fn(x):
+            return x.sin()
+
+        functorch.compile.set_compile_cache_capacity(2)
+        aot_fn = aot_function(fn, nop)
+        aot_fn(torch.randn(2, requires_grad=True))
+        aot_fn(torch.randn(3, requires_grad=True))
+        # Touch the oldest entry so that size 3 gets evicted instead
+        aot_fn(torch.randn(2, requires_grad=True))
+        aot_fn(torch.randn(4, requires_grad=True))
+        aot_fn(torch.randn(2, requires_grad=True))
+        stats = functorch.compile.compile_cache_stats()
+        self.assertEqual(stats["misses"], 3)
+        self.assertEqual(stats["hits"], 2)
+
+    def test_per_function_capacity(self):
+        def f(x):
+            return x.sin()
+
+        def g(x):
+            return x.cos()
+
+        functorch.compile.set_compile_cache_capacity(per_function_capacity=1)
+        aot_f = aot_function(f, nop)
+        aot_g = aot_function(g, nop)
+        aot_g(torch.randn(2, requires_grad=True))
+        for s in [2, 3, 4]:
+            aot_f(torch.randn(s, requires_grad=True))
+        stats = functorch.compile.compile_cache_stats()
+        self.assertEqual(stats["size"], 2)
+        self.assertEqual(stats["evictions"], 2)
+
+        # g's entry was not evicted by f's compilations
+        aot_g(torch.randn(2, requires_grad=True))
+        self.assertEqual(functorch.compile.compile_cache_stats()["hits"], 1)
+
+    def test_shrink_capacity(self):
+        def fn(x):
+            return x.sin()
+
+        aot_fn = aot_function(fn, nop)
+        for s in [2, 3, 4, 5]:
+            aot_fn(torch.randn(s, requires_grad=True))
+        functorch.compile.set_compile_cache_capacity(1)
+        stats = functorch.compile.compile_cache_stats()
+        self.assertEqual(stats["size"], 1)
+        self.assertEqual(stats["evictions"], 3)
+
+
+@unittest.skipIf(IS_WINDOWS, 'test broken on windows')
+class TestCompileCacheBucketed(TestCase):
+    def check(self, fn, aot_fn, x, w):
+        x_clone = x.clone().detach().requires_grad_(True)
+        w_clone = w.clone().detach().requires_grad_(True)
+        ref = fn(x, w)
+        ref.sum().backward()
+        res = aot_fn(x_clone, w_clone)
+        res.sum().backward()
+        self.assertEqual(res.shape, ref.shape)
+        assert torch.allclose(res, ref)
+        assert torch.allclose(x.grad, x_clone.grad)
+        assert torch.allclose(w.grad, w_clone.grad)
+
+    def test_power_of_two_buckets(self):
+        def fn(x, w):
+            return torch.mm(x, w).relu()
+
+        functorch.compile.clear_compile_cache()
+        aot_fn = aot_function(fn, nop, hasher_type="BucketedShapeHasher", bucket_dims={0: 0})
+        for batch_size in range(5, 17):
+            x = torch.randn(batch_size, 4, requires_grad=True)
+            w = torch.randn(4, 3, requires_grad=True)
+            self.check(fn, aot_fn, x, w)
+        # Buckets 8 and 16
+        self.assertEqual(functorch.compile.num_of_recompilations(), 2)
+
+    def test_custom_buckets(self):
+        def fn(x, w):
+            return x * w
+
+        functorch.compile.clear_compile_cache()
+        aot_fn = aot_function(fn, nop, hasher_type="BucketedShapeHasher",
+                              bucket_dims={0: 1, 1: 1}, buckets=[10, 20])
+        for seq_len in [3, 10, 11, 20, 25]:
+            x = torch.randn(2, seq_len, requires_grad=True)
+            w = torch.randn(2, seq_len, requires_grad=True)
+            self.check(fn, aot_fn, x, w)
+        # Buckets 10 and 20, and the unbucketed size 25
+        self.assertEqual(functorch.compile.num_of_recompilations(), 3)
+
+    def test_mismatched_sizes(self):
+        def fn(x, w):
+            return x.sum() + w.sum()
+
+        aot_fn = aot_function(fn, nop, hasher_type="BucketedShapeHasher", bucket_dims={0: 0, 1: 0})
+        with self.assertRaisesRegex(RuntimeError, "same size"):
+            aot_fn(torch.randn(3), torch.randn(4))
+
+    def test_module(self):
+        functorch.compile.clear_compile_cache()
+        mod = torch.nn.Linear(4, 3)
+        aot_mod = aot_module(mod, nop, hasher_type="BucketedShapeHasher", bucket_dims={0: 0})
+        for batch_size in [3, 4]:
+            x = torch.randn(batch_size, 4)
+            self.assertEqual(aot_mod(x), mod(x))
+        self.assertEqual(functorch.compile.num_of_recompilations(), 1)
+
+        # The input is found when passed by keyword as well
+        x = torch.randn(3, 4)
+        self.assertEqual(aot_mod(input=x), mod(x))
+
+    def test_keyword_argument(self):
+        def fn(x, w):
+            return torch.mm(x, w).relu()
+
+        aot_fn = aot_function(fn, nop, hasher_type="BucketedShapeHasher", bucket_dims={0: 0})
+        x = torch.randn(5, 4)
+        w = torch.randn(4, 3)
+        self.assertEqual(aot_fn(x=x, w=w), fn(x, w))
+        self.assertEqual(aot_fn(x, w=w), fn(x, w))
+
+    def test_output_dims(self):
+        def fn(x, w):
+            # The padded size of x is 8, like the size of w
+            y = torch.mm(x, w)
+            return y.t(), w * 2
+
+        aot_fn = aot_function(fn, nop, hasher_type="BucketedShapeHasher", bucket_dims={0: 0})
+        x = torch.randn(5, 4)
+        w = torch.randn(4, 8)
+        res = aot_fn(x, w)
+        self.assertEqual([r.shape for r in res], [(8, 5), (4, 8)])
+        self.assertEqual(res, fn(x, w))
+
+    def test_reduction(self):
+        def fn(x):
+            return x.softmax(0)
+
+        aot_fn = aot_function(fn, nop, hasher_type="BucketedShapeHasher", bucket_dims={0: 0})
+        with self.assertRaisesRegex(RuntimeError, "depends on the padded entries"):
+            aot_fn(torch.randn(5))
+
+
+@unittest.skipIf(IS_WINDOWS, 'test broken on windows')
+class TestCompileCacheFastPath(TestCase):
+    def setUp(self):
+        functorch.compile.clear_compile_cache()
+
+    def test_nested_args_and_static_args(self):
+        def fn(d, scale, x, y=None):
+            return d['a'][0] * scale + d['b'] * x + y
+
+        aot_fn = aot_function(fn, nop, static_argnums=(1,))
+        for _ in range(3):
+            d = {'b': torch.randn(3, requires_grad=True), 'a': [torch.randn(3, requires_grad=True)]}
+            x = torch.randn(3, requires_grad=True)
+            y = torch.randn(3)
+            self.assertEqual(aot_fn(d, 2.0, x, y=y), fn(d, 2.0, x, y=y))
+        aot_fn(d, 3.0, x, y=y)
+        stats = functorch.compile.compile_cache_stats()
+        self.assertEqual({k: stats[k] for k in ["hits", "misses", "evictions", "size"]},
+                         {"hits": 2, "misses": 2, "evictions": 0, "size": 2})
+
+    def test_python_fallback(self):
+        # namedtuples are flattened by pytree, not by the C++ fast path
+        Point = collections.namedtuple('Point', ['x', 'y'])
+
+        def fn(p):
+            return p.x * p.y
+
+        aot_fn = aot_function(fn, nop)
+        for _ in range(3):
+            p = Point(torch.randn(3, requires_grad=True), torch.randn(3))
+            self.assertEqual(aot_fn(p), fn(p))
+        self.assertEqual(functorch.compile.num_of_recompilations(), 1)
+
+
+@unittest.skipIf(IS_WINDOWS, 'test broken on windows')
+class TestAsyncCompile(TestCase):
+    def setUp(self):
+        functorch.compile.clear_compile_cache()
+        config.async_compile = True
+
+    def tearDown(self):
+        config.async_compile = False
+        functorch.compile.wait_for_async_compiles()
+
+    def test_eager_until_compiled(self):
+        release = threading.Event()
+
+        def blocking_compiler(fx_g, _):
+            release.wait()
+            return fx_g
+
+        def fn(x, y):
+            return (x * y).sin()
+
+        aot_fn = aot_function(fn, blocking_compiler)
+        for _ in range(3):
+            x = torch.randn(4, requires_grad=True)
+            y = torch.randn(4, requires_grad=True)
+            self.check_grads(fn, aot_fn, x, y)
+        release.set()
+        self.assertTrue(functorch.compile.wait_for_async_compiles(timeout=60))
+        for _ in range(2):
+            self.check_grads(fn, aot_fn, x, y)
+
+        stats = functorch.compile.compile_cache_stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["eager_calls"], 3)
+        self.assertEqual(stats["compiled_calls"], 2)
+
+    def test_compile_error_falls_back_to_eager(self):
+        release = threading.Event()
+
+        def failing_compiler(fx_g, _):
+            release.wait()
+            raise RuntimeError("compiler failure")
+
+        aot_fn = aot_function(torch.sin, failing_compiler)
+        x = torch.randn(4)
+        self.assertEqual(aot_fn(x), torch.sin(x))
+        release.set()
+        functorch.compile.wait_for_async_compiles()
+        with self.assertWarnsRegex(UserWarning, "compiler failure"):
+            self.assertEqual(aot_fn(x), torch.sin(x))
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            self.assertEqual(aot_fn(x), torch.sin(x))
+        stats = functorch.compile.compile_cache_stats()
+        self.assertEqual(stats["eager_calls"], 3)
+        self.assertEqual(stats["compiled_calls"], 0)
+
+    def test_rng_state_is_restored(self):
+        def fn(x):
+            return x + torch.rand_like(x)
+
+        x = torch.randn(4)
+        torch.manual_seed(0)
+        ref = fn(x), torch.rand(4)
+        torch.manual_seed(0)
+        aot_fn = aot_function(fn, nop)
+        res = aot_fn(x), torch.rand(4)
+        functorch.compile.wait_for_async_compiles()
+        self.assertEqual(res, ref)
+
+    def check_grads(self, fn, aot_fn, x, y):
+        ref = fn(x, y)
+        ref.sum().backward()
+        ref_grads = [x.grad, y.grad]
+        x.grad = y.grad = None
+        res = aot_fn(x, y)
+        res.sum().backward()
+        self.assertEqual(res, ref)
+        self.assertEqual([x.grad, y.grad], ref_grads)
+        x.grad = y.grad = None
+
+
+@unittest.skipIf(IS_WINDOWS, 'test broken on windows')
+class TestParallelCompile(TestCase):
+    def setUp(self):
+        functorch.compile.clear_compile_cache()
+        config.parallel_compile = True
+
+    def tearDown(self):
+        config.parallel_compile = False
+        functorch.compile.clear_compile_cache()
+
+    def test_backward_compiles_during_forward(self):
+        bw_started = threading.Event()
+        bw_args = []
+
+        def fw_compiler(fx_g, _):
+            # Only returns if the backward is compiled concurrently
+            self.assertTrue(bw_started.wait(timeout=60))
+            return fx_g
+
+        def bw_compiler(fx_g, args):
+            bw_started.set()
+            bw_args.extend(args)
+            return fx_g
+
+        def fn(x, y):
+            return (x @ y).sin().t()
+
+        x = torch.randn(3, 4, requires_grad=True)
+        y = torch.randn(4, 5, requires_grad=True)
+        ref = fn(x, y)
+        ref.sum().backward()
+        ref_grads = [x.grad, y.grad]
+        x.grad = y.grad = None
+
+        res = aot_function(fn, fw_compiler, bw_compiler)(x, y)
+        res.sum().backward()
+        self.assertEqual(res, ref)
+        self.assertEqual([x.grad, y.grad], ref_grads)
+        # The example inputs of the backward have the traced shapes
+        self.assertEqual([tuple(a.shape) for a in bw_args], [(3, 4), (4, 5), (3, 5), (5, 3)])
+
+    def test_forward_error(self):
+        def fw_compiler(fx_g, _):
+            raise RuntimeError("compiler failure")
+
+        with self.assertRaisesRegex(RuntimeError, "compiler failure"):
+            aot_function(torch.sin, fw_compiler, nop)(torch.randn(4, requires_grad=True))
+
+
+@unittest.skipIf(IS_WINDOWS, 'test broken on windows')
+class TestWarmup(TestCase):
+    def setUp(self):
+        functorch.compile.clear_compile_cache()
+
+    def test_warmup(self):
+        def fn(x, y, scale):
+            return (x * y).sin() * scale
+
+        aot_fn = aot_function(fn, nop, static_argnums=(2,))
+        signatures = [
+            (TensorSpec((4,), requires_grad=True), TensorSpec((4,)), 2.0),
+            (TensorSpec((3, 4), stride=(1, 3), requires_grad=True), TensorSpec((3, 4)), 2.0),
+            (TensorSpec((4,), dtype=torch.float64), TensorSpec((4,), dtype=torch.float64), 3.0),
+        ]
+        report = aot_fn.warmup(signatures, num_workers=2)
+        self.assertEqual([r["signature"] for r in report], signatures)
+        self.assertTrue(all(not r["cached"] and r["compile_time"] > 0 for r in report))
+        self.assertEqual(functorch.compile.num_of_recompilations(), 3)
+
+        x = torch.randn(4, 3).t().requires_grad_()
+        y = torch.randn(3, 4)
+        res = aot_fn(x, y, 2.0)
+        res.sum().backward()
+        ref_x = x.detach().clone().requires_grad_()
+        ref = fn(ref_x, y, 2.0)
+        ref.sum().backward()
+        self.assertEqual(res, ref)
+        self.assertEqual(x.grad, ref_x.grad)
+        aot_fn(torch.randn(4, requires_grad=True), torch.randn(4), 2.0)
+        aot_fn(torch.randn(4, dtype=torch.float64), torch.randn(4, dtype=torch.float64), 3.0)
+        self.assertEqual(functorch.compile.num_of_recompilations(), 3)
+
+        report = aot_fn.warmup(signatures[:1])
+        self.assertTrue(report[0]["cached"])
+
+    def test_keyword_args(self):
+        example_inputs = []
+
+        def recording_compiler(fx_g, inps):
+            example_inputs.extend(inps)
+            return fx_g
+
+        def fn(x, *, bias, scale=1.0):
+            return (x + bias) * scale
+
+        aot_fn = aot_function(fn, recording_compiler)
+        signatures = [CallSpec(TensorSpec((4,), requires_grad=True), bias=TensorSpec((4,)))]
+        torch.manual_seed(0)
+        ref_rand = torch.rand(4)
+        torch.manual_seed(0)
+        report = aot_fn.warmup(signatures)
+        self.assertEqual(torch.rand(4), ref_rand)
+        self.assertEqual([r["signature"] for r in report], signatures)
+        self.assertFalse(report[0]["cached"])
+        self.assertTrue(all((t != 0).any() for t in example_inputs))
+
+        x = torch.randn(4, requires_grad=True)
+        bias = torch.randn(4)
+        self.assertEqual(aot_fn(x, bias=bias), fn(x, bias=bias))
+        self.assertEqual(functorch.compile.num_of_recompilations(), 1)
+        self.assertTrue(aot_fn.warmup(signatures)[0]["cached"])
+
+
 if __name__ == "__main__":
     run_tests()
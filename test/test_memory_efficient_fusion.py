@@ -3,7 +3,7 @@ import torch.nn as nn
 import torch.fx as fx
 from functorch import make_fx
 from torch.nn import functional as F
-from functorch.compile import memory_efficient_fusion
+from functorch.compile import memory_efficient_fusion, config
 from functorch._src.compile_utils import fx_graph_cse
 from torch.testing._internal.common_utils import TestCase, run_tests
 import inspect
@@ -344,6 +344,73 @@ class ReduceTestCase(TestCase):
         t = torch.randn(2, 2)
         check(f, t, 1)
 
+    def test_commutative(self):
+        def f(x, y):
+            a = x + y
+            b = y + x
+            c = x * y
+            d = y * x
+            return a + b + c + d
+        fx_g = make_fx(f)(torch.randn(2, 2), torch.randn(2, 2))
+        new_graph = fx_graph_cse(fx_g.graph)
+        self.assertEqual(len(fx_g.graph.nodes) - len(new_graph.nodes), 2)
+
+    def test_alpha_is_not_commutative(self):
+        def f(x, y):
+            return torch.add(x, y, alpha=2) + torch.add(y, x, alpha=2)
+        fx_g = make_fx(f)(torch.randn(2, 2), torch.randn(2, 2))
+        new_graph = fx_graph_cse(fx_g.graph)
+        self.assertEqual(len(fx_g.graph.nodes), len(new_graph.nodes))
+
+    def test_fold_constants(self):
+        def f(x):
+            scale = torch.ones(4).cumsum(0) * 2
+            return x * scale
+        t = torch.randn(4)
+        fx_g = make_fx(f)(t)
+        self.assertEqual(len(fx_graph_cse(fx_g.graph).nodes), len(fx_g.graph.nodes))
+        config.fold_constants = True
+        try:
+            new_graph = fx_graph_cse(fx_g.graph)
+        finally:
+            config.fold_constants = False
+        new_g = fx.GraphModule(fx_g, new_graph)
+        targets = [n.target for n in new_graph.nodes if n.op == 'call_function']
+        self.assertEqual(targets, [torch.ops.aten.mul.Tensor])
+        self.assertEqual(new_g(t), fx_g(t))
+
+    def test_no_folding_of_parameters(self):
+        class M(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.weight = torch.nn.Parameter(torch.randn(4))
+
+            def forward(self, x):
+                return x * self.weight.cos()
+
+        with torch.no_grad():
+            fx_g = make_fx(M())(torch.randn(4))
+        config.fold_constants = True
+        try:
+            new_graph = fx_graph_cse(fx_g.graph)
+        finally:
+            config.fold_constants = False
+        targets = [n.target for n in new_graph.nodes if n.op == 'call_function']
+        self.assertEqual(targets, [torch.ops.aten.cos.default, torch.ops.aten.mul.Tensor])
+
+    def test_no_folding_with_mutation(self):
+        def f(x):
+            scale = torch.ones(4) * 2
+            x.add_(1)
+            return x * scale
+        fx_g = make_fx(f)(torch.randn(4))
+        config.fold_constants = True
+        try:
+            new_graph = fx_graph_cse(fx_g.graph)
+        finally:
+            config.fold_constants = False
+        self.assertFalse(any(n.op == 'get_attr' for n in new_graph.nodes))
+
 
 class RandomOpTestCase(TestCase):
     def test_random(self):
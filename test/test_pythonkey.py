@@ -10,18 +10,33 @@ import torch.nn as nn
 import torch.utils._pytree as pytree
 import unittest
 import warnings
+import weakref
 import itertools
+import json
+import math
+import os
+import tempfile
+import types
 from functools import partial
 from torch.testing._internal.common_device_type import instantiate_device_type_tests
 from functorch import (
     grad, vjp, vmap, jacrev,
     make_fx
 )
-from functorch._src.aot_autograd import aot_module_simplified
+from functorch._src.aot_autograd import aot_module_simplified, create_joint_forward_backward
+from functorch._src.min_cut import FlowGraph
+from functorch._src.partitioners import _size_of, _node_devices, SYMBOLIC_DIM_HINT
+from torch.fx.passes.shape_prop import TensorMetadata
+from functorch._src.memory_planner import out_variant
 from functorch.compile import (
     nnc_jit, compiled_function, compiled_module,
-    min_cut_rematerialization_partition, aot_function, aot_module, decomposition_table, nop,
+    min_cut_rematerialization_partition, memory_budget_partition, aot_function, aot_module, decomposition_table,
+    nop, boxed_nop,
     num_of_recompilations, default_partition, default_decompositions, memory_efficient_fusion,
+    CompileProfiler, register_compile_callback, remove_compile_callback, config,
+    clear_compile_cache, compile_cache_stats, CostModel, activation_offload_partition, HostOffloader,
+    memory_timeline, plan_memory, nvfuser_profile, tvm_profile, partition_cache_stats, clear_partition_cache,
+    FusionPattern, apply_fusion_patterns,
 )
 
 from torch.testing._internal.common_device_type import ops
@@ -43,14 +58,6 @@ except ImportError:
                   "`--no-deps` to avoid overwriting the pytorch installation",
                   UserWarning)
 
-USE_NETWORKX = False
-try:
-    import networkx  # noqa: F401
-    USE_NETWORKX = True
-except ImportError:
-    warnings.warn("Some tests use networkx but it was not installed",
-                  UserWarning)
-
 # NB: numpy is a testing dependency!
 
 
@@ -64,6 +71,19 @@ class TestPythonKey(TestCase):
         new_inp = torch.randn(3)
         self.assertEqual(fx_f(new_inp), f(new_inp))
 
+    def test_make_fx_meta(self, device):
+        def f(x, y):
+            return torch.mm(x, y).relu() + torch.ones(x.shape[0], 1, device=x.device)
+        inps = [torch.randn(4, 3, device=device), torch.randn(3, 5, device=device)]
+        fx_f = make_fx(f, tracing_mode="meta")(*inps)
+        for node in fx_f.graph.nodes:
+            if node.op not in ('placeholder', 'output'):
+                self.assertIn('tensor_meta', node.meta)
+        self.assertEqual(fx_f.graph.nodes.__iter__().__next__().meta['tensor_meta'].shape, (4, 3))
+
+        new_inps = [torch.randn(4, 3, device=device), torch.randn(3, 5, device=device)]
+        self.assertEqual(fx_f(*new_inps), f(*new_inps))
+
     def test_make_fx_grad(self, device):
         def f(x):
             return torch.sin(x).sum()
@@ -306,6 +326,105 @@ class TestAOTAutograd(TestCase):
         x = torch.ones(1, 4, 2, 2)
         mod(x).sum().backward()
 
+    def test_single_forward_execution(self):
+        # The output metadata comes from a pass on meta tensors, so the first
+        # call only runs the function with real tensors while tracing.
+        real_calls = 0
+
+        def f(a, b):
+            nonlocal real_calls
+            if not a.is_meta:
+                real_calls += 1
+            return torch.mm(a, b).relu(), a.sum(dim=0)
+
+        inp = [torch.randn(4, 3, requires_grad=True), torch.randn(3, 5, requires_grad=True)]
+        self.verify_aot_autograd(f, inp)
+        self.assertEqual(real_calls, 2)
+
+    def test_meta_tracing_mode(self):
+        real_calls = 0
+
+        def f(a, b):
+            nonlocal real_calls
+            if not a.is_meta:
+                real_calls += 1
+            return torch.mm(a, b).relu() * torch.full((1, 5), 2.0, device=a.device)
+
+        inp = [torch.randn(4, 3, requires_grad=True), torch.randn(3, 5, requires_grad=True)]
+        config.tracing_mode = "meta"
+        try:
+            self.verify_aot_autograd(f, inp)
+        finally:
+            config.tracing_mode = "real"
+        # Only the reference ran on real tensors
+        self.assertEqual(real_calls, 1)
+
+    def test_output_metadata_fallback(self):
+        # Falls back to an eager forward when the function can't run on meta
+        # tensors, here because it creates a tensor on the cpu.
+        real_calls = 0
+
+        def f(a):
+            nonlocal real_calls
+            if not a.is_meta:
+                real_calls += 1
+            return (a + torch.ones(3)).cos()
+
+        inp = [torch.randn(3, requires_grad=True)]
+        self.verify_aot_autograd(f, inp)
+        self.assertEqual(real_calls, 3)
+
+    def test_boxed_nop_frees_saved_tensors(self):
+        # The compile cache is keyed by the ids of the compilers, so keep them
+        # alive to avoid reusing an entry of a freed compiler.
+        compilers = []
+
+        # Probes at the end of the backward whether the saved tensors of the
+        # forward are still alive.
+        def alive_at_end_of_backward(bw_compiler):
+            saved = []
+            alive = []
+
+            def fw_compiler(fx_g, _):
+                def fw(*args):
+                    outs = fx_g(*args)
+                    saved[:] = [weakref.ref(t) for t in outs[1:]]
+                    return outs
+                return fw
+
+            def probe():
+                alive.append([ref() is not None for ref in saved])
+
+            def compiler(fx_g, inps):
+                output = next(node for node in fx_g.graph.nodes if node.op == "output")
+                with fx_g.graph.inserting_before(output):
+                    fx_g.graph.call_function(probe, ())
+                fx_g.recompile()
+                return bw_compiler(fx_g, inps)
+
+            def f(x):
+                return x.cos().cos().sum()
+
+            x = torch.randn(4, requires_grad=True)
+            compiled_f = aot_function(f, fw_compiler, compiler)
+            compilers.append((f, fw_compiler, compiler))
+            for _ in range(2):
+                compiled_f(x).backward()
+            self.assertEqual(x.grad, 2 * x.cos().sin() * x.sin())
+            return alive[-1]
+
+        # The forward saves its input, which the caller holds, and cos(x)
+        self.assertEqual(alive_at_end_of_backward(nop), [True, True])
+        self.assertEqual(alive_at_end_of_backward(boxed_nop), [True, False])
+
+        # A retained graph keeps its saved tensors
+        compiled_f = aot_function(lambda x: x.sin().sin().sum(), nop, boxed_nop)
+        x = torch.randn(4, requires_grad=True)
+        out = compiled_f(x)
+        out.backward(retain_graph=True)
+        out.backward()
+        self.assertEqual(x.grad, 2 * x.sin().cos() * x.cos())
+
 
 class TestEagerFusionOpInfo(TestCase):
     @ops(functorch_lagging_op_db + additional_op_db, allowed_dtypes=(torch.float,))
@@ -415,7 +534,6 @@ def get_fw_bw_graph(f, inps, partitioner=min_cut_rematerialization_partition):
 
 
 class TestPartitioning(TestCase):
-    @unittest.skipIf(not USE_NETWORKX, "networkx not available")
     def test_recompute_partitioning(self):
         def fn(a, b):
             return torch.sin(torch.sin(a)) + b
@@ -477,7 +595,6 @@ class TestPartitioning(TestCase):
         self.assertEqual(get_num_ins_outs(fw_graph), (3, 6))
         self.assertEqual(get_num_ins_outs(bw_graph), (6, 3))
 
-    @unittest.skipIf(not USE_NETWORKX, "networkx not available")
     def test_min_cut_partitioner(self):
         def f(x):
             return x.cos().cos().cos()
@@ -502,6 +619,248 @@ class TestPartitioning(TestCase):
         ins, outs = get_ins_outs(fw_graph)
         self.assertEqual(outs[1].target, torch.ops.aten.mm.default)
 
+    def test_flow_graph_minimum_cut(self):
+        g = FlowGraph(6)
+        for u, v, capacity in [(0, 2, 3), (0, 3, math.inf), (2, 4, 1), (3, 4, 2), (3, 5, 5), (4, 1, 4), (5, 1, 1)]:
+            g.add_edge(u, v, capacity)
+        value, (reachable, non_reachable) = g.minimum_cut(0, 1)
+        self.assertEqual(value, 4)
+        self.assertEqual(non_reachable, {1, 4})
+        self.assertEqual(reachable | non_reachable, set(range(6)))
+        self.assertEqual(sorted(g.cut_edges(reachable)), [(2, 4), (3, 4), (5, 1)])
+
+        g = FlowGraph(2)
+        g.add_edge(0, 1, math.inf)
+        with self.assertRaisesRegex(RuntimeError, "unbounded"):
+            g.minimum_cut(0, 1)
+
+    def test_memory_budget_partitioner(self):
+        def f(x):
+            return x.cos().cos().cos()
+
+        inps = [torch.randn(16, requires_grad=True)]
+        for budget, num_saved in [(None, 3), (3 * 16 * 4, 3), (2 * 16 * 4, 2), (16 * 4, 1)]:
+            partitioner = partial(memory_budget_partition, memory_budget=budget)
+            fw_graph, bw_graph = get_fw_bw_graph(f, inps, partitioner=partitioner)
+            self.assertEqual(get_num_ins_outs(fw_graph), (1, 1 + num_saved))
+            self.assertEqual(get_num_ins_outs(bw_graph), (1 + num_saved, 1))
+
+        ref_x = inps[0].detach().clone().requires_grad_()
+        ref = f(ref_x)
+        ref.sum().backward()
+        partitioner = partial(memory_budget_partition, memory_budget=16 * 4)
+        res = aot_function(f, nop, partition_fn=partitioner)(*inps)
+        res.sum().backward()
+        self.assertEqual(res, ref)
+        self.assertEqual(inps[0].grad, ref_x.grad)
+
+        # The input has to be saved, so no partition fits in fewer bytes
+        partitioner = partial(memory_budget_partition, memory_budget=8 * 4)
+        with self.assertWarnsRegex(UserWarning, "saves 64 bytes .* exceeds the memory budget of 32 bytes"):
+            fw_graph, _ = get_fw_bw_graph(f, inps, partitioner=partitioner)
+        self.assertEqual(get_num_ins_outs(fw_graph), (1, 2))
+
+    def test_memory_budget_partitioner_keeps_matmuls(self):
+        def f(a, b):
+            return torch.mm(a, b).cos().cos()
+
+        # Only the pointwise ops can be recomputed, so the output of mm stays
+        inps = [torch.randn(8, 4, requires_grad=True), torch.randn(4, 8, requires_grad=True)]
+        partitioner = partial(memory_budget_partition, memory_budget=(8 * 4 * 2 + 8 * 8) * 4)
+        fw_graph, _ = get_fw_bw_graph(f, inps, partitioner=partitioner)
+        _, outs = get_ins_outs(fw_graph)
+        self.assertEqual(len(outs), 4)
+        self.assertIn(torch.ops.aten.mm.default, [out.target for out in outs[1:]])
+
+    def test_cost_model_partitioner(self):
+        def f(a, b):
+            return torch.mm(a, b).cos().cos()
+
+        inps = [torch.randn(8, 4, requires_grad=True), torch.randn(4, 8, requires_grad=True)]
+        fx_g = make_fx(f)(*inps)
+        mm_node = next(node for node in fx_g.graph.nodes if node.target == torch.ops.aten.mm.default)
+        cost_model = CostModel(peak_flops=1e12, memory_bandwidth=1e11)
+        self.assertEqual(cost_model.flops(mm_node), 2 * 8 * 8 * 4)
+        self.assertEqual(cost_model.bytes_accessed(mm_node), (8 * 4 * 2 + 8 * 8) * 4)
+        self.assertEqual(cost_model.recompute_time(mm_node), 8 * 4 * 2 * 4 / 1e11)
+
+        # Whether the matmul is recomputed depends on how fast the machine computes
+        for peak_flops, saves_mm in [(1e15, False), (1e9, True)]:
+            partitioner = partial(min_cut_rematerialization_partition, cost_model=CostModel(peak_flops=peak_flops))
+            fw_graph, _ = get_fw_bw_graph(f, inps, partitioner=partitioner)
+            _, outs = get_ins_outs(fw_graph)
+            self.assertEqual(torch.ops.aten.mm.default in [out.target for out in outs[1:]], saves_mm)
+
+        calibrated = CostModel.calibrate(size=64, repeat=2)
+        self.assertGreater(calibrated.peak_flops, 0)
+        self.assertGreater(calibrated.memory_bandwidth, 0)
+
+    def test_backend_profile(self):
+        def f(x):
+            return x.cos().t().cos().t().cos()
+
+        inps = [torch.randn(8, 8, requires_grad=True)]
+
+        def partition(profile, partitioner=min_cut_rematerialization_partition):
+            fw_graph, bw_graph = get_fw_bw_graph(f, inps, partitioner=partial(partitioner, backend_profile=profile))
+            _, outs = get_ins_outs(fw_graph)
+            bw_ops = [node.target for node in bw_graph.graph.nodes]
+            return [str(out.target) for out in outs[1:]], bw_ops
+
+        # NVFuser can't fuse the transposes, TVM can recompute them
+        saved, _ = partition(nvfuser_profile)
+        self.assertEqual(saved, ["primals_1", "aten.t.default", "aten.t.default"])
+        saved, bw_ops = partition(tvm_profile)
+        self.assertEqual(saved, ["primals_1"])
+        self.assertIn(torch.ops.aten.cos.default, bw_ops)
+        _, bw_ops = partition(tvm_profile.replace(banned_ops=[torch.ops.aten.cos]))
+        self.assertNotIn(torch.ops.aten.cos.default, bw_ops)
+
+        # Ops that are infinitely expensive to recompute are saved
+        budget = partial(memory_budget_partition, memory_budget=8 * 8 * 4)
+        _, bw_ops = partition(tvm_profile, budget)
+        self.assertIn(torch.ops.aten.cos.default, bw_ops)
+        _, bw_ops = partition(tvm_profile.replace(op_costs={torch.ops.aten.cos: math.inf}), budget)
+        self.assertNotIn(torch.ops.aten.cos.default, bw_ops)
+
+    def test_node_devices(self):
+        def f(a, b):
+            return a.cos().to("meta").sin(), b.sin(), torch.zeros(2, device="meta")
+
+        inps = (torch.randn(2), torch.randn(2, device="meta"))
+        devices = _node_devices(make_fx(f)(*inps), inps)
+        cpu, meta = torch.device("cpu"), torch.device("meta")
+        self.assertEqual(
+            {name: devices[name] for name in ["a_1", "b_1", "cos", "_to_copy", "sin", "sin_1", "zeros"]},
+            {"a_1": cpu, "b_1": meta, "cos": cpu, "_to_copy": meta, "sin": meta, "sin_1": meta, "zeros": meta},
+        )
+
+    def test_size_of(self):
+        def meta(shape, dtype):
+            return TensorMetadata(shape, dtype, False, None, None, False, {})
+
+        self.assertEqual(_size_of(meta((2, 3), torch.complex64)), 2 * 3 * 8)
+        self.assertEqual(_size_of(meta((2, 3), torch.complex128)), 2 * 3 * 16)
+        self.assertEqual(_size_of(meta((5,), torch.quint4x2)), 3)
+        # Tuples of tensors, and fake tensors
+        self.assertEqual(_size_of((meta((4,), torch.float16), meta((4,), torch.int64))), 4 * 2 + 4 * 8)
+        self.assertEqual(_size_of(torch.empty(2, 4, device="meta", dtype=torch.bfloat16)), 2 * 4 * 2)
+
+        # Symbolic dimensions count as their hint, or a default guess
+        class Unknown(object):
+            def __int__(self):
+                raise TypeError("symbolic")
+
+        hinted = types.SimpleNamespace(node=types.SimpleNamespace(hint=3))
+        self.assertEqual(_size_of(meta((hinted, 2), torch.float32)), 3 * 2 * 4)
+        self.assertEqual(_size_of(meta((Unknown(), 2), torch.float32)), SYMBOLIC_DIM_HINT * 2 * 4)
+
+    def test_complex_min_cut(self):
+        def f(x, w):
+            return (torch.mm(x, w).cos() * 2).sin().abs().sum()
+
+        inps = [torch.randn(4, 4, dtype=torch.complex64, requires_grad=True),
+                torch.randn(4, 4, dtype=torch.complex64, requires_grad=True)]
+        fw_graph, _ = get_fw_bw_graph(f, inps)
+        _, outs = get_ins_outs(fw_graph)
+        # The pointwise ops on the complex matmul are recomputed
+        self.assertEqual(outs[1].target, torch.ops.aten.mm.default)
+        self.assertEqual(len(outs), 4)
+
+        ref_inps = [x.detach().requires_grad_() for x in inps]
+        f(*ref_inps).backward()
+        aot_function(f, nop, partition_fn=min_cut_rematerialization_partition)(*inps).backward()
+        self.assertEqual([x.grad for x in inps], [x.grad for x in ref_inps])
+
+    def test_partition_cache(self):
+        def f(a, b):
+            return (torch.mm(a, b).cos() * 2).sin().sum(dim=1)
+
+        def saved_ops(batch_size):
+            inps = [torch.randn(batch_size, 4, requires_grad=True), torch.randn(4, 8, requires_grad=True)]
+            fw_graph, _ = get_fw_bw_graph(f, inps)
+            _, outs = get_ins_outs(fw_graph)
+            return [str(out.target) for out in outs]
+
+        clear_partition_cache()
+        config.cache_partitions = True
+        try:
+            with CompileProfiler() as prof:
+                cut = saved_ops(4)
+                self.assertEqual(saved_ops(16), cut)
+            self.assertEqual(partition_cache_stats(), {"hits": 1, "misses": 1, "hit_rate": 0.5, "size": 1})
+            # Only the first graph was cut
+            self.assertEqual(prof.summary()["min_cut"]["calls"], 1)
+            self.assertEqual(prof.summary()["partition_cache"]["hit"], 1)
+
+            # Cost models that only differ beyond the precision of their repr
+            # get cuts of their own
+            for peak_flops in [1e12, 1.0001e12]:
+                partitioner = partial(min_cut_rematerialization_partition, cost_model=CostModel(peak_flops=peak_flops))
+                get_fw_bw_graph(f, [torch.randn(4, 4, requires_grad=True), torch.randn(4, 8, requires_grad=True)],
+                                partitioner=partitioner)
+            self.assertEqual(partition_cache_stats()["misses"], 3)
+        finally:
+            config.cache_partitions = False
+
+        self.assertEqual(saved_ops(16), cut)
+        self.assertEqual(partition_cache_stats()["hits"], 1)
+        clear_partition_cache()
+        self.assertEqual(partition_cache_stats(), {"hits": 0, "misses": 0, "hit_rate": 0.0, "size": 0})
+
+    def test_activation_offload_partitioner(self):
+        class SimulatedDeviceOffloader(HostOffloader):
+            # Treats CPU memory as the device, and tracks the bytes of saved
+            # tensors that were moved out of its memory pool
+            def __init__(self):
+                super().__init__()
+                self.device_pool = set()
+                self.host_bytes = 0
+                self.prefetch_devices = []
+                self.waited_for_prefetched = []
+
+            def offload(self, tensor):
+                self.host_bytes += tensor.numel() * tensor.element_size()
+                return tensor.clone()
+
+            def prefetch(self, tensor, device):
+                prefetched = tensor.clone()
+                self.device_pool.add(id(prefetched))
+                self.prefetch_devices.append(device)
+                return prefetched
+
+            def wait(self, tensor):
+                self.waited_for_prefetched.append(id(tensor) in self.device_pool)
+                return tensor
+
+        def f(a, b):
+            return torch.mm(a, b).cos().cos()
+
+        inps = [torch.randn(64, 64, requires_grad=True), torch.randn(64, 64, requires_grad=True)]
+        ref_inps = [x.detach().clone().requires_grad_() for x in inps]
+        f(*ref_inps).sum().backward()
+        # Offloading is cheap, so all the 64x64 intermediates are offloaded
+        offloader = SimulatedDeviceOffloader()
+        partitioner = partial(activation_offload_partition, min_offload_bytes=64 * 64 * 4,
+                              cost_model=CostModel(offload_bandwidth=1e15), offloader=offloader)
+        res = aot_function(f, nop, partition_fn=partitioner)(*inps)
+        res.sum().backward()
+        self.assertEqual(res, f(*ref_inps))
+        self.assertEqual([x.grad for x in inps], [x.grad for x in ref_inps])
+        self.assertGreater(offloader.host_bytes, 0)
+        num_waits = len(offloader.waited_for_prefetched)
+        self.assertEqual(offloader.host_bytes, num_waits * 64 * 64 * 4)
+        self.assertTrue(all(offloader.waited_for_prefetched))
+        self.assertEqual(offloader.prefetch_devices, [torch.device("cpu")] * num_waits)
+
+        # Recomputing the matmul from the inputs is faster than offloading it
+        partitioner = partial(activation_offload_partition, min_offload_bytes=64 * 64 * 4,
+                              cost_model=CostModel(offload_bandwidth=1e6), offloader=offloader)
+        fw_graph, bw_graph = get_fw_bw_graph(f, inps, partitioner=partitioner)
+        _, outs = get_ins_outs(fw_graph)
+        self.assertNotIn(torch.ops.aten.mm.default, [out.target for out in outs[1:]])
+        self.assertEqual([node.target for node in bw_graph.graph.nodes].count(torch.ops.aten.mm.default), 3)
+
 
 class TestContiguous(TestCase):
     def test_contiguous(self):
@@ -515,6 +874,315 @@ class TestContiguous(TestCase):
         out = aot_function(f, nop)(inp)
         torch.autograd.grad(out, inp, torch.randn(3, 2))
 
+    def test_cotangent_copies(self):
+        def f(x):
+            return x.sin() * 2
+
+        clear_compile_cache()
+        inp = torch.randn(3, 4, requires_grad=True)
+        aot_f = aot_function(f, nop)
+        aot_f(inp).sum().backward()
+        self.assertEqual(inp.grad, inp.cos() * 2)
+        # The gradient of sum() is expanded, so it is copied
+        stats = compile_cache_stats()
+        self.assertEqual(stats["cotangent_copies"], 1)
+        self.assertEqual(stats["cotangent_copy_bytes"], 3 * 4 * 4)
+
+        inp.grad = None
+        aot_f(inp).backward(torch.ones(3, 4))
+        self.assertEqual(compile_cache_stats()["cotangent_copies"], 1)
+
+    def test_specialize_backward_strides(self):
+        num_bw_compiles = 0
+
+        def count_bw_compiles(fx_g, _):
+            nonlocal num_bw_compiles
+            num_bw_compiles += 1
+            return fx_g
+
+        def f(x):
+            return x.sin() * 2
+
+        def g(x):
+            return x.view(2, 3) * 2
+
+        clear_compile_cache()
+        config.specialize_backward_strides = True
+        try:
+            inp = torch.randn(3, 4, requires_grad=True)
+            aot_f = aot_function(f, nop, count_bw_compiles)
+            for _ in range(2):
+                inp.grad = None
+                aot_f(inp).sum().backward()
+                self.assertEqual(inp.grad, inp.cos() * 2)
+            self.assertEqual(num_bw_compiles, 2)
+            self.assertEqual(compile_cache_stats()["cotangent_copies"], 0)
+
+            # The backward views the cotangent, which only works once copied
+            inp = torch.randn(6, requires_grad=True)
+            cotangent = torch.randn(3, 2).t()
+            out = aot_function(g, nop)(inp)
+            self.assertEqual(torch.autograd.grad(out, inp, cotangent)[0], cotangent.reshape(6) * 2)
+            self.assertEqual(compile_cache_stats()["cotangent_copies"], 1)
+
+            # Errors of the compiler aren't mistaken for unsupported layouts
+            def fail_on_layouts(fx_g, inps):
+                if not inps[-1].is_contiguous():
+                    raise RuntimeError("compiler failure")
+                return fx_g
+
+            inp = torch.randn(3, 4, requires_grad=True)
+            with self.assertRaisesRegex(RuntimeError, "compiler failure"):
+                aot_function(f, nop, fail_on_layouts)(inp).sum().backward()
+        finally:
+            config.specialize_backward_strides = False
+
+
+class TestCompileProfiler(TestCase):
+    def test_phases(self):
+        def f(x, y):
+            return (x * y).cos().cos()
+
+        x = torch.randn(8, 8, requires_grad=True)
+        y = torch.randn(8, 8, requires_grad=True)
+        with CompileProfiler() as prof:
+            aot_function(f, nop, partition_fn=min_cut_rematerialization_partition)(x, y)
+        summary = prof.summary()
+        for phase in ["aot_compile", "output_metadata", "make_fx", "fx_graph_cse", "min_cut",
+                      "partition", "fw_compiler", "bw_compiler"]:
+            self.assertEqual(summary[phase]["calls"], 1)
+            self.assertGreaterEqual(summary[phase]["total_time"], 0)
+        self.assertGreater(summary["make_fx"]["nodes_after"], 0)
+        self.assertGreaterEqual(summary["fx_graph_cse"]["nodes_before"], summary["fx_graph_cse"]["nodes_after"])
+        # The backward recomputes x * y, so only x and y are saved
+        self.assertEqual(summary["partition"]["num_saved"], 2)
+        self.assertEqual(summary["partition"]["saved_bytes"], 2 * 8 * 8 * 4)
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "trace.json")
+            prof.export_chrome_trace(path)
+            with open(path) as trace:
+                events = json.load(trace)["traceEvents"]
+        self.assertEqual(len(events), len(prof.events))
+        self.assertTrue(all(e["ph"] == "X" and e["dur"] >= 0 for e in events))
+
+    def test_callback(self):
+        events = []
+        register_compile_callback(events.append)
+        try:
+            aot_function(torch.sin, nop)(torch.randn(3, requires_grad=True))
+        finally:
+            remove_compile_callback(events.append)
+        self.assertEqual(events[-1].name, "aot_compile")
+        self.assertIn("make_fx", [e.name for e in events])
+
+        events.clear()
+        aot_function(torch.cos, nop)(torch.randn(3, requires_grad=True))
+        self.assertEqual(events, [])
+
+
+class TestPartitionReport(TestCase):
+    def setUp(self):
+        config.partition_reports = True
+
+    def tearDown(self):
+        config.partition_reports = False
+
+    def test_memory_timeline(self):
+        fx_g = make_fx(lambda x: ((x + 1) * 2).sum())(torch.randn(16))
+        # The input stays alive, and the result of the add is freed after the mul
+        self.assertEqual([live for _, live in memory_timeline(fx_g)], [64, 128, 192, 132, 68])
+
+    def test_partition_report(self):
+        def f(x):
+            return x.cos().cos()
+
+        x = torch.randn(16, requires_grad=True)
+        aot_fn = aot_function(f, nop, partition_fn=min_cut_rematerialization_partition)
+        aot_fn(x).sum().backward()
+        reports = aot_fn.partition_reports()
+        self.assertEqual(len(reports), 1)
+        report = reports[0]
+        self.assertEqual(report.num_saved, 1)
+        saved = report.saved_tensors[0]
+        self.assertEqual((saved.op, saved.shape, saved.dtype, saved.nbytes, saved.reason),
+                         ("input", (16,), torch.float32, 64, "input"))
+        self.assertEqual(report.fw_peak_memory, 3 * 64)
+        self.assertEqual(report.bw_peak_memory, max(live for _, live in report.bw_timeline))
+        self.assertIn("primals_1", str(report))
+
+        # Recomputing is banned for the matmul, so it is saved
+        def f(a, b):
+            return torch.mm(a, b).cos()
+
+        inps = [torch.randn(4, 4, requires_grad=True), torch.randn(4, 4, requires_grad=True)]
+        aot_fn = aot_function(f, nop, partition_fn=min_cut_rematerialization_partition)
+        aot_fn(*inps)
+        reasons = {saved.op: saved.reason for saved in aot_fn.partition_reports()[0].saved_tensors}
+        self.assertEqual(reasons["aten.mm.default"], "recomputation banned")
+
+        # Reports are only built on request
+        config.partition_reports = False
+
+        def g(a, b):
+            return torch.mm(a, b).sin()
+
+        aot_fn = aot_function(g, nop, partition_fn=min_cut_rematerialization_partition)
+        aot_fn(*inps)
+        self.assertEqual(aot_fn.partition_reports(), [])
+
+
+class TestMemoryPlanning(TestCase):
+    def test_out_variant(self):
+        aten = torch.ops.aten
+        self.assertEqual(out_variant(aten.mm.default), aten.mm.out)
+        self.assertEqual(out_variant(aten.sum.dim_IntList), aten.sum.IntList_out)
+        self.assertIsNone(out_variant(aten.native_dropout.default))
+        self.assertIsNone(out_variant(aten.add_.Tensor))
+
+    def test_plan_memory(self):
+        def f(x, w):
+            for _ in range(4):
+                x = torch.mm(x, w).relu() + 1
+            return x.sum(1)
+
+        inps = [torch.randn(8, 8), torch.randn(8, 8)]
+        fx_g = plan_memory(make_fx(f)(*inps), inps)
+        plan = fx_g.memory_plan
+        # Each intermediate is dead once the next one is computed
+        self.assertEqual(plan.num_planned, 12)
+        self.assertEqual(plan.total_bytes, 12 * 8 * 8 * 4)
+        self.assertEqual(plan.arena_bytes, 2 * 8 * 8 * 4)
+        self.assertEqual(plan.naive_peak_bytes, plan.arena_bytes)
+        self.assertEqual(fx_g(*inps), f(*inps))
+        self.assertEqual(fx_g(*inps), f(*inps))
+
+    def test_plan_memory_views(self):
+        def f(x, w):
+            a, b = torch.mm(x, w).relu().split(4)
+            c = torch.mm(b, w).cos().chunk(2, dim=1)[0]
+            return a.narrow(1, 0, 4), c.sum(1)
+
+        inps = [torch.randn(8, 8), torch.randn(8, 8)]
+        fx_g = plan_memory(make_fx(f)(*inps), inps)
+        # The output is a view of the result of relu, so it isn't planned
+        self.assertEqual(sorted(fx_g.memory_plan.offsets), ["cos", "mm", "mm_1"])
+        ref = f(*inps)
+        out = fx_g(*inps)
+        fx_g(torch.randn(8, 8), torch.randn(8, 8))
+        self.assertEqual(out, ref)
+
+    def test_aot_function_memory_planning(self):
+        def f(x, w):
+            return (torch.mm(x, w).relu() * 2).cos().sum(1)
+
+        inps = [torch.randn(8, 8, requires_grad=True), torch.randn(8, 8, requires_grad=True)]
+        ref_inps = [x.detach().clone().requires_grad_() for x in inps]
+        ref_out, ref_grads = _outs_and_grads(f, ref_inps)
+        config.memory_planning = config.partition_reports = True
+        try:
+            aot_fn = aot_function(f, nop)
+            out, grads = _outs_and_grads(aot_fn, inps)
+        finally:
+            config.memory_planning = config.partition_reports = False
+        self.assertEqual(out, ref_out)
+        self.assertEqual(grads, ref_grads)
+        report = aot_fn.partition_reports()[0]
+        self.assertGreater(report.bw_memory_plan.num_planned, 0)
+        self.assertLessEqual(report.bw_memory_plan.arena_bytes, report.bw_memory_plan.total_bytes)
+
+
+def _joint_graph(f, inps):
+    outs = f(*inps)
+    return make_fx(create_joint_forward_backward(f))(list(inps), [torch.randn_like(out) for out in outs])
+
+
+def _call_targets(fx_g):
+    return {node.target for node in fx_g.graph.nodes if node.op == "call_function"}
+
+
+class TestFusionPatterns(TestCase):
+    def test_rewrite_joint_graph(self):
+        aten = torch.ops.aten
+        F = torch.nn.functional
+
+        def f(x, bias, mask):
+            h = F.dropout(F.gelu(x + bias), 0.1, training=True)
+            scores = (h @ h.transpose(-1, -2)).unsqueeze(1)
+            return (F.dropout(torch.softmax(scores + mask, -1), 0.2, training=True).sum(),)
+
+        inps = [torch.randn(4, 8, 16, requires_grad=True), torch.randn(16, requires_grad=True), torch.randn(4, 1, 1, 8)]
+        fx_g = _joint_graph(f, inps)
+        tangents = [torch.ones(())]
+        torch.manual_seed(0)
+        ref = pytree.tree_flatten(fx_g(inps, tangents))[0]
+        self.assertEqual(apply_fusion_patterns(fx_g), 2)
+        targets = _call_targets(fx_g)
+        for op in [aten.gelu.default, aten.gelu_backward.default, aten._softmax.default,
+                   aten._softmax_backward_data.default]:
+            self.assertNotIn(op, targets)
+        torch.manual_seed(0)
+        self.assertEqual(pytree.tree_flatten(fx_g(inps, tangents))[0], ref)
+        # The replacements don't match again
+        self.assertEqual(apply_fusion_patterns(fx_g), 0)
+
+    def test_aot_function_layer_norm(self):
+        def f(x, residual, weight, bias):
+            return torch.nn.functional.layer_norm(x + residual, (16,), weight, bias, 1e-12).cos()
+
+        graphs = []
+
+        def compiler(fx_g, _):
+            graphs.append(fx_g)
+            return fx_g
+
+        inps = [torch.randn(2, 4, 16, requires_grad=True), torch.randn(2, 4, 16),
+                torch.randn(16, requires_grad=True), torch.randn(16, requires_grad=True)]
+        ref_inps = [x.detach().clone().requires_grad_(x.requires_grad) for x in inps]
+        ref_out, ref_grads = _outs_and_grads(f, ref_inps)
+        config.rewrite_fusion_patterns = True
+        try:
+            with CompileProfiler() as prof:
+                out, grads = _outs_and_grads(aot_function(f, compiler), inps)
+        finally:
+            config.rewrite_fusion_patterns = False
+        self.assertEqual(out, ref_out)
+        self.assertEqual(grads, ref_grads)
+        self.assertEqual(prof.summary()["fusion_patterns"]["rewrites"], 1)
+        for fx_g in graphs:
+            targets = _call_targets(fx_g)
+            self.assertNotIn(torch.ops.aten.native_layer_norm.default, targets)
+            self.assertNotIn(torch.ops.aten.native_layer_norm_backward.default, targets)
+
+    def test_custom_pattern(self):
+        def pattern(x):
+            return torch.sigmoid(x) * x
+
+        def replacement(x):
+            return torch.nn.functional.silu(x)
+
+        silu = FusionPattern("silu", pattern, replacement,
+                             lambda: ((torch.randn(2, 3),), (torch.randn(4, 5, dtype=torch.float64),)))
+
+        def f(x, y):
+            h = x @ y
+            return ((torch.sigmoid(h) * h).sum(),)
+
+        inps = [torch.randn(3, 3, requires_grad=True), torch.randn(3, 3)]
+        fx_g = _joint_graph(f, inps)
+        ref = fx_g(inps, [torch.ones(())])
+        self.assertEqual(apply_fusion_patterns(fx_g, [silu]), 1)
+        self.assertIn(torch.ops.aten.silu.default, _call_targets(fx_g))
+        self.assertEqual(fx_g(inps, [torch.ones(())]), ref)
+
+        def bad_replacement(x, p):
+            return torch.sigmoid(x) * x + p
+
+        bad = FusionPattern("bad", lambda x, p: torch.sigmoid(x) * x, bad_replacement,
+                            lambda: ((torch.randn(2, 3), 1.0), (torch.randn(4, 5, dtype=torch.float64), 2.0)))
+        with self.assertRaisesRegex(ValueError, "isn't used by the pattern"):
+            apply_fusion_patterns(fx_g, [bad])
+
 
 class TestAOTModuleSimplified(TestCase):
     def test_aot_module_simplified(self):
@@ -547,6 +1215,85 @@ class TestAOTModuleSimplified(TestCase):
         assert torch.allclose(inputs[1].grad, cloned_inputs[1].grad)
 
 
+class _Layer(nn.Module):
+    def __init__(self, dim, scale=0.5):
+        super().__init__()
+        self.fc = nn.Linear(dim, dim)
+        self.norm = nn.LayerNorm(dim)
+        self.scale = scale
+
+    def forward(self, x):
+        return self.norm(x + self.scale * torch.relu(self.fc(x)))
+
+
+class _Stack(nn.Module):
+    def __init__(self, scales, dim=8):
+        super().__init__()
+        self.inp = nn.Linear(4, dim)
+        self.layers = nn.ModuleList([_Layer(dim, scale) for scale in scales])
+        self.out = nn.Linear(dim, 1)
+
+    def forward(self, x):
+        h = self.inp(x)
+        for layer in self.layers:
+            h = layer(h)
+        return self.out(h)
+
+
+class TestAOTModuleDeduplicated(TestCase):
+    def compile_and_check(self, mod, x):
+        graphs = []
+
+        def record_graph(fx_g, _):
+            graphs.append(fx_g)
+            return fx_g
+
+        ref_out, ref_grad = _outs_and_grads(mod, [x])
+        ref_param_grads = [p.grad for p in mod.parameters()]
+        mod.zero_grad(set_to_none=True)
+        aot_mod = aot_module(mod, record_graph, deduplicate_layers=True)
+        test_out, test_grad = _outs_and_grads(aot_mod, [x])
+        self.assertEqual(ref_out, test_out)
+        self.assertEqual(ref_grad, test_grad)
+        self.assertEqual(ref_param_grads, [p.grad for p in mod.parameters()])
+        # The number of compiled graphs, and of inputs of the forward
+        return len(graphs), len([n for n in graphs[0].graph.nodes if n.op == "placeholder"])
+
+    def test_compiles_once_per_layer_type(self):
+        for depth in [2, 6]:
+            mod = _Stack([0.5] * depth)
+            x = torch.randn(3, 4, requires_grad=True)
+            # The forward and backward of a layer, with its 4 parameters
+            self.assertEqual(self.compile_and_check(mod, x), (2, 5))
+
+    def test_different_attributes(self):
+        x = torch.randn(3, 4, requires_grad=True)
+        self.assertEqual(self.compile_and_check(_Stack([0.5, 0.5, 2.0]), x), (2, 5))
+
+        # Layers that differ share their identical linear and layer norm
+        self.assertEqual(self.compile_and_check(_Stack([0.5, 2.0]), x), (4, 3))
+
+        # Without repeated submodules, the whole module is compiled
+        self.assertEqual(self.compile_and_check(_Layer(4), x), (2, 5))
+
+    def test_module_is_not_modified(self):
+        mod = _Stack([0.5] * 3)
+        layers = list(mod.layers)
+        aot_mod = aot_module(mod, nop, deduplicate_layers=True)
+        aot_mod(torch.randn(3, 4)).sum().backward()
+        self.assertEqual(list(mod.layers), layers)
+        self.assertTrue(all(type(layer) is _Layer and "forward" not in vars(layer) for layer in mod.layers))
+
+    def test_hooks(self):
+        mod = _Stack([0.5] * 3)
+        calls = []
+        mod.layers[1].register_forward_hook(lambda *_: calls.append(1))
+        x = torch.randn(3, 4, requires_grad=True)
+        # The layer with a hook runs eagerly
+        self.assertEqual(self.compile_and_check(mod, x), (2, 5))
+        self.assertEqual(len(calls), 2)
+
+
 class TestRandom(TestCase):
     def test_preserve_random(self):
         def fn(x):